@@ -2,16 +2,46 @@
 import streamlit as st
 import streamlit_ext as ste
 import glob
-import json
-import os
 import io
-from image_operation_functions import resize_image, encode_image
-from openai_functions import chat_complition_images
-from document_functions import update_intro_table, \
-    get_available_days_name, get_table_id_of_days, \
-        update_table_for_lesson_plan, get_all_data_from_file, \
-            document_templates, document_templates_names_for_saving, \
-                update_assessment_and_marking_guide
+import os
+import time
+from image_operation_functions import prepare_images
+from openai_functions import lesson_plans_from_images, parse_lesson_plans, regenerate_lesson_plan
+from cache_functions import completion_cache_stats
+from tracing_functions import trace_request, summarize_trace
+from document_functions import get_available_days_name, GenerationContext, create_documents, \
+        document_templates_names_for_saving, generate_lesson_body
+from job_functions import submit_job, get_job, get_job_artifacts
+from export_functions import pdf_export_available, submit_pdf_conversion, iter_zip_bundle, mime_types
+
+# Show each day while the lesson plans are generated instead of waiting for the complete response
+stream_vision_response = os.environ.get("STREAM_VISION_RESPONSE", "1") != "0"
+
+# Show a collapsible table with the time spent in each stage after a generation
+show_timing_panel = os.environ.get("SHOW_TIMING_PANEL", "1") != "0"
+
+# Seconds between two refreshes of the page while a generation is running
+job_poll_seconds = float(os.environ.get("GENERATION_JOB_POLL_SECONDS", 1))
+
+# Name of the archive with all documents of a generation
+bundle_file_name = "lesson_plan_documents"
+
+# Icon shown for the status of each stage of a generation
+stage_status_icons = {"running": "⏳", "done": "✅", "failed": "❌"}
+
+# Message shown for each progress status of a day
+day_progress_messages = {"received": "planned, creating lesson body...",
+                         "lesson_body_ready": "lesson body created ✅",
+                         "lesson_body_failed": "lesson body could not be created, lesson plan text is used ⚠️"}
+
+# Parts of a generation which can be generated again: the whole day or one section of the day
+regeneration_sections = {"day": "Whole day",
+                         "aims_and_objective": "Aims and objectives",
+                         "introduction": "Introduction",
+                         "lesson_body": "Lesson body",
+                         "conclusion": "Conclusion",
+                         "assessment": "Assessment (and its answers)",
+                         "answers": "Answers"}
 
 # =============== Page setup
 st.header("Automated Lesson Plan App📄")
@@ -30,7 +60,21 @@ def show_uploaded_img_in_sidebar(uploaded_images):
     for image in uploaded_images:
         st.sidebar.image(image)
 
-def handle_images_and_prompts(user_uploaded_images, days_selected_by_user, no_of_questions_for_assessment, dict_of_duration_and_activity):
+def show_duplicate_images_in_sidebar(duplicate_images):
+    """
+    Display in the sidebar the images which were not sent because they are the same page as another image.
+
+    Parameters:
+        duplicate_images (list): {"name", "duplicate_of", "tokens"} of each image which was not sent.
+    """
+    if duplicate_images:
+        tokens_saved = sum(image["tokens"] for image in duplicate_images)
+        st.sidebar.info(f"{len(duplicate_images)} copied page(s) not sent, about {tokens_saved} tokens saved", icon="ℹ")
+        for image in duplicate_images:
+            st.sidebar.caption(f"{image['name']} is the same page as {image['duplicate_of']}")
+
+def handle_images_and_prompts(user_uploaded_images, days_selected_by_user, no_of_questions_for_assessment, dict_of_duration_and_activity, 
+                              stream=False, warn=None, report_duplicates=None):
     """
     Prompts the ChatGPT model to generate a lesson plan based on the provided images.
 
@@ -39,63 +83,38 @@ def handle_images_and_prompts(user_uploaded_images, days_selected_by_user, no_of
         no_of_days (int): The number of days for which the lesson plan is required.
         no_of_questions_for_assessment (int): The number of questions for each day of the assessment.
         dict_of_duration_and_activity(dict): 
+        stream (bool): give the response part by part while it is generated
+        warn (function): called with the message of each image which is skipped or can not be read, defaults to st.warning
+        report_duplicates (function): called with the copied images which are not sent 
+                                      ({"name", "duplicate_of", "tokens"}), defaults to show_duplicate_images_in_sidebar
     Returns:
         str: A JSON string containing the lesson plan for each day.
+        generator: parts of the JSON string if stream is True.
+    Raises:
+        ValueError: if none of the images can be read.
     """
-    # Prompt to get desired response from chatGPT
     no_of_days = len(days_selected_by_user)
-    
-    # Extract durations
-    durations = [day["Duration"] for day in dict_of_duration_and_activity.values()]
-    durations = ", ".join(str(duration)+" minutes" for duration in durations[:-1]) + " and " + str(durations[-1]) + " minutes"
+    warn = warn or (lambda message: st.warning(message, icon="⚠️"))
 
-    prompt = f"""I need {f"{no_of_days} lesson plans" if no_of_days>1 else f"{no_of_days} lesson plan"} according to provided images using Bloom's Taxonomy.
-    Design lesson plans for {durations} respectively.
-    Duration must be same as provided, adjust lesson plan according to time duration.
-    
-    Identify the following items from all provided images:
-    - KEY CONCEPTS & TERMINOLOGY
-    - Aims and Objectives
-    - Introduction (Opening routines, warmer, topic lead-in etc.)
-    - Lesson Body (Stages, activities, focus etc.)
-    - Duration
-    - Conclusion (Closing routines & wrap up, e.g. homework setting, review, summary etc.)
-    - Assessment ({no_of_questions_for_assessment} questions for students for assessment from the topic)
-    - Exact answers of assessment questions
-
-    Your response should start with JSON object.
-    I will use `json.loads()` to load your response in JSON. Give your response properly so that `json.loads()` don't create any issue.
-    Do not include any explanations, only provide {no_of_days} RFC8259 compliant JSON response following this format without deviation.
-    [{{"terminology": "key concepts and terminology separated by new line",
-    "aims_and_objective": "Aims and objectives separated by new line. Each line should start with SWBAT",
-    "introduction": "opening routines, warmer, topic lead-in etc separated by new line",
-    "lesson_body": "stages, activities, focus etc and should be a bit long e.g 4 to 5 lines",
-    "Duration": "lecture duration in minutes",
-    "conclusion": "closing routines & wrap up, e.g. homework setting, review, summary etc separated by new line",
-    "assessment": "{no_of_questions_for_assessment} questions for students for assessment from the topic separated by new line",
-    "answers": "Exact answers of assessment questions separated by new line"}}]
-
-    Make sure that values must be in string.
-    Don't repeat terminologies for each day.
-    Don't change any key.
-    Don't forget to use Bloom's Taxonomy while creating lesson plans.
-    Don't forget any instruction mentioned above.
-    """
-    # Don't use collections in values. 
-
-    content = [{"type": "text", "text": prompt}]
-
-    for image in user_uploaded_images:
-        resized_image = resize_image(image)
-        
-        # Convert RGBA image to RGB
-        if resized_image.mode == 'RGBA':
-            resized_image = resized_image.convert('RGB')
-        base64_image = encode_image(resized_image)
-        content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{base64_image}"})
-    # print(content)
-    # print(prompt)
-    return chat_complition_images(content, no_of_days)
+    # Resize, convert to RGB and encode all images in parallel, in upload order
+    images = []
+    duplicate_images = []
+    for prepared_image in prepare_images(user_uploaded_images):
+        if prepared_image["error"]:
+            warn(f"{prepared_image['name']} is skipped: {prepared_image['error']}")
+            continue
+        if prepared_image["duplicate_of"]:
+            # The same page is already sent
+            duplicate_images.append({key: prepared_image[key] for key in ("name", "duplicate_of", "tokens")})
+            continue
+        images.append(prepared_image)
+    if not images:
+        raise ValueError("None of the uploaded images could be read")
+    if duplicate_images:
+        report_duplicates(duplicate_images) if report_duplicates else show_duplicate_images_in_sidebar(duplicate_images)
+    # Many pages are read by batches at the same time, see lesson_plans_from_images
+    return lesson_plans_from_images(images, no_of_days, no_of_questions_for_assessment, dict_of_duration_and_activity, 
+                                    stream, warn)
 
 def get_current_path_of_file(file_name):
     """ This function will find the file from current working directory. 
@@ -133,13 +152,13 @@ def save_content_in_file(text, file_extension=".docx"):
     file_path = get_current_path_of_file(f"chatgpt_response{file_extension}")
     return file_path
 
-def show_download_button(file_name_containing_data, file_extension=".docx"):
+def show_download_button(file_name, data, file_extension=".docx"):
     """ 
-    This function will save content into  file and enable download button on web app 
-     from where user can download file.
+    This function enable download button on web app from where user can download file.
     
     Parameters:
-        text (required): the content that you want to save in file
+        file_name (required): name of the downloaded file without extension
+        data (required): content of the file (bytes)
         file_extension (optional): give the extension of file that you want to save the file. 
                                                 bydefault, it is .docx
     """
@@ -147,22 +166,235 @@ def show_download_button(file_name_containing_data, file_extension=".docx"):
     if not file_extension.startswith("."):
         file_extension = f".{file_extension}"
 
-    doc_download = get_all_data_from_file(file_name_containing_data)
-    bio = io.BytesIO()
-    doc_download.save(bio)
     # use ste extension of streamlit for the reload problem while press download button
     # while click on download button page reload and other download buttons disappear because app rerun.
     # using ste prevent application from rerun.
-    ste.download_button(f"Download your {file_name_containing_data}{file_extension} file", 
-                       data=bio.getvalue(), 
-                       file_name=f"{file_name_containing_data}{file_extension}", 
-                       mime="docx")
+    ste.download_button(f"Download your {file_name}{file_extension} file", 
+                       data=data, 
+                       file_name=f"{file_name}{file_extension}", 
+                       mime=mime_types.get(file_extension, "application/octet-stream"))
     
+def show_timing_report(timing):
+    """
+    Display the time, tokens and payload of each stage of a generation in a collapsible panel.
+
+    Parameters:
+        timing (dict): {"wall_time": seconds, "stages": summary of the trace}, see tracing_functions.summarize_trace
+    """
+    with st.expander(f"Timing report ({timing['wall_time']:.1f} s)"):
+        st.dataframe(timing["stages"], hide_index=True)
+
+def create_job_documents(job, teacher_name, course_name, unit_title, week, days, gpt_responses, activities, 
+                         lesson_bodies=None):
+    """
+    Create the lesson plan, assessment and marking guide of a job and their PDF. Each document is added to the job
+    as soon as it is created. The results of the days are kept in the job so that one day or one section can be 
+    generated again without the others, see regenerate_documents.
+
+    Parameters:
+        job (JobProgress): progress of the job.
+        teacher_name, course_name, unit_title, week (str): values of the intro table.
+        days (list): selected days.
+        gpt_responses (iterable): lesson plan of each day, may be a generator of a streamed response.
+        activities (list): activity of each day.
+        lesson_bodies (list, optional): lesson bodies already generated, only the other days are requested.
+    """
+    def show_day_progress(index_number, status):
+        if index_number < len(days):
+            job.day(days[index_number], day_progress_messages[status])
+
+    # Stage of each document
+    document_stages = dict(zip(document_templates_names_for_saving, ["Lesson plan document", "Assessment", "Marking guide"]))
+    errors = []
+    export_pdf = pdf_export_available()
+    pdf_conversions = {}
+
+    def document_ready(file_name, document):
+        # Each document can be downloaded as soon as it is created, its PDF is made while the others are created
+        if isinstance(document, bytes):
+            job.add_artifact(f"{file_name}.docx", document)
+            job.stage(document_stages[file_name], "done")
+            if export_pdf:
+                pdf_conversions[file_name] = submit_pdf_conversion(document, file_name)
+        else:
+            errors.append(document)
+            job.update(errors=errors)
+            job.stage(document_stages[file_name], "failed")
+
+    for stage in document_stages.values():
+        job.stage(stage)
+    # The assessment and the marking guide are created while the lesson bodies are generated
+    context = GenerationContext()
+    create_documents(teacher_name, course_name, unit_title, week, days, gpt_responses, activities, 
+                     progress_callback=show_day_progress, context=context, document_callback=document_ready, 
+                     lesson_bodies=lesson_bodies)
+    if context.lesson_plans:
+        job.update(results={"teacher_name": teacher_name, "course_name": course_name, "unit_title": unit_title, 
+                            "week": week, "days": days, "activities": activities, 
+                            "lesson_plans": context.lesson_plans, "lesson_bodies": context.lesson_bodies})
+
+    if pdf_conversions:
+        job.stage("PDF export")
+        pdf_export_status = "done"
+        for file_name, pdf_conversion in pdf_conversions.items():
+            pdf_document = pdf_conversion.result()
+            if isinstance(pdf_document, bytes):
+                job.add_artifact(f"{file_name}.pdf", pdf_document)
+            else:
+                # The .docx file can still be downloaded
+                job.warn(f"PDF of {file_name} could not be created: {pdf_document}")
+                pdf_export_status = "failed"
+        job.stage("PDF export", pdf_export_status)
+
+def generate_documents(job, teacher_name, course_name, unit_title, week, user_selected_days, 
+                       number_of_questions_for_assessment, duration_activity, uploaded_images):
+    """
+    Generate the lesson plan, assessment and marking guide. Runs as a job (see job_functions.submit_job)
+    so that it continues when the page is rerun or closed, the documents are added to the job.
+
+    Parameters:
+        job (JobProgress): progress of the job.
+        teacher_name, course_name, unit_title, week, user_selected_days, number_of_questions_for_assessment, 
+        duration_activity: values entered in the page.
+        uploaded_images (list): (name, bytes) of each uploaded image.
+    """
+    images = []
+    for name, data in uploaded_images:
+        image = io.BytesIO(data)
+        image.name = name
+        images.append(image)
+    activities = [day["Activity"] for day in duration_activity.values()]
+
+    def report_duplicates(duplicate_images):
+        job.update(duplicate_images=duplicate_images)
+
+    with trace_request("generate_documents", days=len(user_selected_days), images=len(images)) as trace:
+        job.stage("Lesson plans")
+        if stream_vision_response:
+            def stream_days():
+                # Each day is given as soon as its object is complete in the response
+                gpt_response = handle_images_and_prompts(images, user_selected_days, number_of_questions_for_assessment, 
+                                                         duration_activity, stream=True, warn=job.warn,
+                                                         report_duplicates=report_duplicates)
+                try:
+                    yield from parse_lesson_plans(gpt_response, no_of_days=len(user_selected_days))
+                except Exception:
+                    job.stage("Lesson plans", "failed")
+                    raise
+                job.stage("Lesson plans", "done")
+
+            # Lesson body of Monday is created while the next days are still generated
+            gpt_responses = stream_days()
+        else:
+            gpt_response = handle_images_and_prompts(images, user_selected_days, number_of_questions_for_assessment, 
+                                                     duration_activity, warn=job.warn, report_duplicates=report_duplicates)
+            # Days which can not be loaded are corrected one by one
+            gpt_responses = list(parse_lesson_plans(gpt_response, no_of_days=len(user_selected_days)))
+            job.stage("Lesson plans", "done")
+
+        create_job_documents(job, teacher_name, course_name, unit_title, week, user_selected_days, gpt_responses, activities)
+    job.update(timing={"wall_time": trace["wall_time"], "stages": summarize_trace(trace)})
+
+def regenerate_documents(job, results, day, section):
+    """
+    Generate one day or one section of a day again and make the documents again. The other days and sections 
+    are taken from the results of a previous generation, so only one completion is requested (two for a whole 
+    day: its lesson plan and its lesson body). Runs as a job like generate_documents.
+
+    Parameters:
+        job (JobProgress): progress of the job.
+        results (dict): results of the previous generation, see create_job_documents.
+        day (str): the day generated again.
+        section (str): key of regeneration_sections.
+    """
+    # Kept first, so that it can be tried again if this generation fails
+    job.update(results=results)
+    lesson_plans = [dict(lesson_plan) for lesson_plan in results["lesson_plans"]]
+    lesson_bodies = list(results["lesson_bodies"])
+    index_number = results["days"].index(day)
+    stage = f"{day}: {regeneration_sections[section]}"
+
+    with trace_request("regenerate_documents", day=day, section=section) as trace:
+        job.stage(stage)
+        try:
+            if section != "lesson_body":
+                lesson_plans[index_number] = regenerate_lesson_plan(lesson_plans[index_number], 
+                                                                    None if section == "day" else [section])
+            if section in ("day", "lesson_body") and index_number < len(lesson_bodies):
+                lesson_plan = lesson_plans[index_number]
+                lesson_bodies[index_number] = generate_lesson_body(lesson_plan["lesson_body"], lesson_plan["Duration"], 
+                                                                   results["activities"][index_number], use_cache=False)
+        except Exception:
+            job.stage(stage, "failed")
+            raise
+        job.stage(stage, "done")
+
+        create_job_documents(job, results["teacher_name"], results["course_name"], results["unit_title"], results["week"],
+                             results["days"], lesson_plans, results["activities"], lesson_bodies)
+    job.update(timing={"wall_time": trace["wall_time"], "stages": summarize_trace(trace)})
+
+def show_regeneration_form(job):
+    """
+    Display the form which generates one day or one section of a finished generation again.
+
+    Parameters:
+        job (dict): the job, its progress has the results of the generation.
+    """
+    results = job["progress"]["results"]
+    with st.expander("Not happy with a part? Generate only that part again"):
+        with st.form(f"regenerate_{job['id']}"):
+            day = st.selectbox("Day", results["days"][:len(results["lesson_plans"])])
+            section = st.selectbox("Part", list(regeneration_sections), format_func=regeneration_sections.get)
+            if st.form_submit_button("Generate again"):
+                # The documents of the other days and sections are made again from the results
+                job_id = submit_job("regenerate_documents", regenerate_documents, results, day, section)
+                st.session_state["job_id"] = st.query_params["job"] = job_id
+                st.rerun()
+
+def show_job(job):
+    """
+    Display the progress of a generation, or its download buttons once it is done.
+
+    Parameters:
+        job (dict): the job, see job_functions.get_job
+    """
+    progress = job["progress"]
+    show_duplicate_images_in_sidebar(progress.get("duplicate_images", []))
+    for warning in progress["warnings"]:
+        st.warning(warning, icon="⚠️")
+    if job["status"] in ("queued", "running"):
+        label = "Creating your documents..." if job["status"] == "running" else "Waiting for other generations to finish..."
+        with st.status(label, expanded=True):
+            for stage, status in progress["stages"].items():
+                st.write(f"{stage} {stage_status_icons[status]}")
+            for day, message in progress["days"].items():
+                st.write(f"{day}: {message}")
+    elif job["status"] == "failed":
+        st.error(job["error"], icon="🚨")
+    for error in progress.get("errors", []):
+        st.error(error)
+    # Download buttons, documents which are ready can be downloaded while the others are created
+    # Same order as the documents whatever the order in which they were created
+    download_order = [f"{name}{file_extension}" for file_extension in [".docx", ".pdf"] 
+                      for name in document_templates_names_for_saving]
+    artifacts = dict(sorted(get_job_artifacts(job["id"]).items(), 
+                            key=lambda artifact: download_order.index(artifact[0]) if artifact[0] in download_order 
+                            else len(download_order)))
+    for file_name, document in artifacts.items():
+        name, file_extension = os.path.splitext(file_name)
+        show_download_button(name, document, file_extension)
+    if job["status"] == "done" and len(artifacts) > 1:
+        # All documents in one archive
+        show_download_button(bundle_file_name, b"".join(iter_zip_bundle(artifacts.items())), ".zip")
+    if job["status"] in ("done", "failed") and "results" in progress:
+        show_regeneration_form(job)
+    if show_timing_panel and "timing" in progress:
+        show_timing_report(progress["timing"])
+
 def main():
     """
     Main function of the app.
     """
-    file_ready = assessment_ready = marking_guide_ready = False
     # =============== User interaction section
     # ---------- Get information to update intro table
     col1, col2 = st.columns(2)
@@ -174,7 +406,11 @@ def main():
         course_name = st.text_input("Course: ", value="AP COMPUTER SCIENCE")
         week = st.text_input("Week: ", value="19")
     
-    user_selected_days = st.multiselect("Select days for lesson planning", get_available_days_name())
+    day_names = get_available_days_name()
+    if isinstance(day_names, str) and day_names.startswith("Error_"):
+        st.error(f"The days of the lesson plan template could not be read: {day_names.removeprefix('Error_')}", icon="🚨")
+        st.stop()
+    user_selected_days = st.multiselect("Select days for lesson planning", day_names)
     
     # Define a column layout with two columns.
     col3, col4 = st.columns(2)
@@ -212,62 +448,35 @@ def main():
             user_selected_days and number_of_questions_for_assessment and \
                 duration_activity:
 
-            updated_intro_table, selected_doc_template = update_intro_table(teacher_name, course_name, unit_title, week)
-            # list of table_id_of_lesson_plan_days
-            table_id_for_lesson_plan = get_table_id_of_days(user_selected_days, selected_doc_template)
-
-            if updated_intro_table == True:
-                st.success("Introduction Updated Successfully")
-            else:
-                st.error(updated_intro_table)
-
             if user_uploaded_images:
-                with st.spinner('Creating your document...'):
-                    gpt_response = handle_images_and_prompts(user_uploaded_images, user_selected_days, 
-                                                             number_of_questions_for_assessment, duration_activity)
-                    # for debugging - view responses in terminal
-                    print(f"{'-'*20}GPT Response Original{'-'*20}\n", type(gpt_response))
-                    print(gpt_response)
-
-                    gpt_response = gpt_response.replace("`", "").replace("json", "")
-
-                    # for debugging - view responses in terminal
-                    # print(f"{'-'*20}GPT Response Setted{'-'*20}\n", type(gpt_response))
-                    # print(gpt_response)
-                    
-                    # for a_lesson_plan in gpt_response
-                    gpt_response_list = json.loads(gpt_response)
-
-                    # for debugging - view responses in terminal
-                    # print(f"{'-'*20}GPT Response Finalized{'-'*20}\n", type(gpt_response_list))
-                    # print(gpt_response_list)
-
-                with st.spinner('Creating Lesson Plans...'):
-                    activities = [day["Activity"] for day in duration_activity.values()]
-                    file_ready = update_table_for_lesson_plan(table_id_for_lesson_plan, gpt_response_list, activities)
-                with st.spinner('Creating Assessments...'):
-                    assessment_ready = update_assessment_and_marking_guide(document_templates()[1], 
-                                                                                        gpt_response_list, "assessment")
-                with st.spinner('Creating Marking Guides...'):
-                    marking_guide_ready = update_assessment_and_marking_guide(document_templates()[2],
-                                                                                            gpt_response_list, "answers")
-                # Download buttons
-                if file_ready == assessment_ready == marking_guide_ready == True:
-                    show_download_button(document_templates_names_for_saving[0])
-                    show_download_button(document_templates_names_for_saving[1])
-                    show_download_button(document_templates_names_for_saving[2])
-
-                else:
-                    if file_ready != True:
-                        st.error(file_ready)
-                    if assessment_ready != True:
-                        st.error(assessment_ready)
-                    if marking_guide_ready != True:
-                        st.error(marking_guide_ready)
+                # The generation runs as a job, the page only shows its progress. The job id is kept in the
+                # url as well so that the documents can be downloaded after the page is refreshed.
+                uploaded_images = [(image.name, image.getvalue()) for image in user_uploaded_images]
+                job_id = submit_job("generate_documents", generate_documents, teacher_name, course_name, unit_title, 
+                                    week, user_selected_days, number_of_questions_for_assessment, duration_activity, 
+                                    uploaded_images)
+                st.session_state["job_id"] = st.query_params["job"] = job_id
             else:
                 st.error("Please upload images first then press button", icon="🚨")
         else:
                 st.error("All fields are required", icon="🚨")
 
+    # =============== Generation section
+    job_id = st.session_state.get("job_id") or st.query_params.get("job")
+    if job_id:
+        job = get_job(job_id)
+        if job is None:
+            st.info("The documents of the last generation have expired, please press Process again", icon="ℹ")
+            st.session_state.pop("job_id", None)
+            st.query_params.pop("job", None)
+        else:
+            st.session_state["job_id"] = job_id
+            show_job(job)
+            cache_stats = completion_cache_stats()
+            st.sidebar.caption(f"Completion cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+            if job["status"] in ("queued", "running"):
+                time.sleep(job_poll_seconds)
+                st.rerun()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
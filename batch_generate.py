@@ -0,0 +1,306 @@
+"""
+Generate the lesson plan, assessment and answers documents of many units without the app.
+
+The manifest (CSV, JSON or YAML) has one unit per row with the columns:
+    teacher, course, unit, week, days, durations, activities, images
+and optionally id and questions (number of assessment questions of each day, default 3).
+In a CSV file the lists (days, durations, activities, images) are separated by ";". A single
+duration or activity is used for every day. images are folders (or files) of page images,
+relative paths are relative to the manifest.
+
+Each unit is written to its own directory <output-dir>/<id>. A status.json file is written
+there last, units which already have one with status "done" are skipped when the batch is
+run again (e.g. after a crash), unless --force is given.
+
+Example:
+    python batch_generate.py term_2.csv --output-dir term_2 --units 4 --api-concurrency 6
+"""
+# Import modules
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Extensions of the page images read from an image folder
+image_extensions = (".png", ".jpg", ".jpeg")
+# Name of the file which marks a unit as generated
+status_file_name = "status.json"
+default_no_of_questions = 3
+
+def split_list(value):
+    """
+    A list from the manifest, CSV cells are separated by ";".
+    """
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in str(value).split(";") if item.strip()]
+
+def unit_id(unit):
+    """
+    Name of the output directory of a unit, the id of the manifest or <course>-<unit>-week-<week>.
+    """
+    name = unit.get("id") or f"{unit['course']}-{unit['unit']}-week-{unit['week']}"
+    return re.sub(r"[^a-z0-9]+", "-", str(name).lower()).strip("-")
+
+def normalize_unit(row, manifest_directory):
+    """
+    This function checks one row of the manifest and gives the unit to generate.
+
+    Parameters:
+        row (dict): the row as read from the manifest.
+        manifest_directory (str): directory of the manifest, image folders are relative to it.
+
+    Returns:
+        dict: {"id", "teacher", "course", "unit", "week", "days", "duration_activity", "questions", "images"}
+
+    Raises:
+        ValueError: if a required value is missing or the lists do not match the days.
+    """
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+    for field in ["teacher", "course", "unit", "week", "days", "images"]:
+        if not row.get(field):
+            raise ValueError(f"{field} is missing")
+    days = split_list(row["days"])
+    durations = split_list(row.get("durations")) or ["40"]
+    activities = split_list(row.get("activities")) or [""]
+    if len(durations) == 1:
+        durations = durations * len(days)
+    if len(activities) == 1:
+        activities = activities * len(days)
+    if len(durations) != len(days) or len(activities) != len(days):
+        raise ValueError(f"{len(days)} days but {len(durations)} durations and {len(activities)} activities")
+
+    images = []
+    for path in split_list(row["images"]):
+        if not os.path.isabs(path):
+            path = os.path.join(manifest_directory, path)
+        if os.path.isdir(path):
+            images += sorted(os.path.join(path, file_name) for file_name in os.listdir(path)
+                             if file_name.lower().endswith(image_extensions))
+        else:
+            images.append(path)
+    if not images:
+        raise ValueError(f"no images found in {row['images']}")
+
+    unit = {"teacher": str(row["teacher"]), "course": str(row["course"]), "unit": str(row["unit"]),
+            "week": str(row["week"]), "days": days,
+            "duration_activity": {day: {"Duration": int(float(duration)), "Activity": activity}
+                                  for day, duration, activity in zip(days, durations, activities)},
+            "questions": int(row.get("questions") or default_no_of_questions),
+            "images": images}
+    unit["id"] = unit_id({**unit, "id": row.get("id")})
+    return unit
+
+def load_manifest(manifest_path):
+    """
+    This function reads the units of a CSV, JSON or YAML manifest.
+
+    Parameters:
+        manifest_path (str): path of the manifest.
+
+    Returns:
+        list: the units, see normalize_unit.
+
+    Raises:
+        ValueError: if the manifest or one of its units is not valid.
+    """
+    extension = os.path.splitext(manifest_path)[1].lower()
+    with open(manifest_path, encoding="utf-8-sig") as manifest_file:
+        if extension == ".csv":
+            rows = list(csv.DictReader(manifest_file))
+        elif extension == ".json":
+            rows = json.load(manifest_file)
+        elif extension in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is needed to read YAML manifests (pip install pyyaml)")
+            rows = yaml.safe_load(manifest_file)
+        else:
+            raise ValueError(f"unknown manifest type {extension}, use .csv, .json or .yaml")
+    # {"units": [...]} is accepted as well as a list
+    if isinstance(rows, dict):
+        rows = rows.get("units", [])
+
+    units, errors = [], []
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    for row_number, row in enumerate(rows, start=1):
+        try:
+            units.append(normalize_unit(row, manifest_directory))
+        except (ValueError, TypeError) as e:
+            errors.append(f"unit {row_number}: {e}")
+    ids = [unit["id"] for unit in units]
+    errors += [f"{duplicate_id} is used by more than one unit" for duplicate_id in sorted(set(ids)) if ids.count(duplicate_id) > 1]
+    if errors:
+        raise ValueError("\n".join(errors))
+    return units
+
+def read_status(unit_directory):
+    try:
+        with open(os.path.join(unit_directory, status_file_name)) as status_file:
+            return json.load(status_file)
+    except (OSError, ValueError):
+        return None
+
+def write_status(unit_directory, status):
+    # Written to a temporary file first so that a crash never leaves a half written status
+    status_path = os.path.join(unit_directory, status_file_name)
+    with open(status_path + ".tmp", "w") as status_file:
+        json.dump(status, status_file, indent=2)
+    os.replace(status_path + ".tmp", status_path)
+
+def initialize_worker(semaphore, rate_limits):
+    """
+    Runs once in every unit process: share the global API limit and the rate limits of the account.
+    """
+    # Streamlit prints warnings when its functions are used outside of "streamlit run"
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    from openai_functions import set_api_semaphore
+    from rate_limit_functions import use_shared_rate_limits
+    set_api_semaphore(semaphore)
+    use_shared_rate_limits(rate_limits)
+
+def generate_unit(unit, unit_directory):
+    """
+    This function generates the three documents of one unit in its directory.
+
+    Parameters:
+        unit (dict): the unit, see normalize_unit.
+        unit_directory (str): directory where the documents and status.json are written.
+
+    Returns:
+        dict: the status of the unit {"id", "status": "done" or "failed", "errors", "documents", "wall_time",
+              "duplicate_images": images not sent because they are the same page as another image}
+    """
+    from image_operation_functions import prepare_images
+    from openai_functions import lesson_plans_from_images, parse_lesson_plans
+    from tracing_functions import trace_request
+    from document_functions import GenerationContext, create_documents, get_available_days_name
+
+    os.makedirs(unit_directory, exist_ok=True)
+    status = {"id": unit["id"], "status": "failed", "errors": [], "documents": [], "duplicate_images": []}
+    start = time.perf_counter()
+    with trace_request("batch_unit", unit=unit["id"], days=len(unit["days"]), images=len(unit["images"])):
+        try:
+            day_names = get_available_days_name()
+            if isinstance(day_names, str) and day_names.startswith("Error_"):
+                raise RuntimeError("the days of the lesson plan template could not be read: "
+                                   f"{day_names.removeprefix('Error_')}")
+            # Days of the manifest are matched to the days of the template whatever their case
+            available_days = {day_name.strip().upper(): day_name for day_name in day_names}
+            unknown_days = [day for day in unit["days"] if day.upper() not in available_days]
+            if unknown_days:
+                raise ValueError(f"{', '.join(unknown_days)} not found in the lesson plan template")
+            days = [available_days[day.upper()] for day in unit["days"]]
+
+            images = []
+            for prepared_image in prepare_images(unit["images"]):
+                if prepared_image["error"]:
+                    status["errors"].append(f"{prepared_image['name']} is skipped: {prepared_image['error']}")
+                    continue
+                if prepared_image["duplicate_of"]:
+                    # The same page is already sent
+                    status["duplicate_images"].append({key: prepared_image[key] for key in ("name", "duplicate_of", "tokens")})
+                    status["errors"].append(f"{prepared_image['name']} is not sent, it is the same page as "
+                                            f"{prepared_image['duplicate_of']}")
+                    continue
+                images.append(prepared_image)
+            if not images:
+                raise ValueError("none of the images could be read")
+
+            gpt_response = lesson_plans_from_images(images, len(unit["days"]), unit["questions"], unit["duration_activity"],
+                                                    warn=status["errors"].append)
+            gpt_response_list = list(parse_lesson_plans(gpt_response, no_of_days=len(unit["days"])))
+
+            activities = [day["Activity"] for day in unit["duration_activity"].values()]
+
+            documents_ready = create_documents(unit["teacher"], unit["course"], unit["unit"], unit["week"], days,
+                                               gpt_response_list, activities, context=GenerationContext(unit_directory))
+            for file_name, document in documents_ready.items():
+                if isinstance(document, bytes):
+                    status["documents"].append(f"{file_name}.docx")
+                else:
+                    status["errors"].append(f"{file_name}: {document}")
+            if len(status["documents"]) == len(documents_ready):
+                status["status"] = "done"
+        except Exception as e:
+            status["errors"].append(f"Error_{e}")
+    status["wall_time"] = time.perf_counter() - start
+    write_status(unit_directory, status)
+    return status
+
+def run_batch(units, output_dir, max_units=2, api_concurrency=4, force=False):
+    """
+    This function generates the units on a process pool, at most api_concurrency API requests
+    run at the same time across all units. The requests/min and tokens/min of the account
+    (OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE) are shared by all units too.
+
+    Parameters:
+        units (list): units of the manifest, see load_manifest.
+        output_dir (str): the directory of each unit is created in it.
+        max_units (int): number of units generated at the same time.
+        api_concurrency (int): number of API requests running at the same time.
+        force (bool): generate units again even if they are done.
+
+    Returns:
+        list: the status of each unit, in manifest order. Skipped units have status "skipped".
+    """
+    statuses = {}
+    pending_units = []
+    for unit in units:
+        unit_directory = os.path.join(output_dir, unit["id"])
+        previous_status = read_status(unit_directory)
+        if not force and previous_status and previous_status.get("status") == "done":
+            statuses[unit["id"]] = {**previous_status, "status": "skipped"}
+        else:
+            pending_units.append((unit, unit_directory))
+
+    if pending_units:
+        # One process per unit: the image preparation and the documents use the CPU
+        context = multiprocessing.get_context("spawn")
+        from rate_limit_functions import shared_rate_limits
+        semaphore = context.Semaphore(max(1, api_concurrency))
+        rate_limits = shared_rate_limits(context)
+        with ProcessPoolExecutor(max_workers=max(1, min(max_units, len(pending_units))), mp_context=context,
+                                 initializer=initialize_worker, initargs=(semaphore, rate_limits)) as executor:
+            futures = {executor.submit(generate_unit, unit, unit_directory): unit for unit, unit_directory in pending_units}
+            for future in as_completed(futures):
+                unit = futures[future]
+                try:
+                    statuses[unit["id"]] = future.result()
+                except Exception as e:
+                    # The unit process crashed, the unit is generated again on the next run
+                    statuses[unit["id"]] = {"id": unit["id"], "status": "failed", "errors": [f"Error_{e}"],
+                                            "documents": []}
+                status = statuses[unit["id"]]
+                print(f"{unit['id']}: {status['status']}" + "".join(f"\n    {error}" for error in status["errors"]),
+                      flush=True)
+    return [statuses[unit["id"]] for unit in units]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the lesson plans of many units from a manifest")
+    parser.add_argument("manifest", help="CSV, JSON or YAML file with one unit per row")
+    parser.add_argument("--output-dir", default="batch_output", help="a directory is created in it for each unit")
+    parser.add_argument("--units", type=int, default=2, help="number of units generated at the same time")
+    parser.add_argument("--api-concurrency", type=int, default=4,
+                        help="number of OpenAI requests running at the same time across all units")
+    parser.add_argument("--force", action="store_true", help="generate units which are already done again")
+    arguments = parser.parse_args()
+
+    try:
+        units = load_manifest(arguments.manifest)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Manifest {arguments.manifest} is not valid:\n{e}")
+    statuses = run_batch(units, arguments.output_dir, arguments.units, arguments.api_concurrency, arguments.force)
+    counts = {status: sum(unit_status["status"] == status for unit_status in statuses)
+              for status in ["done", "skipped", "failed"]}
+    print(f"{len(statuses)} units: {counts['done']} done, {counts['skipped']} skipped, {counts['failed']} failed")
+    sys.exit(1 if counts["failed"] else 0)
@@ -0,0 +1,164 @@
+"""
+Calibration of the token and cost estimator (token_functions) against the real traffic.
+
+Each request of the app logs what was predicted before it was sent and what it really used
+(TOKEN_ESTIMATE_LOG, default .cache/token_estimates.jsonl). This script compares them:
+  - prompt tokens of each model: real / predicted, e.g. when tiktoken is not installed,
+  - response tokens of each purpose (lesson_plans, page_extraction, lesson_body, ...): real / predicted,
+    how much of max_tokens is used and how many responses were cut off,
+  - time of each model: first_token_seconds and output_tokens_per_second fitted on the response tokens,
+  - predicted and real cost.
+With --write the fitted values are saved to the profile read by the app (TOKEN_ESTIMATOR_PROFILE).
+
+Example:
+    python -m benchmarks.calibrate_estimator --min-requests 20 --write
+"""
+# Import modules
+import argparse
+import json
+import os
+import statistics
+from token_functions import (token_estimate_log_path, estimator_profile_path, load_estimator_profile, model_profile,
+                             max_tokens_margin)
+
+def read_log(paths):
+    entries = []
+    for path in paths:
+        try:
+            with open(path) as log_file:
+                for line in log_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Last line of a log which is being written
+                        continue
+        except FileNotFoundError:
+            continue
+    return entries
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+def calibrate_models(entries, min_requests):
+    """
+    Returns:
+        dict: {model: {"requests", "prompt_ratio", "prompt_scale", "first_token_seconds", "output_tokens_per_second",
+                       "predicted_cost", "cost"}}, a value is None when there are not enough requests to fit it.
+    """
+    calibration = {}
+    for model in sorted({entry["model"] for entry in entries}):
+        model_entries = [entry for entry in entries if entry["model"] == model]
+        profile = model_profile(model)
+        # Streamed responses have no usage, their prompt is not known
+        prompt_ratios = [entry["prompt_tokens"] / entry["predicted_prompt_tokens"] for entry in model_entries
+                         if entry["prompt_tokens"] and entry["predicted_prompt_tokens"]]
+        prompt_ratio = statistics.median(prompt_ratios) if len(prompt_ratios) >= min_requests else None
+
+        # seconds - prompt tokens / prompt_tokens_per_second = first_token_seconds + response tokens / output_tokens_per_second
+        timed_entries = [entry for entry in model_entries if entry["seconds"] and entry["completion_tokens"]]
+        first_token_seconds = output_tokens_per_second = None
+        if len(timed_entries) >= min_requests:
+            response_tokens = [entry["completion_tokens"] for entry in timed_entries]
+            writing_seconds = [entry["seconds"] - (entry["prompt_tokens"] or entry["predicted_prompt_tokens"])
+                               / profile["prompt_tokens_per_second"] for entry in timed_entries]
+            try:
+                slope, intercept = statistics.linear_regression(response_tokens, writing_seconds)
+                if slope > 0:
+                    first_token_seconds, output_tokens_per_second = max(0.0, intercept), 1 / slope
+            except statistics.StatisticsError:
+                # All responses have the same length
+                pass
+
+        costed_entries = [entry for entry in model_entries if entry["cost"] is not None]
+        calibration[model] = {
+            "requests": len(model_entries), "prompt_ratio": prompt_ratio,
+            "prompt_scale": None if prompt_ratio is None else profile["prompt_scale"] * prompt_ratio,
+            "first_token_seconds": first_token_seconds, "output_tokens_per_second": output_tokens_per_second,
+            "predicted_cost": sum(entry["predicted_cost"] for entry in costed_entries),
+            "cost": sum(entry["cost"] for entry in costed_entries)}
+    return calibration
+
+def calibrate_purposes(entries, min_requests, current_scales):
+    """
+    Returns:
+        dict: {purpose: {"requests", "response_ratio", "output_scale", "p95_response_ratio", "p95_max_tokens_used",
+                         "cut_off"}}, a value is None when there are not enough requests to fit it.
+    """
+    calibration = {}
+    for purpose in sorted({entry["purpose"] for entry in entries}):
+        purpose_entries = [entry for entry in entries if entry["purpose"] == purpose
+                           and entry["completion_tokens"] and entry["predicted_completion_tokens"]]
+        if not purpose_entries:
+            continue
+        ratios = [entry["completion_tokens"] / entry["predicted_completion_tokens"] for entry in purpose_entries]
+        used_shares = [entry["completion_tokens"] / entry["max_tokens"] for entry in purpose_entries if entry["max_tokens"]]
+        response_ratio = statistics.median(ratios) if len(ratios) >= min_requests else None
+        calibration[purpose] = {
+            "requests": len(purpose_entries), "response_ratio": response_ratio,
+            "output_scale": None if response_ratio is None else current_scales.get(purpose, 1.0) * response_ratio,
+            # Margin needed after the new scale so that 95% of the responses fit in max_tokens
+            "p95_response_ratio": percentile(ratios, 0.95) / (response_ratio or 1.0),
+            "p95_max_tokens_used": percentile(used_shares, 0.95) if used_shares else None,
+            "cut_off": sum(entry["finish_reason"] == "length" for entry in purpose_entries)}
+    return calibration
+
+def format_value(value, digits=2):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+def print_report(models, purposes):
+    print(f"{'model':>22} | {'requests':>8} | {'prompt real/pred':>16} | {'first token (s)':>15} | "
+          f"{'tokens/s':>8} | {'cost pred ($)':>13} | {'cost real ($)':>13}")
+    for model, values in models.items():
+        print(f"{model:>22} | {values['requests']:>8} | {format_value(values['prompt_ratio']):>16} | "
+              f"{format_value(values['first_token_seconds']):>15} | {format_value(values['output_tokens_per_second'], 1):>8} | "
+              f"{values['predicted_cost']:>13.4f} | {values['cost']:>13.4f}")
+    print()
+    print(f"{'purpose':>22} | {'requests':>8} | {'response real/pred':>18} | {'p95 / median':>12} | "
+          f"{'p95 max_tokens used':>19} | {'cut off':>7}")
+    for purpose, values in purposes.items():
+        print(f"{purpose:>22} | {values['requests']:>8} | {format_value(values['response_ratio']):>18} | "
+              f"{format_value(values['p95_response_ratio']):>12} | {format_value(values['p95_max_tokens_used']):>19} | "
+              f"{values['cut_off']:>7}")
+    p95_ratios = [values["p95_response_ratio"] for values in purposes.values()]
+    if p95_ratios:
+        print(f"\nmax_tokens margin: {max_tokens_margin:.2f}, 95% of the responses fit with a margin of "
+              f"{max(0.0, max(p95_ratios) - 1):.2f} (MAX_TOKENS_MARGIN)")
+
+def write_profile(path, models, purposes):
+    """
+    Save the fitted values to the profile, the values which could not be fitted are kept.
+    """
+    profile = load_estimator_profile(path)
+    for model, values in models.items():
+        fitted_values = {key: values[key] for key in ("prompt_scale", "first_token_seconds", "output_tokens_per_second")
+                         if values[key] is not None}
+        profile["models"].setdefault(model, {}).update(fitted_values)
+    for purpose, values in purposes.items():
+        if values["output_scale"] is not None:
+            profile["output_scale"][purpose] = values["output_scale"]
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as profile_file:
+        json.dump(profile, profile_file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the token and cost estimator on the logged requests")
+    parser.add_argument("--log", nargs="+", default=[token_estimate_log_path, f"{token_estimate_log_path}.1"],
+                        help="logs of the requests, see TOKEN_ESTIMATE_LOG")
+    parser.add_argument("--profile", default=estimator_profile_path, help="profile read by the app")
+    parser.add_argument("--min-requests", type=int, default=10, help="requests needed to fit a value")
+    parser.add_argument("--write", action="store_true", help="save the fitted values to the profile")
+    arguments = parser.parse_args()
+
+    entries = read_log(arguments.log)
+    if not entries:
+        raise SystemExit(f"No request logged in {', '.join(arguments.log)}")
+    current_profile = load_estimator_profile(arguments.profile)
+    models = calibrate_models(entries, max(2, arguments.min_requests))
+    purposes = calibrate_purposes(entries, max(1, arguments.min_requests), current_profile["output_scale"])
+    print_report(models, purposes)
+    if arguments.write:
+        write_profile(arguments.profile, models, purposes)
+        print(f"\nProfile written to {arguments.profile}")
@@ -0,0 +1,108 @@
+"""
+Cold start benchmark: time to import the app and each module in a new Python process.
+
+Each import is measured several times with python -X importtime, in a process of its own so that
+nothing is cached in memory. OPENAI_API_KEY is removed from the environment: importing a module
+must not need an API key or a secrets file. The heaviest imports of each module are listed to find
+what makes it slow.
+
+Example:
+    python -m benchmarks.import_time --repeat 5 --top 5
+"""
+# Import modules
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# The app and the modules which can be imported alone (e.g. by the batch or the workers)
+modules = ["Lesson_Plan", "batch_generate", "document_functions", "openai_functions", "template_renderer_functions",
+           "docx_writer_functions", "image_operation_functions", "json_functions", "rate_limit_functions",
+           "cache_functions", "tracing_functions", "job_functions", "export_functions", "token_functions"]
+
+# Packages which should only be loaded when they are used
+heavy_packages = ["streamlit", "openai", "httpx", "PIL", "docx", "lxml"]
+
+def measure_import(module, repository_directory):
+    """
+    Import a module in a new process.
+
+    Returns:
+        dict: {"module", "seconds", "imports": {imported module: cumulative seconds}, "heavy_packages": [...], "error"}
+    """
+    environment = {key: value for key, value in os.environ.items() if key != "OPENAI_API_KEY"}
+    code = (f"import sys; import {module}; "
+            f"print(','.join(package for package in {heavy_packages!r} if package in sys.modules))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=repository_directory,
+                            env=environment, capture_output=True, text=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, indented by its depth.
+        # A package is printed after the packages it imports.
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            # Top level import, what was imported before it (e.g. by the interpreter start) is not counted
+            if name.strip() != module:
+                imports = {}
+                continue
+        imports[name.strip()] = int(cumulative) / 1e6
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"
+    loaded_packages = result.stdout.strip().split(",") if result.returncode == 0 and result.stdout.strip() else []
+    return {"module": module, "seconds": imports.get(module), "imports": imports,
+            "heavy_packages": loaded_packages, "error": error}
+
+def run_import_benchmark(selected_modules, repeat, top):
+    """
+    Measure every selected module repeat times.
+
+    Returns:
+        list: one dictionary of measures per module.
+    """
+    repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    measures = []
+    for module in selected_modules:
+        runs = [measure_import(module, repository_directory) for _ in range(repeat)]
+        times = [run["seconds"] for run in runs if run["seconds"] is not None]
+        errors = [run["error"] for run in runs if run["error"]]
+        # Heaviest top level packages of the last run, the module itself excluded
+        imports = runs[-1]["imports"]
+        heaviest = sorted(((name, seconds) for name, seconds in imports.items()
+                           if "." not in name and name != module), key=lambda item: item[1], reverse=True)[:top]
+        measures.append({"module": module,
+                         "median_seconds": statistics.median(times) if times else None,
+                         "min_seconds": min(times) if times else None,
+                         "heavy_packages": runs[-1]["heavy_packages"],
+                         "heaviest_imports": [{"package": name, "seconds": seconds} for name, seconds in heaviest],
+                         "errors": errors[0] if errors else None})
+    return measures
+
+def print_report(measures):
+    print(f"{'module':>30} | {'median (ms)':>11} | {'min (ms)':>9} | heavy packages loaded")
+    for measure in measures:
+        median = "-" if measure["median_seconds"] is None else f"{measure['median_seconds'] * 1000:.1f}"
+        minimum = "-" if measure["min_seconds"] is None else f"{measure['min_seconds'] * 1000:.1f}"
+        print(f"{measure['module']:>30} | {median:>11} | {minimum:>9} | {', '.join(measure['heavy_packages']) or '-'}")
+        if measure["errors"]:
+            print(f"{'':>30}   error: {measure['errors']}")
+        for heavy_import in measure["heaviest_imports"]:
+            print(f"{'':>30}   {heavy_import['package']:<28} {heavy_import['seconds'] * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold start time of the app and of each module")
+    parser.add_argument("--modules", nargs="+", default=modules, choices=modules)
+    parser.add_argument("--repeat", type=int, default=5, help="number of processes started for each module")
+    parser.add_argument("--top", type=int, default=5, help="number of heaviest imports listed for each module")
+    parser.add_argument("--json", help="also write the measures to this file")
+    arguments = parser.parse_args()
+
+    measures = run_import_benchmark(arguments.modules, max(1, arguments.repeat), arguments.top)
+    print_report(measures)
+    if arguments.json:
+        with open(arguments.json, "w") as json_file:
+            json.dump(measures, json_file, indent=2)
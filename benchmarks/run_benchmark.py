@@ -0,0 +1,199 @@
+"""
+Offline benchmark of the generation pipeline.
+
+The pipeline runs against the local stub OpenAI server (benchmarks/stub_openai_server.py) with
+synthetic page images, so no API calls are paid for. Each stage and number of days runs in its
+own process so that its peak RSS can be measured. The completion cache is disabled.
+
+Example:
+    python -m benchmarks.run_benchmark --days 1 3 5 7 --iterations 5 --latency 1.5
+"""
+# Import modules
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+
+# Stages which can be measured
+stages = ["handle_images_and_prompts", "update_table_for_lesson_plan",
+          "update_assessment_and_marking_guide", "end_to_end", "regenerate_section"]
+
+def synthetic_page(seed, width=3024, height=4032):
+    """
+    JPEG photo of a made up textbook page, as an uploaded file.
+    """
+    from PIL import Image, ImageDraw
+    random_generator = random.Random(seed)
+    page = Image.new("RGB", (width, height), (245, 243, 235))
+    draw = ImageDraw.Draw(page)
+    # Lines of "text"
+    for top in range(200, height - 200, 60):
+        left = 150
+        while left < width - 300:
+            word_width = random_generator.randint(40, 220)
+            draw.rectangle([left, top, left + word_width, top + 28], fill=(30, 30, 30))
+            left += word_width + random_generator.randint(20, 40)
+    page_file = io.BytesIO()
+    page.save(page_file, format="JPEG", quality=90)
+    page_file.seek(0)
+    page_file.name = f"page_{seed}.jpg"
+    return page_file
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_stage(stage, no_of_days, iterations, no_of_images, results):
+    """
+    Run one stage several times in this process and put the measures in results (a queue).
+    """
+    # Streamlit prints warnings when its functions are used outside of "streamlit run"
+    import logging
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    from benchmarks.stub_openai_server import canned_lesson_plans
+    from document_functions import days_names, create_lesson_plan, create_assessment_and_marking_guide, \
+        create_documents, generate_lesson_body, GenerationContext
+    from Lesson_Plan import handle_images_and_prompts
+
+    days = days_names[:no_of_days]
+    duration_activity = {day: {"Duration": 40, "Activity": "Pair programming"} for day in days}
+    activities = [day["Activity"] for day in duration_activity.values()]
+    images = [synthetic_page(seed) for seed in range(no_of_images)]
+    gpt_response_list = canned_lesson_plans(no_of_days)
+
+    def lesson_plan():
+        return create_lesson_plan("BEN", "AP COMPUTER SCIENCE", "ONE DIMENSIONAL ARRAYS", "19", days,
+                                  gpt_response_list, activities)
+
+    def assessment_and_marking_guide():
+        return [create_assessment_and_marking_guide(gpt_response_list, "assessment"),
+                create_assessment_and_marking_guide(gpt_response_list, "answers")]
+
+    def images_and_prompts():
+        for image in images:
+            image.seek(0)
+        return handle_images_and_prompts(images, days, 3, duration_activity)
+
+    def end_to_end():
+        images_and_prompts()
+        return list(create_documents("BEN", "AP COMPUTER SCIENCE", "ONE DIMENSIONAL ARRAYS", "19", days,
+                                     gpt_response_list, activities).values())
+
+    def regenerate_section():
+        # The lesson body of one day is generated again, the documents are made from the stored results
+        lesson_bodies = list(stored_results.lesson_bodies)
+        lesson_bodies[0] = generate_lesson_body(gpt_response_list[0]["lesson_body"], gpt_response_list[0]["Duration"],
+                                                activities[0], use_cache=False)
+        return list(create_documents("BEN", "AP COMPUTER SCIENCE", "ONE DIMENSIONAL ARRAYS", "19", days,
+                                     gpt_response_list, activities, lesson_bodies=lesson_bodies).values())
+
+    if stage == "regenerate_section":
+        # Results of a first generation, not measured
+        stored_results = GenerationContext()
+        create_documents("BEN", "AP COMPUTER SCIENCE", "ONE DIMENSIONAL ARRAYS", "19", days, gpt_response_list,
+                         activities, context=stored_results)
+
+    run = {"handle_images_and_prompts": images_and_prompts,
+           "update_table_for_lesson_plan": lesson_plan,
+           "update_assessment_and_marking_guide": assessment_and_marking_guide,
+           "end_to_end": end_to_end,
+           "regenerate_section": regenerate_section}[stage]
+
+    latencies, cpu_times, errors = [], [], 0
+    for _ in range(iterations):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        output = run()
+        latencies.append(time.perf_counter() - start)
+        cpu_times.append(time.process_time() - cpu_start)
+        outputs = output if isinstance(output, list) else [output]
+        errors += sum(isinstance(item, str) and item.startswith("Error_") for item in outputs)
+    results.put({"stage": stage, "days": no_of_days, "iterations": iterations,
+                 "p50_latency": percentile(latencies, 0.5), "p95_latency": percentile(latencies, 0.95),
+                 "mean_cpu_time": sum(cpu_times) / len(cpu_times), "peak_rss_mb": peak_rss_mb(),
+                 "errors": errors})
+
+def run_benchmark(days_list, iterations, no_of_images, selected_stages, latency, jitter, chunk_delay):
+    """
+    Start the stub server and measure every selected stage for every number of days.
+
+    Returns:
+        list: one dictionary of measures per stage and number of days.
+    """
+    from benchmarks.stub_openai_server import start_stub_server
+    server, base_url = start_stub_server(latency=latency, jitter=jitter, chunk_delay=chunk_delay)
+    # Inherited by the stage processes. Stub requests are not logged with the real ones used for calibration.
+    os.environ.update({"OPENAI_BASE_URL": base_url, "OPENAI_API_KEY": "benchmark",
+                       "COMPLETION_CACHE": "0", "PIPELINE_TRACING": "0", "TOKEN_ESTIMATE_LOG": ""})
+    context = multiprocessing.get_context("spawn")
+    measures = []
+    try:
+        for stage in selected_stages:
+            for no_of_days in days_list:
+                results = context.Queue()
+                process = context.Process(target=run_stage, args=(stage, no_of_days, iterations, no_of_images, results))
+                process.start()
+                while True:
+                    try:
+                        measures.append(results.get(timeout=1))
+                        break
+                    except queue.Empty:
+                        if not process.is_alive():
+                            # The stage crashed, its traceback is on stderr
+                            measures.append({"stage": stage, "days": no_of_days, "iterations": iterations,
+                                             "p50_latency": None, "p95_latency": None, "mean_cpu_time": None,
+                                             "peak_rss_mb": None, "errors": f"exit code {process.exitcode}"})
+                            break
+                process.join()
+    finally:
+        server.shutdown()
+    return measures
+
+def print_report(measures):
+    columns = ["stage", "days", "p50_latency", "p95_latency", "mean_cpu_time", "peak_rss_mb", "errors"]
+    print(" | ".join(f"{column:>35}" if column == "stage" else f"{column:>13}" for column in columns))
+    for measure in measures:
+        cells = []
+        for column in columns:
+            value = measure[column]
+            if column == "stage":
+                cells.append(f"{value:>35}")
+            elif isinstance(value, float):
+                cells.append(f"{value:>13.3f}")
+            else:
+                cells.append(f"{str(value):>13}")
+        print(" | ".join(cells))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the lesson plan pipeline")
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 3, 5, 7], help="numbers of selected days (1 to 7)")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--images", type=int, default=3, help="number of synthetic pages uploaded")
+    parser.add_argument("--stages", nargs="+", default=stages, choices=stages)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds before each stub response")
+    parser.add_argument("--jitter", type=float, default=0.2, help="random +/- seconds added to the latency")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed parts")
+    parser.add_argument("--json", help="also write the measures to this file")
+    arguments = parser.parse_args()
+
+    measures = run_benchmark([min(7, max(1, days)) for days in arguments.days], arguments.iterations,
+                             arguments.images, arguments.stages, arguments.latency, arguments.jitter,
+                             arguments.chunk_delay)
+    print_report(measures)
+    if arguments.json:
+        with open(arguments.json, "w") as json_file:
+            json.dump(measures, json_file, indent=2)
@@ -0,0 +1,163 @@
+"""
+Concurrency stress test of the document generation: many generations run at the same time in one
+process, as the Streamlit sessions of many teachers do, and each document is checked to contain
+only the values of its own generation.
+
+Lesson bodies come from the local stub OpenAI server (benchmarks/stub_openai_server.py). Every
+generation has its own teacher, unit, week and days, and its gpt responses are marked with its
+number. The documents are also written to LESSON_PLAN_OUTPUT_DIR (a temporary directory) to check
+that generations do not overwrite the files of each other. Both the compiled templates and the
+python-docx path are tested. The exit code is 1 if a document is wrong.
+
+Example:
+    python -m benchmarks.stress_generation_context --generations 200 --concurrency 32
+"""
+# Import modules
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Values of a generation in its documents, with its number
+generation_marker = re.compile(r"(?:TEACHER|UNIT|MARK)-(\d+)")
+
+def generation_values(number, days_names):
+    """
+    Teacher, unit, week, days and gpt responses of one generation, all marked with its number.
+    """
+    from benchmarks.stub_openai_server import canned_lesson_plans
+    random_generator = random.Random(number)
+    days = sorted(random_generator.sample(days_names, random_generator.randint(1, len(days_names))),
+                  key=days_names.index)
+    gpt_response_list = canned_lesson_plans(len(days))
+    for day_number, day_plan in enumerate(gpt_response_list, start=1):
+        for key in ["terminology", "assessment", "answers"]:
+            day_plan[key] = f"MARK-{number} day {day_number}\n{day_plan[key]}"
+    return {"teacher": f"TEACHER-{number}", "course": "AP COMPUTER SCIENCE", "unit": f"UNIT-{number}",
+            "week": str(number), "days": days, "gpt_response_list": gpt_response_list,
+            "activities": ["Pair programming"] * len(days)}
+
+def generate(number, days_names):
+    """
+    One generation with its own context, as one press of the Process button.
+
+    Returns:
+        (number, values, context)
+    """
+    from document_functions import GenerationContext, create_lesson_plan, create_assessment_and_marking_guide
+    values = generation_values(number, days_names)
+    context = GenerationContext()
+    create_lesson_plan(values["teacher"], values["course"], values["unit"], values["week"], values["days"],
+                       values["gpt_response_list"], values["activities"], context=context)
+    create_assessment_and_marking_guide(values["gpt_response_list"], "assessment", context=context)
+    create_assessment_and_marking_guide(values["gpt_response_list"], "answers", context=context)
+    return number, values, context
+
+def document_text(document_bytes):
+    with zipfile.ZipFile(io.BytesIO(document_bytes)) as document_zip:
+        return document_zip.read("word/document.xml").decode("utf-8")
+
+def check_generation(number, values, context):
+    """
+    Problems found in the documents of one generation, an empty list if they are right.
+    """
+    from document_functions import document_templates_names_for_saving
+    problems = []
+    for name_of_document in document_templates_names_for_saving:
+        document = context.documents.get(name_of_document)
+        if not isinstance(document, bytes):
+            problems.append(f"{name_of_document}: {document}")
+            continue
+        text = document_text(document)
+        other_generations = {int(found) for found in generation_marker.findall(text)} - {number}
+        if other_generations:
+            problems.append(f"{name_of_document} has values of generations {sorted(other_generations)[:5]}")
+        # Every day of the generation is in the document
+        for day_number in range(1, len(values["days"]) + 1):
+            if f"MARK-{number} day {day_number}" not in text:
+                problems.append(f"{name_of_document} misses day {day_number}")
+        if name_of_document == document_templates_names_for_saving[0]:
+            for value in [values["teacher"], values["unit"]]:
+                if value not in text:
+                    problems.append(f"{name_of_document} misses {value}")
+            # One lesson body for each selected day
+            if text.count("Stage 1 - ") != len(values["days"]):
+                problems.append(f"{name_of_document} has {text.count('Stage 1 - ')} lesson bodies "
+                                f"for {len(values['days'])} days")
+        # The file written is the document of this generation
+        path = os.path.join(context.output_dir or "", f"{name_of_document}.docx")
+        if not context.output_dir or not os.path.exists(path):
+            problems.append(f"{name_of_document} was not written")
+        else:
+            with open(path, "rb") as document_file:
+                if document_file.read() != document:
+                    problems.append(f"{path} is not the document of this generation")
+    return problems
+
+def run_stress(generations, concurrency, compiled):
+    """
+    Run the generations on a thread pool and check their documents.
+
+    Returns:
+        (wall time, {generation number: problems}) with only the generations which have problems.
+    """
+    import template_renderer_functions
+    from document_functions import get_available_days_name
+    # Days which have a table in the lesson plan template
+    days_names = get_available_days_name()
+    template_renderer_functions.compiled_templates = compiled
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda number: generate(number, days_names), range(generations)))
+    wall_time = time.perf_counter() - start
+
+    failures = {}
+    output_dirs = set()
+    for number, values, context in results:
+        problems = check_generation(number, values, context)
+        if context.output_dir in output_dirs:
+            problems.append(f"output directory {context.output_dir} is used by another generation")
+        output_dirs.add(context.output_dir)
+        if problems:
+            failures[number] = problems
+    return wall_time, failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrency stress test of the document generation")
+    parser.add_argument("--generations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16, help="generations running at the same time")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before each stub response")
+    arguments = parser.parse_args()
+
+    from benchmarks.stub_openai_server import start_stub_server
+    server, base_url = start_stub_server(latency=arguments.latency, jitter=arguments.latency / 2)
+    output_directory = tempfile.mkdtemp(prefix="stress_generation_context_")
+    # Read when the modules are imported. The stub has no rate limits and its requests are not logged
+    # with the real ones used for calibration.
+    os.environ.update({"OPENAI_BASE_URL": base_url, "OPENAI_API_KEY": "benchmark", "COMPLETION_CACHE": "0",
+                       "PIPELINE_TRACING": "0", "LESSON_PLAN_OUTPUT_DIR": output_directory, "TOKEN_ESTIMATE_LOG": "",
+                       "OPENAI_REQUESTS_PER_MINUTE": "1000000", "OPENAI_TOKENS_PER_MINUTE": "1000000000"})
+    # Streamlit prints warnings when its functions are used outside of "streamlit run"
+    import logging
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    failed = False
+    try:
+        for compiled in [True, False]:
+            wall_time, failures = run_stress(arguments.generations, arguments.concurrency, compiled)
+            path = "compiled templates" if compiled else "python-docx"
+            print(f"{path}: {arguments.generations} generations, {arguments.concurrency} at a time, "
+                  f"{wall_time:.2f}s, {len(failures)} wrong")
+            for number, problems in sorted(failures.items())[:10]:
+                print(f"    generation {number}: " + "; ".join(problems))
+            failed = failed or bool(failures)
+    finally:
+        server.shutdown()
+    print(f"Documents written in {output_directory}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,184 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, used to benchmark the app without
+spending money on API calls.
+
+Vision requests (messages with images) get a JSON array with one lesson plan per requested day,
+text requests get an expanded lesson body. Streamed requests are answered with server-sent events.
+Prompt tokens are counted like the API bills them (see token_functions.estimate_prompt_tokens) and a response
+longer than max_tokens is cut off with finish_reason "length".
+
+Run it alone with:
+    python -m benchmarks.stub_openai_server --port 8089 --latency 2
+and point the app to it with OPENAI_BASE_URL=http://127.0.0.1:8089/v1
+"""
+# Import modules
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from token_functions import estimate_prompt_tokens
+
+def canned_lesson_plans(no_of_days, no_of_questions=3):
+    """
+    Lesson plans in the format asked by handle_images_and_prompts.
+    """
+    return [{"terminology": f"Array\nIndex\nElement {day}",
+             "aims_and_objective": "SWBAT declare an array\nSWBAT traverse an array with a loop",
+             "introduction": "Warmer: recap of variables\nTopic lead-in: storing many values",
+             "lesson_body": "Explain array declaration, indexing and traversal with examples. "
+                            "Students practise with guided exercises and pair work.",
+             "Duration": "40",
+             "conclusion": "Review key points\nHomework: exercises 1 to 5",
+             "assessment": "\n".join(f"Question {day}.{number}" for number in range(1, no_of_questions + 1)),
+             "answers": "\n".join(f"Answer {day}.{number}" for number in range(1, no_of_questions + 1))}
+            for day in range(1, no_of_days + 1)]
+
+def canned_lesson_body():
+    """
+    Expanded lesson body in the format asked by generate_lesson_body.
+    """
+    return {"Lesson_Title": "One dimensional arrays",
+            "Duration": "40 minutes",
+            "Focus": "Declaring arrays and accessing their elements.\nTraversing arrays with loops.",
+            "Materials": "Slides\nWorksheet\nIDE",
+            "Activity": "Pair programming",
+            "Lesson_Stages": [{"Warm up (5 minutes)": "Recap of variables"},
+                              {"Explanation (10 minutes)": "Array declaration and indexing"},
+                              {"Practice (10 minutes)": "Guided exercises"},
+                              {"Activity (5 minutes)": "Pair programming"}]}
+
+def prompt_text(messages):
+    return " ".join(item.get("text", "") for message in messages
+                    for item in (message["content"] if isinstance(message["content"], list)
+                                 else [{"text": message["content"]}]))
+
+def requested_days(messages):
+    match = re.search(r"I need (\d+) lesson plan", prompt_text(messages))
+    return int(match.group(1)) if match else 1
+
+def regenerated_sections(messages):
+    """
+    Sections asked by regenerate_lesson_plan, None for other prompts.
+    """
+    match = re.search(r"Write these sections again: ([\w, ]+)\.", prompt_text(messages))
+    return match.group(1).split(", ") if match else None
+
+def response_for(request):
+    """
+    Canned content for a chat completion request.
+    """
+    messages = request["messages"]
+    has_images = any(isinstance(message["content"], list) and
+                     any(item.get("type") == "image_url" for item in message["content"])
+                     for message in messages)
+    if has_images and "Extract their content" in prompt_text(messages):
+        # Map step of the map-reduce
+        return "Arrays: a fixed number of elements of one type, accessed by index from 0.\n" \
+               "Example: int[] marks = new int[5]; traversal with a for loop.\nExercises 1 to 5."
+    if has_images or re.search(r"I need \d+ lesson plan", prompt_text(messages)):
+        return "```json\n" + json.dumps(canned_lesson_plans(requested_days(messages)), indent=2) + "\n```"
+    if "should be a JSON object but it is not valid" in prompt_text(messages):
+        # Asked by repair_lesson_plan, e.g. for a day cut off by max_tokens
+        return json.dumps(canned_lesson_plans(1)[0], indent=2)
+    sections = regenerated_sections(messages)
+    if sections:
+        return json.dumps({section: f"Regenerated {section}" for section in sections}, indent=2)
+    return json.dumps(canned_lesson_body(), indent=2)
+
+def make_handler(latency, jitter, chunk_delay, chunk_size):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            content = response_for(request)
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+            created = int(time.time())
+            prompt_tokens = estimate_prompt_tokens(request["messages"], request["model"])
+            # About 4 characters per token
+            finish_reason = "stop"
+            if request.get("max_tokens") and len(content) > request["max_tokens"] * 4:
+                content, finish_reason = content[:request["max_tokens"] * 4], "length"
+            completion_tokens = len(content) // 4 + 1
+            if request.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for start in range(0, len(content), chunk_size):
+                    chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created,
+                             "model": request["model"],
+                             "choices": [{"index": 0, "delta": {"content": content[start:start + chunk_size]},
+                                          "finish_reason": None}]}
+                    self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                    time.sleep(chunk_delay)
+                chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created,
+                         "model": request["model"], "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}
+                self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+                self.write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+                return
+
+            body = json.dumps({"id": "chatcmpl-stub", "object": "chat.completion", "created": created,
+                               "model": request["model"],
+                               "choices": [{"index": 0, "finish_reason": finish_reason,
+                                            "message": {"role": "assistant", "content": content}}],
+                               "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                         "total_tokens": prompt_tokens + completion_tokens}}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def write_chunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return StubHandler
+
+def start_stub_server(host="127.0.0.1", port=0, latency=1.0, jitter=0.0, chunk_delay=0.01, chunk_size=40):
+    """
+    Start the stub server on a background thread.
+
+    Parameters:
+        host, port: address to listen on, port 0 picks a free port.
+        latency (float): seconds before each response starts.
+        jitter (float): random +/- seconds added to the latency.
+        chunk_delay (float): seconds between two parts of a streamed response.
+        chunk_size (int): characters in each part of a streamed response.
+
+    Returns:
+        (server, base_url): call server.shutdown() to stop it, base_url goes in OPENAI_BASE_URL.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(latency, jitter, chunk_delay, chunk_size))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds added to the latency")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed parts")
+    arguments = parser.parse_args()
+    server, base_url = start_stub_server(arguments.host, arguments.port, arguments.latency,
+                                         arguments.jitter, arguments.chunk_delay)
+    print(f"Stub OpenAI server listening, set OPENAI_BASE_URL={base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,187 @@
+# Import modules
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Completion cache settings, can be changed with environment variables
+completion_cache_enabled = os.environ.get("COMPLETION_CACHE", "1") != "0"
+completion_cache_path = os.environ.get("COMPLETION_CACHE_PATH", os.path.join(".cache", "completions.sqlite3"))
+# Entries older than this are not used anymore (default 7 days)
+completion_cache_ttl_seconds = float(os.environ.get("COMPLETION_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60))
+# Least recently used entries are removed when the cache grows over this size (default 100 MB)
+completion_cache_max_bytes = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", 100 * 1024 * 1024))
+
+# Counters of the completion cache since the process started
+cache_counters = {"hits": 0, "misses": 0, "writes": 0, "expired": 0, "evictions": 0, "errors": 0}
+_cache_counters_lock = threading.Lock()
+
+def count_cache_event(counter, amount=1):
+    with _cache_counters_lock:
+        cache_counters[counter] += amount
+
+def normalize_prompt(text):
+    """
+    Normalize whitespace of a prompt so that indentation or blank lines do not change the cache key.
+    """
+    return " ".join(text.split())
+
+def digest_image_url(image_url):
+    """
+    Replace an image url (usually a base64 data url) by the SHA-256 digest of its content.
+
+    Parameters:
+        image_url (Union[str, dict]): "data:image/jpeg;base64,..." or {"url": ..., "detail": ...}
+
+    Returns:
+        str or dict: digest of the url, other keys of a dict are kept.
+    """
+    if isinstance(image_url, dict):
+        return {**image_url, "url": digest_image_url(image_url.get("url", ""))}
+    # Only the payload matters, not the data url prefix
+    payload = image_url.split("base64,", 1)[-1]
+    return "sha256:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def normalize_message_content(content):
+    if isinstance(content, str):
+        return normalize_prompt(content)
+    normalized_content = []
+    for item in content:
+        if item.get("type") == "text":
+            normalized_content.append({"type": "text", "text": normalize_prompt(item["text"])})
+        elif item.get("type") == "image_url":
+            normalized_content.append({"type": "image_url", "image_url": digest_image_url(item["image_url"])})
+        else:
+            normalized_content.append(item)
+    return normalized_content
+
+def completion_cache_key(model, messages, **parameters):
+    """
+    This function gives the key of a completion in the cache.
+
+    Parameters:
+        model (str): name of the model.
+        messages (list): messages sent to the model, images may be included as base64 data urls.
+        parameters: other request parameters which change the response (e.g. max_tokens).
+
+    Returns:
+        str: SHA-256 of the model, normalized prompts, image digests and parameters.
+    """
+    key = {"model": model,
+           "messages": [{"role": message["role"], "content": normalize_message_content(message["content"])}
+                        for message in messages],
+           "parameters": parameters}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+def connect_completion_cache():
+    directory = os.path.dirname(completion_cache_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(completion_cache_path, timeout=10)
+    connection.execute("""CREATE TABLE IF NOT EXISTS completions (
+                              key TEXT PRIMARY KEY,
+                              model TEXT,
+                              response TEXT,
+                              size INTEGER,
+                              created_at REAL,
+                              last_access REAL)""")
+    connection.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+    return connection
+
+def get_cached_completion(key):
+    """
+    This function gives a cached completion.
+
+    Parameters:
+        key (str): key given by completion_cache_key.
+
+    Returns:
+        str: the cached response, None if it is not cached, expired or the cache is disabled.
+    """
+    if not completion_cache_enabled:
+        return None
+    try:
+        connection = connect_completion_cache()
+        try:
+            with connection:
+                row = connection.execute("SELECT response, created_at FROM completions WHERE key = ?",
+                                         (key,)).fetchone()
+                if row is None:
+                    count_cache_event("misses")
+                    return None
+                response, created_at = row
+                now = time.time()
+                if now - created_at > completion_cache_ttl_seconds:
+                    connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                    count_cache_event("expired")
+                    count_cache_event("misses")
+                    return None
+                connection.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+                count_cache_event("hits")
+                return response
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        # The cache must never break a generation
+        print(f"Completion cache read failed: {e}")
+        count_cache_event("errors")
+        return None
+
+def set_cached_completion(key, model, response):
+    """
+    This function stores a completion and removes the least recently used completions
+    when the cache is bigger than completion_cache_max_bytes.
+
+    Parameters:
+        key (str): key given by completion_cache_key.
+        model (str): name of the model.
+        response (str): the response to store.
+    """
+    if not completion_cache_enabled:
+        return
+    try:
+        connection = connect_completion_cache()
+        try:
+            with connection:
+                now = time.time()
+                connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)",
+                                   (key, model, response, len(response.encode("utf-8")), now, now))
+                count_cache_event("writes")
+                connection.execute("DELETE FROM completions WHERE created_at < ?",
+                                   (now - completion_cache_ttl_seconds,))
+                total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+                if total_size > completion_cache_max_bytes:
+                    for old_key, size in connection.execute(
+                            "SELECT key, size FROM completions ORDER BY last_access").fetchall():
+                        if total_size <= completion_cache_max_bytes:
+                            break
+                        connection.execute("DELETE FROM completions WHERE key = ?", (old_key,))
+                        total_size -= size
+                        count_cache_event("evictions")
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f"Completion cache write failed: {e}")
+        count_cache_event("errors")
+
+def completion_cache_stats():
+    """
+    Returns:
+        dict: counters of this process with the number of entries and bytes stored in the cache.
+    """
+    with _cache_counters_lock:
+        stats = dict(cache_counters)
+    stats["entries"] = stats["bytes"] = 0
+    if completion_cache_enabled:
+        try:
+            connection = connect_completion_cache()
+            try:
+                stats["entries"], stats["bytes"] = connection.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            pass
+    return stats
@@ -1,20 +1,240 @@
 # Import modules
 from docx import Document
+import copy
+import hashlib
+import io
 import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai_functions import chat_completion
+from token_functions import completion_budget, estimate_prompt_tokens, count_text_tokens, model_profile
+from json_functions import validate_lesson_body
+from tracing_functions import trace_stage, submit_in_context, log_warning
+import template_renderer_functions
+from template_renderer_functions import compile_template, render_document_xml, iter_docx_bytes, \
+    cell_text_xml, lesson_body_xml, paragraphs_xml
+from docx_writer_functions import table_cell_grid, set_cell_text, append_key_value, append_list_of_dicts, \
+    append_lesson_body, append_paragraphs
 
-# Length of document_templates & document_templates_names_for_saving should be same
+# Length of document_templates_paths & document_templates_names_for_saving should be same
 
 # File names for saving respective template
 document_templates_names_for_saving = ["lesson_plan", 
                                        "assessment", 
                                        "answers"]
 
+# Paths of the templates of all documents, next to this module so they are found from any working directory
+templates_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_templates")
+document_templates_paths = [os.path.join(templates_directory, "LESSON_PLAN_TEMPLATE.docx"), 
+                            os.path.join(templates_directory, "ASSESSMENT_TEMPLATE.docx"), 
+                            os.path.join(templates_directory, "MARKING_GUIDE_TEMPLATE.docx")]
+
+# Parsed templates, shared by every request of the process.
+# {absolute path: {"mtime": ..., "bytes": ..., "document": Document}}
+_template_cache = {}
+_template_cache_lock = threading.Lock()
+
+def get_template_entry(template_path):
+    """
+    This function loads a template once and keeps its bytes and parsed document in memory.
+    The template is loaded again when the modification time of the file changes.
+
+    Parameters:
+        template_path (str): path of the template file.
+
+    Returns:
+        dict: {"mtime": modification time, "bytes": content of the file, 
+               "sha256": hash of the content, "document": parsed Document, 
+               "pristine": parsed Document which is only used to make copies}
+              The documents are shared and must not be modified, use get_template_copy instead.
+    """
+    template_path = os.path.abspath(template_path)
+    mtime = os.stat(template_path).st_mtime_ns
+    entry = _template_cache.get(template_path)
+    if entry is not None and entry["mtime"] == mtime:
+        return entry
+
+    with _template_cache_lock:
+        # Another request may have loaded it while waiting for the lock
+        entry = _template_cache.get(template_path)
+        if entry is None or entry["mtime"] != mtime:
+            with open(template_path, "rb") as template_file:
+                template_bytes = template_file.read()
+            # python-docx caches proxies of inner elements (e.g. the body) on first access and
+            # deepcopy would copy them as detached trees, so copies are made from a document
+            # that is never read.
+            pristine = Document(io.BytesIO(template_bytes))
+            entry = {"mtime": mtime, 
+                     "bytes": template_bytes, 
+                     "sha256": hashlib.sha256(template_bytes).hexdigest(), 
+                     "document": copy.deepcopy(pristine), 
+                     "pristine": pristine}
+            _template_cache[template_path] = entry
+        return entry
+
+def get_template_copy(template_path):
+    """
+    This function gives a fresh working copy of a template which can be modified freely.
+    The XML tree of the cached template is deep copied instead of reading the file again.
+
+    Parameters:
+        template_path (str): path of the template file.
+
+    Returns:
+        Document: copy of the template.
+    """
+    return copy.deepcopy(get_template_entry(template_path)["pristine"])
+
+def load_document_template(index):
+    """
+    Load template of one document, index is the position in document_templates_paths
+    """
+    return get_template_copy(document_templates_paths[index])
+
 # Load template of all documents
 def document_templates():
-    return [Document(f"{os.path.abspath('sample_templates/LESSON_PLAN_TEMPLATE.docx')}"), 
-                      Document(f"{os.path.abspath('sample_templates/ASSESSMENT_TEMPLATE.docx')}"), 
-                      Document(f"{os.path.abspath('sample_templates/MARKING_GUIDE_TEMPLATE.docx')}")]
+    return [get_template_copy(template_path) for template_path in document_templates_paths]
+
+# =================================================
+# Index of the named sections of a template
+days_names = ["MONDAY", "TUESDAY", "WEDNESDAY", 
+              "THURSDAY", "FRIDAY", "SATURDAY", "SUNDAY"]
+
+# Label in the first cell of a row -> key of the gpt response written in that row
+day_table_row_labels = {"aims": "aims_and_objective", 
+                        "introduction": "introduction", 
+                        "lesson body": "lesson_body", 
+                        "conclusion": "conclusion"}
+
+# Label of a cell in the introduction table -> field written in the next cell
+intro_table_labels = {"teacher": "teacher_name", 
+                      "course": "course", 
+                      "unit": "unit_title", 
+                      "week": "week"}
+
+# Layout of the lesson plan template used when a label is not found
+default_template_index = {"intro_table": {"table": 0, 
+                                          "cells": {"teacher_name": (0, 1), "course": (0, 3), 
+                                                    "unit_title": (1, 1), "week": (1, 3)}}, 
+                          "terminology_table": {"table": 1, "cell": (1, 0)}, 
+                          "day_rows": {"aims_and_objective": 1, "introduction": 2, 
+                                       "lesson_body": 3, "conclusion": 4}}
+
+# {sha256 of template: index}
+_template_index_cache = {}
+
+def build_template_index(document):
+    """
+    This function walks the tables of a template once and finds the position of its named sections.
+
+    Parameters:
+        document (Document): the template.
+
+    Returns:
+        dict: {"days": {day name: {"table": table position, "rows": {response key: row position}}},
+               "intro_table": {"table": table position, "cells": {field: (row, cell)}},
+               "terminology_table": {"table": table position, "cell": (row, cell)},
+               "day_rows": row layout of the first day table}
+    """
+    index = copy.deepcopy(default_template_index)
+    index["days"] = {}
+    intro_found = terminology_found = False
+    for table_position, table in enumerate(document.tables):
+        rows = [[cell.text for cell in row.cells] for row in table.rows]
+        if not rows or not rows[0]:
+            continue
+        first_cell = rows[0][0].strip()
+
+        if first_cell.upper() in days_names:
+            day_rows = {}
+            for row_position, row in enumerate(rows[1:], start=1):
+                label = " ".join(row[0].lower().split())
+                for row_label, response_key in day_table_row_labels.items():
+                    if label.startswith(row_label) and response_key not in day_rows:
+                        day_rows[response_key] = row_position
+            day_rows = {**default_template_index["day_rows"], **day_rows}
+            # Keep the name as written in the template, the user selects from it
+            index["days"].setdefault(first_cell, {"table": table_position, "rows": day_rows})
+            if len(index["days"]) == 1:
+                index["day_rows"] = day_rows
+
+        elif not intro_found and first_cell.lower().startswith("teacher"):
+            intro_found = True
+            index["intro_table"]["table"] = table_position
+            for row_position, row in enumerate(rows):
+                for cell_position, text in enumerate(row[:-1]):
+                    label = text.strip().lower()
+                    for intro_label, field in intro_table_labels.items():
+                        if label.startswith(intro_label):
+                            index["intro_table"]["cells"][field] = (row_position, cell_position + 1)
+
+        elif not terminology_found and " ".join(first_cell.lower().split()).startswith("key concepts"):
+            terminology_found = True
+            index["terminology_table"] = {"table": table_position, "cell": (1, 0)}
+    return index
+
+def get_template_index(template_path=document_templates_paths[0]):
+    """
+    This function gives the index of a template, the index is built once for each content of the template.
+
+    Parameters:
+        template_path (str, optional): path of the template file. Defaults to lesson plan template.
+
+    Returns:
+        dict: index of the template, see build_template_index.
+    """
+    entry = get_template_entry(template_path)
+    index = _template_index_cache.get(entry["sha256"])
+    if index is None:
+        index = build_template_index(entry["document"])
+        _template_index_cache[entry["sha256"]] = index
+    return index
+
+# Directory where generated documents are also written as files.
+# When it is not set documents only live in memory and go straight to the download buttons.
+output_directory = os.environ.get("LESSON_PLAN_OUTPUT_DIR")
+
+# Maximum number of lesson body completions running at the same time.
+# Keep it low enough to stay under the organisation's OpenAI rate limits.
+lesson_body_concurrency = int(os.environ.get("LESSON_BODY_CONCURRENCY", "3"))
+
+# Ask for the lesson bodies of several days in one request instead of one request per day.
+# It sends the instructions once, but the lesson bodies are only requested when all days are received.
+lesson_body_batching = os.environ.get("LESSON_BODY_BATCHING", "0") != "0"
+# Model of chat_completion, a batch which would not fit in its limits (see token_functions.model_profile)
+# is split and a day which does not fit with others is requested on its own
+text_model = "gpt-4-turbo-preview"
+# Tokens expected for the lesson body of one day
+lesson_body_tokens = int(os.environ.get("LESSON_BODY_TOKENS", "800"))
+
+class GenerationContext:
+    """
+    Everything one generation works on: its own copy of the lesson plan template, the tables of the
+    selected days and the documents made. Each request (e.g. each press of the Process button) uses its
+    own context, so generations running at the same time in one process only share the read-only
+    template caches.
+
+    Attributes:
+        generation_id (str): unique id of the generation.
+        output_dir (str): directory where the documents are also written, None to keep them in memory.
+                          When only output_directory is configured, each generation writes to its own
+                          <output_directory>/<generation_id> so that file names do not collide.
+        lesson_plan_template (Document): working copy of the lesson plan template, see update_intro_table.
+        table_id_for_lesson_plan (list): tables of the selected days in lesson_plan_template.
+        documents (dict): {name of document: bytes of the .docx file or Error_error}
+        lesson_plans (list): gpt response of each day written in the lesson plan.
+        lesson_bodies (list): expanded lesson body (dict) or Error_error of each day. With lesson_plans they are
+                              the results of the generation, the documents can be made again from them.
+    """
+    def __init__(self, output_dir=None):
+        self.generation_id = uuid.uuid4().hex
+        self.output_dir = output_dir or (os.path.join(output_directory, self.generation_id) if output_directory else None)
+        self.lesson_plan_template = None
+        self.table_id_for_lesson_plan = []
+        self.documents = {}
+        self.lesson_plans = []
+        self.lesson_bodies = []
 
 def get_all_data_from_file(file_name):
     """
@@ -40,20 +260,17 @@ def get_table_id_of_days(lesson_plan_days, doc_template):
 
     Parameters:
         lesson_plan_days (list): A list of days that are present in the lesson plan template.
-        doc_template (Document): A document template that contains the lesson plan.
+        doc_template (Document): A copy of the lesson plan template.
 
     Returns:
         list: A list of table objects that contain the days in the lesson plan.
         Error_error:  If there is an error while finding the table objects.
     """
     try:
-        list_of_days_table_id = []
-        for lesson_plan_day in lesson_plan_days:
-            for i in range(0, len(doc_template.tables)):
-                if  doc_template.tables[i].rows[0].cells[0].text == lesson_plan_day:
-                    list_of_days_table_id.append(doc_template.tables[i])
-                    break
-        return list_of_days_table_id
+        days_index = get_template_index()["days"]
+        tables = doc_template.tables
+        return [tables[days_index[lesson_plan_day]["table"]] 
+                for lesson_plan_day in lesson_plan_days if lesson_plan_day in days_index]
     except Exception as e:
         return f"Error_{e}"
 
@@ -66,16 +283,8 @@ def get_table_id_from_template_contain_days():
         Error_error -  if there is any problem to get table id from template contain days
     """
     try:
-        days_names = ["MONDAY", "TUESDAY", "WEDNESDAY", 
-                      "THURSDAY", "FRIDAY", "SATURDAY", "SUNDAY"]
-        document_templates_local = document_templates()
-        tables_id_of_tables_contain_days_name = []
-        for i in range(0, len(document_templates_local[0].tables)):
-            for day in days_names:
-                if  str.lower(document_templates_local[0].tables[i].rows[0].cells[0].text) == str.lower(day):
-                    tables_id_of_tables_contain_days_name.append(document_templates_local[0].tables[i])
-                    break
-        return tables_id_of_tables_contain_days_name
+        tables = load_document_template(0).tables
+        return [tables[day["table"]] for day in get_template_index()["days"].values()]
     except Exception as e:
         return f"Error_{e}"
 
@@ -88,22 +297,20 @@ def get_available_days_name():
         Error_error -  if there is any problem to get names of days from template
     """
     try:
-        days_available_in_template = []
-        for table_id in get_table_id_from_template_contain_days():
-            days_available_in_template.append(table_id.rows[0].cells[0].text)
-        return days_available_in_template
+        return list(get_template_index()["days"])
     except Exception as e:
         return f"Error_{e}"
 
-def update_intro_table(teacher_name, course, unit_title, week):
+def update_intro_table(teacher_name, course, unit_title, week, context=None):
     """
     This function will update template of first table which is introduction table
     
     Parameters (required):
         - teacher_name, course, unit and title, week
+        - context (GenerationContext, optional): the working copy of the lesson plan is kept in it
     
     Returns:
-        True - if table updated successfully
+        True, the working copy of the lesson plan template - if table updated successfully
         Error_error -  if table is not updated for any reason
     """
     try:
@@ -115,48 +322,54 @@ def update_intro_table(teacher_name, course, unit_title, week):
         #     intro_table.rows[1].cells[1].text = unit_title
         #     intro_table.rows[1].cells[3].text = week
         #     save_document(template, document_templates_names_for_saving[index_num])
-        global document_templates_global
-        document_templates_global = document_templates()
-
-        intro_table = document_templates_global[0].tables[0]
-        intro_table.rows[0].cells[1].text = teacher_name
-        intro_table.rows[0].cells[3].text = course
-        intro_table.rows[1].cells[1].text = unit_title
-        intro_table.rows[1].cells[3].text = week
-        save_document(document_templates_global[0], document_templates_names_for_saving[0])
-        return True, document_templates_global[0]
+        context = context if context is not None else GenerationContext()
+        context.lesson_plan_template = load_document_template(0)
+
+        intro_table_index = get_template_index()["intro_table"]
+        intro_table_cell = table_cell_grid(context.lesson_plan_template.tables[intro_table_index["table"]])
+        values = {"teacher_name": teacher_name, "course": course, "unit_title": unit_title, "week": week}
+        for field, (row_position, cell_position) in intro_table_index["cells"].items():
+            set_cell_text(intro_table_cell(row_position, cell_position), values[field])
+        return True, context.lesson_plan_template
     except Exception as e:
         return f"Error_{e}"
 
 # =================================================
 # Function to add key as bold and value as normal
+# The XML is written directly, see docx_writer_functions
 def add_key_value(key, value, table_id):
-    p = table_id.add_paragraph()
-    p.add_run(key).bold = True
-    p.add_run(": " + value)
+    append_key_value(table_id._tc, key, value)
 
 # Function to handle list of dictionaries
 def handle_list_of_dicts(key, value, table_id):
-    index = 1
-    add_key_value(key, "", table_id)
-    for item in value:
-        for inner_key, inner_value in item.items():
-            p = table_id.add_paragraph()
-            p.add_run(f"Stage {index} - {inner_key}").bold = True
-            p.add_run(": " + inner_value)
-            index += 1
+    append_list_of_dicts(table_id._tc, key, value)
 
-def adjust_lesson_body(table_id, lesson_body, time_duration_mints, activity):
-    prompt = f"""
-    Your task is to generate a lesson plan with activity of provided content, delimited by triple 
-    backticks.
-    Exclude 26% of time. Remaining time should be divided into stages.
+# Instructions for the stages of a lesson body, sent once per request
+lesson_body_instructions = """Exclude 26% of time. Remaining time should be divided into stages.
     On each stage we divide the time accodingly so we can show the time to be spent on each stage.
     If the time is 90 or more, let us make it around 6 or more stages but not more than 8.\
     If the time is around 60 make it around 5 stages, \
     If the time is 40 we make it 3-4 stages and if the time is below 40 we keep then at 3.
     Given activity should connect to the lesson plan and you should create the materials needed and the activity should embedded in the lesson plan.
-    Be carefull with number of stages, time specified on each stage and connection of activity with lesson plan.
+    Be carefull with number of stages, time specified on each stage and connection of activity with lesson plan."""
+
+def generate_lesson_body(lesson_body, time_duration_mints, activity, use_cache=True):
+    """
+    Ask ChatGPT to expand the lesson body of a single day into stages.
+
+    Parameters:
+        lesson_body (str): lesson body of the day given by the image prompt.
+        time_duration_mints (str): duration of the lecture in minutes.
+        activity (str): activity given by the user for that day.
+        use_cache (bool, optional): False to ask again instead of the cached lesson body, see chat_completion.
+
+    Returns:
+        dict: the expanded lesson body (Lesson_Title, Duration, Focus, Materials, Activity, Lesson_Stages).
+    """
+    prompt = f"""
+    Your task is to generate a lesson plan with activity of provided content, delimited by triple 
+    backticks.
+    {lesson_body_instructions}
     
     Do not include any explanations, only provide RFC8259 compliant JSON response following this format without deviation.
     {{"Lesson_Title": "title of lesson",
@@ -169,50 +382,262 @@ def adjust_lesson_body(table_id, lesson_body, time_duration_mints, activity):
     content: ```{lesson_body}```
     """
 
-    lesson_body = chat_completion(prompt)
+    return validate_lesson_body(chat_completion(prompt, use_cache=use_cache, expected_tokens=lesson_body_tokens, 
+                                                purpose="lesson_body"))
 
-    for key, value in lesson_body.items():
-        if isinstance(value, list):  # If value is a list of dictionaries
-            handle_list_of_dicts(key, value, table_id)
-        else:
-            add_key_value(key, value, table_id)
+def generate_lesson_bodies_in_one_request(days):
+    """
+    Ask ChatGPT to expand the lesson bodies of several days with one request.
+
+    Parameters:
+        days (list): (lesson_body, time_duration_mints, activity) of each day.
+
+    Returns:
+        list: the expanded lesson body (dict) of each day in the given order, 
+              Error_error for a day which is missing or not valid in the response.
+    """
+    keys = [f"day_{day_number}" for day_number in range(1, len(days) + 1)]
+    # The budget is at most the maximum of the model, see token_functions.completion_budget
+    gpt_response = chat_completion(lesson_bodies_prompt(days), expected_tokens=lesson_body_tokens * len(days), 
+                                   purpose="lesson_body")
+    lesson_bodies = []
+    for key in keys:
+        try:
+            lesson_bodies.append(validate_lesson_body(gpt_response.get(key)))
+        except ValueError as e:
+            lesson_bodies.append(f"Error_{key}: {e}")
+    return lesson_bodies
+
+def lesson_body_day_content(day_number, day):
+    """
+    Line of one day in the prompt of lesson_bodies_prompt, day is (lesson_body, time_duration_mints, activity).
+    """
+    lesson_body, time_duration_mints, activity = day
+    return f"""    day_{day_number}: duration {time_duration_mints} minutes, activity "{activity}", content: ```{lesson_body}```"""
+
+def lesson_bodies_prompt(days):
+    """
+    Prompt which asks for the lesson bodies of several days, see generate_lesson_bodies_in_one_request.
+    """
+    keys = [f"day_{day_number}" for day_number in range(1, len(days) + 1)]
+    contents = "\n".join(lesson_body_day_content(day_number, day) for day_number, day in enumerate(days, 1))
+    return f"""
+    Your task is to generate a lesson plan with activity for each of the {len(days)} days below, from the provided 
+    content of that day, delimited by triple backticks.
+    {lesson_body_instructions}
+    
+    Do not include any explanations, only provide RFC8259 compliant JSON response following this format without deviation.
+    It has one key for each day: {", ".join(keys)}.
+    {{"day_1": {{"Lesson_Title": "title of lesson",
+    "Duration": "duration of the day in minutes",
+    "Focus": "Describe main focus during lecture. It should be 2 to 3 lines",
+    "Materials":"should be separted and started by new line",
+    "Activity": "activity of the day",
+    "Lesson_Stages": [{{"Stage name (minutes spend on each stage)":"Stage details"}}]
+    }}}}
+{contents}
+    """
+
+def plan_lesson_body_batches(days):
+    """
+    Group days so that each group fits in one request: the lesson bodies must fit in the maximum output of
+    the text model and the whole request in its context window. The tokens are counted like the request
+    is (see token_functions) so the plan and the max_tokens of the request agree.
+
+    Parameters:
+        days (list): (lesson_body, time_duration_mints, activity) of each day.
+
+    Returns:
+        list: lists of day indexes, a list with one index is requested on its own.
+    """
+    profile = model_profile(text_model)
+    # The max_tokens of each day must fit in the response
+    _, day_max_tokens = completion_budget(lesson_body_tokens, "lesson_body", text_model)
+    days_per_request = max(1, profile["max_output_tokens"] // day_max_tokens)
+    # Prompt without the days, the response may use the maximum of the model until lesson_body is calibrated
+    instructions_tokens = estimate_prompt_tokens([{"role": "user", "content": lesson_bodies_prompt([])}], text_model)
+    response_tokens = profile["max_output_tokens"]
+    batches, batch, batch_tokens = [], [], instructions_tokens
+    for index_number, day in enumerate(days):
+        # Line of the day and its new line in the prompt
+        day_tokens = count_text_tokens(lesson_body_day_content(len(batch) + 1, day) + "\n", text_model)
+        if batch and (len(batch) == days_per_request or 
+                      batch_tokens + day_tokens + response_tokens > profile["context_window"]):
+            batches.append(batch)
+            batch, batch_tokens = [], instructions_tokens
+        batch.append(index_number)
+        batch_tokens += day_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def write_lesson_body(table_id, lesson_body):
+    """
+    Write an expanded lesson body into a table cell.
+
+    Parameters:
+        table_id (_Cell): cell of the day table which holds the lesson body.
+        lesson_body (dict): expanded lesson body returned by generate_lesson_body.
+    """
+    append_lesson_body(table_id._tc, lesson_body)
+
+def adjust_lesson_body(table_id, lesson_body, time_duration_mints, activity):
+    write_lesson_body(table_id, generate_lesson_body(lesson_body, time_duration_mints, activity))
+
+def generate_lesson_bodies(gpt_responses, list_of_activity, max_workers=None, progress_callback=None, batching=None, 
+                           lesson_bodies=None):
+    """
+    Expand the lesson body of every day concurrently.
+    gpt_responses may be a generator (e.g. a streamed response), the lesson body of a day is 
+    requested as soon as that day is received.
+    With batching, the lesson bodies are requested when all days are received, several days per
+    request (see plan_lesson_body_batches). A day missing from a batched response is requested on its own.
+
+    Parameters:
+        gpt_responses (iterable): gpt response of each day, one dictionary per day.
+        list_of_activity (list): activity of each day, in the same order as gpt_responses.
+        max_workers (int, optional): maximum number of requests in flight.
+                                     Defaults to lesson_body_concurrency.
+        progress_callback (callable, optional): called as progress_callback(index_number, status) with status
+                                                "received", "lesson_body_ready" or "lesson_body_failed".
+                                                It is always called from the calling thread.
+        batching (bool, optional): request several days at once. Defaults to lesson_body_batching.
+        lesson_bodies (list, optional): lesson bodies already generated, e.g. when the documents are made again 
+                                        from the results of a generation. A day which has one (dict) is not requested.
+
+    Returns:
+        tuple: (list of gpt response, list of lesson bodies) one entry per day in the given order. 
+               Each lesson body is the expanded lesson body (dict) or Error_error if the request of that day failed.
+    """
+    def generate(index_number, gpt_response, activity):
+        try:
+            with trace_stage("lesson_body", day=index_number + 1):
+                return generate_lesson_body(gpt_response["lesson_body"], gpt_response["Duration"], activity)
+        except Exception as e:
+            return f"Error_{e}"
+
+    def generate_batch(index_numbers):
+        if len(index_numbers) == 1:
+            return [generate(index_numbers[0], list_of_gpt_response[index_numbers[0]], list_of_activity[index_numbers[0]])]
+        try:
+            with trace_stage("lesson_body", days=len(index_numbers)):
+                lesson_bodies = generate_lesson_bodies_in_one_request(
+                    [(list_of_gpt_response[index_number]["lesson_body"], list_of_gpt_response[index_number]["Duration"], 
+                      list_of_activity[index_number]) for index_number in index_numbers])
+        except Exception as e:
+            lesson_bodies = [f"Error_{e}"] * len(index_numbers)
+        # Days which are not in the batched response are requested on their own
+        return [lesson_body if isinstance(lesson_body, dict) 
+                else generate(index_number, list_of_gpt_response[index_number], list_of_activity[index_number])
+                for index_number, lesson_body in zip(index_numbers, lesson_bodies)]
+
+    def report(index_number, status):
+        if progress_callback is not None:
+            progress_callback(index_number, status)
+
+    known_lesson_bodies = lesson_bodies or []
+
+    def generated(index_number):
+        return index_number < len(known_lesson_bodies) and isinstance(known_lesson_bodies[index_number], dict)
+
+    batching = lesson_body_batching if batching is None else batching
+    list_of_gpt_response = []
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers or lesson_body_concurrency)) as executor:
+        for index_number, gpt_response in enumerate(gpt_responses):
+            list_of_gpt_response.append(gpt_response)
+            report(index_number, "received")
+            if index_number < len(list_of_activity) and generated(index_number):
+                report(index_number, "lesson_body_ready")
+            elif not batching and index_number < len(list_of_activity):
+                futures[submit_in_context(executor, generate_batch, [index_number])] = [index_number]
+        if batching:
+            requested_days = [index_number for index_number in range(min(len(list_of_gpt_response), len(list_of_activity)))
+                              if not generated(index_number)]
+            days = [(list_of_gpt_response[index_number]["lesson_body"], list_of_gpt_response[index_number]["Duration"], 
+                     list_of_activity[index_number]) for index_number in requested_days]
+            for batch in plan_lesson_body_batches(days):
+                index_numbers = [requested_days[position] for position in batch]
+                futures[submit_in_context(executor, generate_batch, index_numbers)] = index_numbers
+
+        lesson_bodies = [known_lesson_bodies[index_number] if generated(index_number) else None 
+                         for index_number in range(min(len(list_of_gpt_response), len(list_of_activity)))]
+        for future in as_completed(futures):
+            for index_number, lesson_body in zip(futures[future], future.result()):
+                lesson_bodies[index_number] = lesson_body
+                report(index_number, "lesson_body_ready" if isinstance(lesson_body, dict) else "lesson_body_failed")
+    return list_of_gpt_response, lesson_bodies
 # =================================================
-def update_table_for_lesson_plan(list_of_table_id, list_of_gpt_response, list_of_activity):
+def update_table_for_lesson_plan(list_of_table_id, list_of_gpt_response, list_of_activity, max_workers=None, 
+                                 output_dir=None, progress_callback=None, context=None, lesson_bodies=None):
     """
     Update the table of lesson plan with the given list of table id and gpt response.
+    Lesson bodies of all days are generated concurrently and then written day by day.
+    If the lesson body of a day could not be generated, the lesson body given by the 
+    image prompt is written in its place so that the other days are kept.
 
     Parameters: 
         list_of_table_id (list): list of table id
-        list_of_gpt_response (list): list of gpt response
+        list_of_gpt_response (iterable): list of gpt response, may be a generator of the days of a streamed response
+        list_of_activity (list): activity of each day
+        max_workers (int, optional): maximum number of lesson body requests in flight
+        output_dir (str, optional): directory where the document is also written, see save_document
+        progress_callback (callable, optional): progress of each day, see generate_lesson_bodies
+        context (GenerationContext, optional): context given to update_intro_table. Without it the
+                                               document of the tables is used.
+        lesson_bodies (list, optional): lesson bodies already generated, see generate_lesson_bodies
     
     Returns:
-        True if document is saved successfully, else returns an error message.
+        bytes of the .docx file if document is saved successfully, else returns an error message.
     """
     try:
-        # Table of key concept and update it's value
-        terminology = ""
-        for index_number, table_id in enumerate(list_of_table_id):
-            # list_of_gpt_response is a list of dictionaries
-            # Check if index_number is within the range of list_of_gpt_response
-            if index_number < len(list_of_gpt_response) :
+        if context is not None and context.lesson_plan_template is not None:
+            lesson_plan_template = context.lesson_plan_template
+            output_dir = output_dir or context.output_dir
+        elif list_of_table_id:
+            lesson_plan_template = list_of_table_id[0].part.document
+        else:
+            raise ValueError("no day of the lesson plan template is selected")
+
+        # Only days which have a table are filled
+        list_of_gpt_response, lesson_bodies = generate_lesson_bodies(
+            list_of_gpt_response, list_of_activity[:len(list_of_table_id)], max_workers, progress_callback, 
+            lesson_bodies=lesson_bodies)
+        list_of_table_id = list_of_table_id[:len(lesson_bodies)]
+        if context is not None:
+            context.lesson_plans, context.lesson_bodies = list_of_gpt_response[:len(lesson_bodies)], lesson_bodies
+
+        with trace_stage("lesson_plan_document", days=len(list_of_table_id)):
+            template_index = get_template_index()
+            day_rows = template_index["day_rows"]
+
+            # Table of key concept and update it's value
+            terminology = ""
+            for index_number, table_id in enumerate(list_of_table_id):
+                # list_of_gpt_response is a list of dictionaries
                 terminology += list_of_gpt_response[index_number]["terminology"]+"\n"
 
-                # table_id has rows and cells structure
+                # table_id has rows and cells structure, its cells are resolved once
                 # table_id.rows[1].cells[1].text = "\n".join(["SWBAT "+line for line in list_of_gpt_response[index_number]["aims_and_objective"].split("\n")])     # Must add SWBAT in this field
-                table_id.rows[1].cells[1].text = list_of_gpt_response[index_number]["aims_and_objective"]
-                table_id.rows[2].cells[1].text = list_of_gpt_response[index_number]["introduction"]
-                # table_id.rows[3].cells[1].text = list_of_gpt_response[index_number]["lesson_body"]
-                specific_table_id = table_id.rows[3].cells[1]
-                adjust_lesson_body(specific_table_id, list_of_gpt_response[index_number]["lesson_body"], 
-                                list_of_gpt_response[index_number]["Duration"], 
-                                list_of_activity[index_number])
-                table_id.rows[4].cells[1].text = list_of_gpt_response[index_number]["conclusion"]
-
-        # Update key concept and terminology table
-        document_templates_global[0].tables[1].rows[1].cells[0].text = terminology
+                cell = table_cell_grid(table_id)
+                set_cell_text(cell(day_rows["aims_and_objective"], 1), list_of_gpt_response[index_number]["aims_and_objective"])
+                set_cell_text(cell(day_rows["introduction"], 1), list_of_gpt_response[index_number]["introduction"])
+                if isinstance(lesson_bodies[index_number], dict):
+                    append_lesson_body(cell(day_rows["lesson_body"], 1), lesson_bodies[index_number])
+                else:
+                    log_warning("lesson body not generated, the lesson plan text is used", day=index_number + 1,
+                                error=lesson_bodies[index_number])
+                    set_cell_text(cell(day_rows["lesson_body"], 1), list_of_gpt_response[index_number]["lesson_body"])
+                set_cell_text(cell(day_rows["conclusion"], 1), list_of_gpt_response[index_number]["conclusion"])
+
+            # Update key concept and terminology table
+            terminology_table = template_index["terminology_table"]
+            row_position, cell_position = terminology_table["cell"]
+            terminology_cell = table_cell_grid(lesson_plan_template.tables[terminology_table["table"]])
+            set_cell_text(terminology_cell(row_position, cell_position), terminology)
 
         # Save the document
-        return save_document(document_templates_global[0], document_templates_names_for_saving[0])
+        return save_document(lesson_plan_template, document_templates_names_for_saving[0], output_dir)
     except Exception as e:
         return f"Error_{e}"
 
@@ -227,7 +652,7 @@ def update_table_for_assessment_and_marking_guide(list_of_table_id, list_of_gpt_
         file_description (str): description of file (assessment or marking guide)
 
     Returns:
-        True if document is saved successfully, else returns an error message.
+        bytes of the .docx file if document is saved successfully, else returns an error message.
     """
     try:
         # Table of key concept and update it's value
@@ -252,7 +677,19 @@ def update_table_for_assessment_and_marking_guide(list_of_table_id, list_of_gpt_
         return f"Error_{e}"
 # =================== Not in use for now SECTION END =====================
 
-def update_assessment_and_marking_guide(document_template, list_of_gpt_response, file_description):
+def update_assessment_and_marking_guide(document_template, list_of_gpt_response, file_description, output_dir=None):
+    """
+    Add the assessment questions or their answers of all days to the document as a numbered list.
+
+    Parameters:
+        document_template (Document): copy of the assessment or marking guide template
+        list_of_gpt_response (list): list of gpt response
+        file_description (str): key of the gpt response to add (assessment or answers)
+        output_dir (str, optional): directory where the document is also written, see save_document
+
+    Returns:
+        bytes of the .docx file if document is saved successfully, else returns an error message.
+    """
     try:
         formatted_response = ""
         for dictionary in list_of_gpt_response:
@@ -262,31 +699,333 @@ def update_assessment_and_marking_guide(document_template, list_of_gpt_response,
                 formatted_response += dictionary[file_description] + "\n"
         # formatted_response = formatted_response.replace("\n", "\n\n")
         formatted_response = formatted_response.strip().split("\n")
-        for i, data in enumerate(formatted_response, start=1):
-            document_template.add_paragraph(f"{i}. {data}")
+        with trace_stage(f"{file_description}_document", lines=len(formatted_response)):
+            append_paragraphs(document_template, [f"{i}. {data}" for i, data in enumerate(formatted_response, start=1)])
 
         # Save the document
         if file_description == "assessment":
-            return save_document(document_template, document_templates_names_for_saving[1])
+            return save_document(document_template, document_templates_names_for_saving[1], output_dir)
         elif file_description == "answers":
-            return save_document(document_template, document_templates_names_for_saving[2])
+            return save_document(document_template, document_templates_names_for_saving[2], output_dir)
     except Exception as e:
         return f"Error_{e}"
 
-def save_document(template, name_of_document):
+# =================================================
+# Compiled templates: documents are rendered by splicing the written content into document.xml
+# of the template, see template_renderer_functions
+
+# Rows of a day table written for each day
+day_table_written_rows = ["aims_and_objective", "introduction", "lesson_body", "conclusion"]
+
+# {sha256 of the template: compiled template}
+_compiled_template_cache = {}
+
+def template_insertion_points(template_position):
+    """
+    Insertion points of a template, see compile_template.
+    The lesson plan has the intro cells, the rows of each day table and the terminology cell,
+    the assessment and marking guide templates have the end of their body.
+    """
+    if template_position != 0:
+        return [("body", None, None, None)]
+    index = get_template_index(document_templates_paths[0])
+    insertion_points = [(f"intro:{field}", index["intro_table"]["table"], row_position, cell_position)
+                        for field, (row_position, cell_position) in index["intro_table"]["cells"].items()]
+    for day_name, day in index["days"].items():
+        insertion_points += [(f"{day_name}:{row_name}", day["table"], day["rows"][row_name], 1) 
+                             for row_name in day_table_written_rows]
+    row_position, cell_position = index["terminology_table"]["cell"]
+    insertion_points.append(("terminology", index["terminology_table"]["table"], row_position, cell_position))
+    return insertion_points
+
+def get_compiled_template(template_position):
+    """
+    This function compiles a template once, it is compiled again when the template file changes.
+
+    Parameters:
+        template_position (int): position of the template in document_templates_paths.
+
+    Returns:
+        dict: the compiled template, see compile_template.
+    """
+    entry = get_template_entry(document_templates_paths[template_position])
+    compiled_template = _compiled_template_cache.get(entry["sha256"])
+    if compiled_template is None:
+        compiled_template = compile_template(entry["bytes"], template_insertion_points(template_position))
+        _compiled_template_cache[entry["sha256"]] = compiled_template
+    return compiled_template
+
+def save_rendered_document(document_chunks, name_of_document, output_dir=None):
+    """
+    Same as save_document for a rendered document: the parts are written to the file while they are made.
+
+    Parameters:
+        document_chunks (iterable): parts of the .docx file, see iter_docx_bytes.
+        name_of_document (str): The name of the file to save the document as.
+        output_dir (str, optional): see save_document.
+
+    Returns:
+        bytes: content of the .docx file.
+    """
+    output_dir = output_dir or output_directory
+    with trace_stage("document_serialization", document=name_of_document, compiled=True) as span:
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            chunks = []
+            with open(os.path.join(output_dir, f"{name_of_document}.docx"), "wb") as document_file:
+                for chunk in document_chunks:
+                    document_file.write(chunk)
+                    chunks.append(chunk)
+        else:
+            chunks = list(document_chunks)
+        document_bytes = b"".join(chunks)
+        span["payload_bytes"] = len(document_bytes)
+    return document_bytes
+
+def render_lesson_plan(intro_values, lesson_plan_days, list_of_gpt_response, lesson_bodies, output_dir=None):
+    """
+    Render the lesson plan with the compiled template, the content is the same as update_intro_table and 
+    update_table_for_lesson_plan write.
+
+    Parameters:
+        intro_values (dict): {"teacher_name", "course", "unit_title", "week"}
+        lesson_plan_days (list): selected days, in the order of list_of_gpt_response.
+        list_of_gpt_response (list): gpt response of each day.
+        lesson_bodies (list): expanded lesson body (dict) or Error_error of each day.
+        output_dir (str, optional): see save_document.
+
+    Returns:
+        bytes: content of the .docx file.
+    """
+    compiled_template = get_compiled_template(0)
+    days_index = get_template_index()["days"]
+    with trace_stage("lesson_plan_document", days=len(lesson_bodies), compiled=True):
+        fragments = {f"intro:{field}": cell_text_xml(value) for field, value in intro_values.items()}
+        appended = []
+        terminology = ""
+        days = [day_name for day_name in lesson_plan_days if day_name in days_index][:len(lesson_bodies)]
+        for index_number, day_name in enumerate(days):
+            gpt_response = list_of_gpt_response[index_number]
+            terminology += gpt_response["terminology"]+"\n"
+            for row_name in ["aims_and_objective", "introduction", "conclusion"]:
+                fragments[f"{day_name}:{row_name}"] = cell_text_xml(gpt_response[row_name])
+            if isinstance(lesson_bodies[index_number], dict):
+                # Written after the content of the template cell
+                fragments[f"{day_name}:lesson_body"] = lesson_body_xml(lesson_bodies[index_number])
+                appended.append(f"{day_name}:lesson_body")
+            else:
+                log_warning("lesson body not generated, the lesson plan text is used", day=index_number + 1,
+                            error=lesson_bodies[index_number])
+                fragments[f"{day_name}:lesson_body"] = cell_text_xml(gpt_response["lesson_body"])
+        fragments["terminology"] = cell_text_xml(terminology)
+        document_xml = render_document_xml(compiled_template, fragments, appended)
+    return save_rendered_document(iter_docx_bytes(compiled_template, document_xml), 
+                                  document_templates_names_for_saving[0], output_dir)
+
+def create_lesson_plan(teacher_name, course, unit_title, week, lesson_plan_days, list_of_gpt_response, list_of_activity, 
+                       max_workers=None, output_dir=None, progress_callback=None, context=None, lesson_bodies=None):
+    """
+    Create the lesson plan document: the intro table, the table of each day with its generated lesson body 
+    and the terminology table. The compiled template is used unless COMPILED_TEMPLATES=0 or it can not be 
+    compiled, then the document is made with python-docx (update_intro_table and update_table_for_lesson_plan).
+
+    Parameters:
+        teacher_name, course, unit_title, week (str): values of the intro table.
+        lesson_plan_days (list): selected days, in the order of list_of_gpt_response.
+        list_of_gpt_response (iterable): gpt response of each day, may be a generator of a streamed response.
+        list_of_activity (list): activity of each day.
+        max_workers, output_dir, progress_callback (optional): see update_table_for_lesson_plan.
+        context (GenerationContext, optional): context of the generation, the document is added to its documents
+                                               and the results of the days to its lesson_plans and lesson_bodies.
+        lesson_bodies (list, optional): lesson bodies already generated, see generate_lesson_bodies.
+
+    Returns:
+        bytes of the .docx file if the document is created successfully, else returns an error message.
+    """
+    context = context if context is not None else GenerationContext(output_dir)
+    context.documents[document_templates_names_for_saving[0]] = lesson_plan = _create_lesson_plan(
+        teacher_name, course, unit_title, week, lesson_plan_days, list_of_gpt_response, list_of_activity, 
+        max_workers, output_dir or context.output_dir, progress_callback, context, lesson_bodies)
+    return lesson_plan
+
+def _create_lesson_plan(teacher_name, course, unit_title, week, lesson_plan_days, list_of_gpt_response, list_of_activity, 
+                        max_workers, output_dir, progress_callback, context, lesson_bodies):
+    if template_renderer_functions.compiled_templates:
+        try:
+            get_compiled_template(0)
+        except Exception as e:
+            log_warning("template can not be compiled, python-docx is used", document="lesson_plan", error=e)
+        else:
+            try:
+                days = [day_name for day_name in lesson_plan_days if day_name in get_template_index()["days"]]
+                list_of_gpt_response, lesson_bodies = generate_lesson_bodies(
+                    list_of_gpt_response, list_of_activity[:len(days)], max_workers, progress_callback, 
+                    lesson_bodies=lesson_bodies)
+                context.lesson_plans, context.lesson_bodies = list_of_gpt_response[:len(lesson_bodies)], lesson_bodies
+                intro_values = {"teacher_name": teacher_name, "course": course, "unit_title": unit_title, "week": week}
+                return render_lesson_plan(intro_values, days, list_of_gpt_response, lesson_bodies, output_dir)
+            except Exception as e:
+                return f"Error_{e}"
+
+    intro_table = update_intro_table(teacher_name, course, unit_title, week, context)
+    if isinstance(intro_table, str):
+        return intro_table
+    context.table_id_for_lesson_plan = get_table_id_of_days(lesson_plan_days, context.lesson_plan_template)
+    return update_table_for_lesson_plan(context.table_id_for_lesson_plan, list_of_gpt_response, list_of_activity, 
+                                        max_workers, output_dir, progress_callback, context, lesson_bodies)
+
+def create_assessment_and_marking_guide(list_of_gpt_response, file_description, output_dir=None, context=None):
+    """
+    Create the assessment or the marking guide document, with the compiled template like create_lesson_plan.
+
+    Parameters:
+        list_of_gpt_response (list): list of gpt response
+        file_description (str): assessment or answers
+        output_dir (str, optional): see save_document
+        context (GenerationContext, optional): context of the generation, the document is added to its documents.
+
+    Returns:
+        bytes of the .docx file if document is saved successfully, else returns an error message.
+    """
+    context = context if context is not None else GenerationContext(output_dir)
+    template_position = {"assessment": 1, "answers": 2}[file_description]
+    context.documents[document_templates_names_for_saving[template_position]] = document = \
+        _create_assessment_and_marking_guide(list_of_gpt_response, file_description, output_dir or context.output_dir)
+    return document
+
+def _create_assessment_and_marking_guide(list_of_gpt_response, file_description, output_dir):
+    template_position = {"assessment": 1, "answers": 2}[file_description]
+    if template_renderer_functions.compiled_templates:
+        try:
+            compiled_template = get_compiled_template(template_position)
+        except Exception as e:
+            log_warning("template can not be compiled, python-docx is used", document=file_description, error=e)
+        else:
+            try:
+                formatted_response = "".join(dictionary[file_description] if dictionary[file_description].endswith("\n") 
+                                             else dictionary[file_description] + "\n" for dictionary in list_of_gpt_response)
+                formatted_response = formatted_response.strip().split("\n")
+                with trace_stage(f"{file_description}_document", lines=len(formatted_response), compiled=True):
+                    document_xml = render_document_xml(compiled_template, {"body": paragraphs_xml(
+                        [f"{i}. {data}" for i, data in enumerate(formatted_response, start=1)])})
+                return save_rendered_document(iter_docx_bytes(compiled_template, document_xml), 
+                                              document_templates_names_for_saving[template_position], output_dir)
+            except Exception as e:
+                return f"Error_{e}"
+    return update_assessment_and_marking_guide(load_document_template(template_position), list_of_gpt_response, 
+                                               file_description, output_dir)
+
+def create_documents(teacher_name, course, unit_title, week, lesson_plan_days, list_of_gpt_response, list_of_activity,
+                     max_workers=None, progress_callback=None, context=None, document_callback=None, lesson_bodies=None):
+    """
+    Create the lesson plan, assessment and marking guide at the same time. The assessment and the marking guide
+    only need the gpt response, they are created as soon as all days are received while the lesson bodies of
+    the lesson plan are still generated. They are not created from some of the days: if the days can not all be
+    read (e.g. the API fails or the response has no lesson plan), both are Error_error.
+
+    Parameters:
+        teacher_name, course, unit_title, week, lesson_plan_days, list_of_gpt_response, list_of_activity,
+        max_workers, progress_callback: see create_lesson_plan.
+        context (GenerationContext, optional): context of the generation.
+        document_callback (callable, optional): called with (name of document, bytes or Error_error) as soon as
+                                                each document is created, on the calling thread.
+        lesson_bodies (list, optional): lesson bodies already generated, e.g. when the documents are made again
+                                        from the results of a generation (context.lesson_plans and lesson_bodies).
+
+    Returns:
+        dict: {name of document: bytes of the .docx file or Error_error} in the order of document_templates_names_for_saving
+    """
+    context = context if context is not None else GenerationContext()
+    gpt_responses = iter(list_of_gpt_response)
+    received_days = []
+    days_read = threading.Event()
+    # Error raised while the days were read, the lesson plan gets it too
+    stream_errors = []
+
+    def receive_days():
+        # Given to the lesson plan, the days are kept for the assessment and the marking guide
+        try:
+            for day_plan in gpt_responses:
+                received_days.append(day_plan)
+                yield day_plan
+        except Exception as e:
+            stream_errors.append(e)
+            raise
+        finally:
+            days_read.set()
+
+    documents = {}
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        lesson_plan_future = submit_in_context(executor, create_lesson_plan, teacher_name, course, unit_title, week,
+                                               lesson_plan_days, receive_days(), list_of_activity, max_workers,
+                                               progress_callback=progress_callback, context=context, 
+                                               lesson_bodies=lesson_bodies)
+        # The lesson plan may stop reading the days when it fails, the other days are read here
+        lesson_plan_future.add_done_callback(lambda future: days_read.set())
+        days_read.wait()
+        try:
+            received_days.extend(gpt_responses)
+        except Exception as e:
+            stream_errors.append(e)
+        if not stream_errors and not received_days:
+            stream_errors.append(ValueError("no lesson plan was received"))
+
+        futures = {lesson_plan_future: document_templates_names_for_saving[0]}
+        for file_description, name_of_document in zip(["assessment", "answers"], document_templates_names_for_saving[1:]):
+            if stream_errors:
+                documents[name_of_document] = f"Error_{stream_errors[0]}"
+                if document_callback:
+                    document_callback(name_of_document, documents[name_of_document])
+                continue
+            futures[submit_in_context(executor, create_assessment_and_marking_guide, received_days, file_description,
+                                      context=context)] = name_of_document
+        for future in as_completed(futures):
+            try:
+                documents[futures[future]] = future.result()
+            except Exception as e:
+                documents[futures[future]] = f"Error_{e}"
+            if document_callback:
+                document_callback(futures[future], documents[futures[future]])
+    return {name_of_document: documents[name_of_document] for name_of_document in document_templates_names_for_saving}
+
+def serialize_document(template):
+    """
+    This function serializes a document into the bytes of a .docx file without touching the disk.
+
+    Parameters:
+        template (Document): The document to serialize.
+
+    Returns:
+        bytes: content of the .docx file.
+    """
+    document_bytes = io.BytesIO()
+    template.save(document_bytes)
+    return document_bytes.getvalue()
+
+def save_document(template, name_of_document, output_dir=None):
     """
-    This function will save document
+    This function will save document in memory and, if an output directory is given, 
+    write it in that directory as well
 
     Parameters:
         template (Document): The document to save.
         name_of_document (str): The name of the file to save the document as.
+        output_dir (str, optional): directory where the file is written. 
+                                    Defaults to output_directory, nothing is written when it is not set.
 
     Returns:
-        bool: True if the document was saved successfully
+        bytes: content of the .docx file if the document was saved successfully
         Error_error -  if table is not updated for any reason
     """
     try:
-        template.save(f"{name_of_document}.docx")
-        return True
+        with trace_stage("document_serialization", document=name_of_document) as span:
+            document_bytes = serialize_document(template)
+            span["payload_bytes"] = len(document_bytes)
+        output_dir = output_dir or output_directory
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(os.path.join(output_dir, f"{name_of_document}.docx"), "wb") as document_file:
+                document_file.write(document_bytes)
+        return document_bytes
     except Exception as e:
         return f"Error_{e}"
@@ -0,0 +1,133 @@
+# Import modules
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.oxml.simpletypes import ST_Merge
+
+# Writes text into the XML of a document directly. python-docx rebuilds the proxies of every
+# cell of a table on each table.rows[i].cells[j] and creates a proxy for each paragraph and run,
+# these functions resolve the cells once and only create the elements. The XML written is the
+# same as python-docx writes for cell.text, cell.add_paragraph().add_run() and document.add_paragraph().
+
+def table_cell_grid(table):
+    """
+    This function resolves the cell elements of a table once, in the same layout as python-docx:
+    a merged cell is repeated for every grid column and row it covers.
+
+    Parameters:
+        table (Table): table of a document, or its w:tbl element.
+
+    Returns:
+        function: cell(row_position, cell_position) giving the w:tc element.
+    """
+    tbl = getattr(table, "_tbl", table)
+    column_count = tbl.col_count
+    grid = []
+    for tc in tbl.iter_tcs():
+        for grid_span_position in range(tc.grid_span):
+            if tc.vMerge == ST_Merge.CONTINUE:
+                grid.append(grid[-column_count])
+            elif grid_span_position > 0:
+                grid.append(grid[-1])
+            else:
+                grid.append(tc)
+    return lambda row_position, cell_position: grid[row_position * column_count + cell_position]
+
+def append_run(paragraph_element, text, bold=False):
+    """
+    Append a run with text to a w:p element. New lines become w:br and tabs w:tab, as python-docx does.
+    """
+    run_element = OxmlElement("w:r")
+    if bold:
+        run_properties = OxmlElement("w:rPr")
+        run_properties.append(OxmlElement("w:b"))
+        run_element.append(run_properties)
+    characters = []
+
+    def flush():
+        if characters:
+            text_element = OxmlElement("w:t")
+            text_element.text = "".join(characters)
+            if len(text_element.text.strip()) < len(text_element.text):
+                text_element.set(qn("xml:space"), "preserve")
+            run_element.append(text_element)
+            characters.clear()
+
+    for character in text:
+        if character == "\t":
+            flush()
+            run_element.append(OxmlElement("w:tab"))
+        elif character in "\r\n":
+            flush()
+            run_element.append(OxmlElement("w:br"))
+        else:
+            characters.append(character)
+    flush()
+    paragraph_element.append(run_element)
+    return run_element
+
+def append_paragraph(container_element, runs=()):
+    """
+    Append a paragraph to a w:tc or w:body element (before the section properties of a body).
+
+    Parameters:
+        container_element: the w:tc or w:body element.
+        runs (iterable): (text, bold) of each run of the paragraph.
+
+    Returns:
+        the w:p element.
+    """
+    paragraph_element = OxmlElement("w:p")
+    # The section properties are always the last element of a body
+    if len(container_element) and container_element[-1].tag == qn("w:sectPr"):
+        container_element[-1].addprevious(paragraph_element)
+    else:
+        container_element.append(paragraph_element)
+    for text, bold in runs:
+        append_run(paragraph_element, text, bold)
+    return paragraph_element
+
+def set_cell_text(cell_element, text):
+    """
+    Same as cell.text = text: the content of the cell is replaced by one paragraph with one run.
+    """
+    for child in list(cell_element):
+        if child.tag != qn("w:tcPr"):
+            cell_element.remove(child)
+    paragraph_element = append_paragraph(cell_element)
+    append_run(paragraph_element, text)
+
+def append_key_value(cell_element, key, value):
+    """
+    Same as add_key_value: a paragraph with the key in bold and ": value".
+    """
+    append_paragraph(cell_element, [(key, True), (": " + value, False)])
+
+def append_list_of_dicts(cell_element, key, value):
+    """
+    Same as handle_list_of_dicts: the key, then one paragraph per stage "Stage n - name: details".
+    """
+    append_key_value(cell_element, key, "")
+    index = 1
+    for item in value:
+        for inner_key, inner_value in item.items():
+            append_paragraph(cell_element, [(f"Stage {index} - {inner_key}", True), (": " + inner_value, False)])
+            index += 1
+
+def append_lesson_body(cell_element, lesson_body):
+    """
+    Same as write_lesson_body, on the w:tc element of the cell.
+    """
+    for key, value in lesson_body.items():
+        if isinstance(value, list):
+            append_list_of_dicts(cell_element, key, value)
+        else:
+            append_key_value(cell_element, key, value)
+
+def append_paragraphs(document, lines):
+    """
+    Same as document.add_paragraph(line) for each line, in one pass.
+    """
+    body_element = document.element.body
+    for line in lines:
+        # add_paragraph("") adds no run
+        append_paragraph(body_element, [(line, False)] if line else [])
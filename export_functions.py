@@ -0,0 +1,182 @@
+# Import modules
+import hashlib
+import os
+import pathlib
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from tracing_functions import trace_stage, submit_in_context
+
+# PDF export settings, can be changed with environment variables.
+# Documents are converted by LibreOffice, PDF_EXPORT=0 disables the export.
+pdf_export_enabled = os.environ.get("PDF_EXPORT", "1") != "0"
+libreoffice_path = os.environ.get("LIBREOFFICE_PATH") or shutil.which("soffice") or shutil.which("libreoffice")
+# Number of LibreOffice processes converting at the same time
+pdf_conversion_workers = int(os.environ.get("PDF_CONVERSION_WORKERS", 2))
+pdf_conversion_timeout_seconds = float(os.environ.get("PDF_CONVERSION_TIMEOUT_SECONDS", 120))
+# Converted documents, by SHA-256 of the .docx file. The oldest files are removed over the limit.
+pdf_cache_path = os.environ.get("PDF_CACHE_PATH", os.path.join(".cache", "pdf"))
+pdf_cache_max_files = int(os.environ.get("PDF_CACHE_MAX_FILES", 500))
+
+# Content type of each downloaded file
+mime_types = {".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+              ".pdf": "application/pdf",
+              ".zip": "application/zip"}
+# Files which are already compressed are stored as they are in the bundle
+compressed_extensions = (".docx", ".pdf", ".zip", ".png", ".jpg", ".jpeg")
+
+# LibreOffice can only run once per user profile, each worker has its own profile which is kept
+# between conversions so that it is only created on the first conversion.
+_libreoffice_profiles = queue.Queue()
+for profile_number in range(max(1, pdf_conversion_workers)):
+    _libreoffice_profiles.put(os.path.join(tempfile.gettempdir(), f"lesson_plan_libreoffice_{os.getpid()}_{profile_number}"))
+
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+def pdf_export_available():
+    """
+    Returns:
+        bool: True if the PDF export is enabled and LibreOffice is found.
+    """
+    return pdf_export_enabled and bool(libreoffice_path)
+
+def get_pdf_executor():
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ThreadPoolExecutor(max_workers=max(1, pdf_conversion_workers), thread_name_prefix="pdf_export")
+        return _pdf_executor
+
+def get_cached_pdf(digest):
+    try:
+        with open(os.path.join(pdf_cache_path, f"{digest}.pdf"), "rb") as pdf_file:
+            return pdf_file.read()
+    except OSError:
+        return None
+
+def set_cached_pdf(digest, pdf_bytes):
+    try:
+        os.makedirs(pdf_cache_path, exist_ok=True)
+        # Written to a temporary file first so that a half written file is never read
+        cache_file_path = os.path.join(pdf_cache_path, f"{digest}.pdf")
+        with open(f"{cache_file_path}.{threading.get_ident()}.tmp", "wb") as pdf_file:
+            pdf_file.write(pdf_bytes)
+        os.replace(f"{cache_file_path}.{threading.get_ident()}.tmp", cache_file_path)
+
+        cached_files = [entry for entry in os.scandir(pdf_cache_path) if entry.name.endswith(".pdf")]
+        if len(cached_files) > pdf_cache_max_files:
+            cached_files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in cached_files[:len(cached_files) - pdf_cache_max_files]:
+                os.remove(entry.path)
+    except OSError as e:
+        # The cache must never break an export
+        print(f"PDF cache write failed: {e}")
+
+def convert_to_pdf(document_bytes, name_of_document="document"):
+    """
+    This function converts a .docx file to PDF with a headless LibreOffice. The same document is
+    only converted once, the PDF is cached by the SHA-256 of the .docx file.
+
+    Parameters:
+        document_bytes (bytes): content of the .docx file.
+        name_of_document (str): name of the document, without extension.
+
+    Returns:
+        bytes: content of the PDF file if the document is converted successfully, else returns an error message.
+    """
+    try:
+        digest = hashlib.sha256(document_bytes).hexdigest()
+        with trace_stage("pdf_conversion", document=name_of_document) as span:
+            pdf_bytes = get_cached_pdf(digest)
+            span["cached"] = pdf_bytes is not None
+            if pdf_bytes is None:
+                if not pdf_export_available():
+                    raise RuntimeError("LibreOffice is not installed, set LIBREOFFICE_PATH to the soffice program")
+                profile = _libreoffice_profiles.get()
+                try:
+                    with tempfile.TemporaryDirectory() as directory:
+                        document_path = os.path.join(directory, f"{name_of_document}.docx")
+                        with open(document_path, "wb") as document_file:
+                            document_file.write(document_bytes)
+                        result = subprocess.run([libreoffice_path, f"-env:UserInstallation={pathlib.Path(profile).as_uri()}",
+                                                 "--headless", "--norestore", "--nologo", "--nodefault",
+                                                 "--convert-to", "pdf", "--outdir", directory, document_path],
+                                                capture_output=True, timeout=pdf_conversion_timeout_seconds)
+                        pdf_path = os.path.join(directory, f"{name_of_document}.pdf")
+                        if not os.path.exists(pdf_path):
+                            output = (result.stderr or result.stdout).decode("utf-8", "replace").strip()
+                            raise RuntimeError(f"LibreOffice could not convert {name_of_document} "
+                                               f"(exit code {result.returncode}): {output}")
+                        with open(pdf_path, "rb") as pdf_file:
+                            pdf_bytes = pdf_file.read()
+                finally:
+                    _libreoffice_profiles.put(profile)
+                set_cached_pdf(digest, pdf_bytes)
+            span["payload_bytes"] = len(pdf_bytes)
+        return pdf_bytes
+    except Exception as e:
+        return f"Error_{e}"
+
+def submit_pdf_conversion(document_bytes, name_of_document="document"):
+    """
+    Convert a document on the PDF export pool, see convert_to_pdf.
+
+    Returns:
+        Future: its result is the PDF file or an error message.
+    """
+    return submit_in_context(get_pdf_executor(), convert_to_pdf, document_bytes, name_of_document)
+
+class _ZipStream:
+    """
+    File object which keeps what zipfile writes until it is read with take(). It has no seek, so
+    zipfile writes the sizes after the data of each file and the archive can be sent while it is written.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def iter_zip_bundle(files, chunk_size=1024 * 1024):
+    """
+    This function writes a ZIP archive part by part.
+
+    Parameters:
+        files (iterable): (file name in the archive, bytes) of each file.
+        chunk_size (int): bytes of a file written at once.
+
+    Yields:
+        bytes: parts of the ZIP archive.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, "w") as bundle:
+        for file_name, data in files:
+            compress_type = zipfile.ZIP_STORED if file_name.lower().endswith(compressed_extensions) else zipfile.ZIP_DEFLATED
+            information = zipfile.ZipInfo(file_name, date_time=time.localtime()[:6])
+            information.compress_type = compress_type
+            information.external_attr = 0o644 << 16
+            with bundle.open(information, "w") as member:
+                for position in range(0, len(data), chunk_size):
+                    member.write(data[position:position + chunk_size])
+                    yield from stream.take()
+            yield from stream.take()
+    yield from stream.take()
@@ -1,7 +1,45 @@
 # Import modules
 import base64
-from PIL import Image
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops, ImageOps, ImageStat
 import io
+from tracing_functions import trace_stage, submit_in_context
+from token_functions import vision_max_long_side, vision_max_short_side, vision_tile_size, vision_image_tokens
+
+# A side which goes over a multiple of the tile size by less than this fraction 
+# is scaled down to save one row or column of tiles
+tile_snap_tolerance = 0.1
+# Quality of the JPEG images sent to the vision model
+jpeg_quality = 85
+# Number of images prepared at the same time, Pillow releases the GIL while decoding and resizing
+image_preparation_workers = int(os.environ.get("IMAGE_PREPARATION_WORKERS", min(8, os.cpu_count() or 1)))
+# The same page uploaded twice (e.g. sent again or saved again) is only sent once, IMAGE_DEDUPLICATION=0 disables it.
+# Pages whose dHash and pHash both differ by at most DUPLICATE_IMAGE_THRESHOLD bits of 64 are then compared pixel
+# by pixel: the hashes alone put different pages which share a layout (e.g. worksheets) as close as 0 bits.
+# A re-encoded or resized copy of a page differs by up to about 3 bits.
+image_deduplication_enabled = os.environ.get("IMAGE_DEDUPLICATION", "1") != "0"
+duplicate_image_threshold = int(os.environ.get("DUPLICATE_IMAGE_THRESHOLD", 4))
+# Pages are compared as grayscale images of this size (long side) cut in a grid of cells. A pixel differs when its
+# gray level differs by more than duplicate_pixel_level, and a page is a duplicate only when no cell has more than
+# duplicate_cell_max_changed_share of its pixels which differ. A copy of a page has no pixel which differs, one
+# digit changed on a worksheet changes about 2% of a cell. A page photographed again is not a duplicate.
+comparison_image_size = 512
+comparison_grid_size = 16
+duplicate_pixel_level = 64
+duplicate_cell_max_changed_share = float(os.environ.get("DUPLICATE_CELL_MAX_CHANGED_SHARE", 0.005))
+# Size of the grayscale images the hashes are computed from
+hash_size = 8
+phash_image_size = 32
+# Detail of the images sent to the vision model: a low detail image is seen at 512x512 for 85 tokens instead of 
+# 85 tokens and 170 for each 512x512 tile. IMAGE_DETAIL=auto chooses for each image, high or low for all images.
+image_detail = os.environ.get("IMAGE_DETAIL", "auto")
+# With auto, an image is sent in high detail when at least this share of its details is lost at 512x512 (e.g. small
+# text). It is above 0.6 for pages of text, about 0.3 for slides with large text and below 0.2 for photos.
+high_detail_min_lost_share = float(os.environ.get("HIGH_DETAIL_MIN_LOST_SHARE", 0.4))
+# The details of an image are measured against what is lost when it is seen at this size
+coarse_detail_size = 128
 
 def encode_image(image):
     """
@@ -27,9 +65,296 @@ def encode_image(image):
     base64_image = base64.b64encode(image_data).decode('utf-8')
     return base64_image
 
+def fit_image_size(image_width, image_height, max_width=768, max_height=1024):
+    """
+    This function gives the size of an image after downscaling it, keeping its aspect ratio.
+    
+    Parameters:
+        image_width, image_height (required): size of the original image.
+        max_width (optional): The maximum width of the resized image. Defaults to 768.
+        max_height (optional): The maximum height of the resized image. Defaults to 1024.
+    
+    Return:
+        (width, height): size which fits in max_width x max_height and in what the vision model keeps,
+                         images are never upscaled.
+    """
+    long_side, short_side = max(image_width, image_height), min(image_width, image_height)
+    scale = min(1.0, max_width / image_width, max_height / image_height,
+                vision_max_long_side / long_side, vision_max_short_side / short_side)
+
+    # Drop a row or column of tiles if only a few pixels go over it
+    for side in (image_width * scale, image_height * scale):
+        tiles = math.ceil(side / vision_tile_size)
+        if tiles > 1 and side <= (tiles - 1) * vision_tile_size * (1 + tile_snap_tolerance):
+            scale = min(scale, (tiles - 1) * vision_tile_size / side * scale)
+
+    return max(1, round(image_width * scale)), max(1, round(image_height * scale))
+
+def load_image(image, max_width=768, max_height=1024):
+    """
+    Decode an image at the size it will be sent with, keeping its aspect ratio.
+    JPEG images are decoded in draft mode, directly at a reduced scale, and rotated
+    according to their EXIF orientation.
+
+    Parameters:
+        image (required): file path or file-like object of the image.
+        max_width, max_height (optional): bounding box of the resized image.
+
+    Return:
+        the resized image (Image.Image).
+    """
+    pil_image = Image.open(image)
+    image_width, image_height = pil_image.size
+    # Orientations 5 to 8 are rotated by 90 degrees
+    rotated = pil_image.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+    if rotated:
+        image_width, image_height = image_height, image_width
+    target_width, target_height = fit_image_size(image_width, image_height, max_width, max_height)
+
+    if pil_image.format == "JPEG":
+        # Decode at 1/2, 1/4 or 1/8 scale as long as it stays bigger than the target
+        pil_image.draft("RGB", (target_height, target_width) if rotated else (target_width, target_height))
+    pil_image = ImageOps.exif_transpose(pil_image)
+
+    # Palette and other special modes can't be resampled, convert them first
+    if pil_image.mode not in ("RGB", "RGBA", "L", "LA"):
+        pil_image = pil_image.convert("RGBA" if "transparency" in pil_image.info or "A" in pil_image.mode 
+                                      else "RGB")
+    if pil_image.size != (target_width, target_height):
+        pil_image = pil_image.resize((target_width, target_height), Image.LANCZOS, reducing_gap=3.0)
+    return pil_image
+
+def flatten_image(pil_image):
+    """
+    Convert an image to RGB, transparent parts become white instead of black.
+    """
+    if pil_image.mode in ("RGBA", "LA"):
+        background = Image.new("RGB", pil_image.size, (255, 255, 255))
+        background.paste(pil_image, mask=pil_image.getchannel("A"))
+        return background
+    if pil_image.mode != "RGB":
+        return pil_image.convert("RGB")
+    return pil_image
+
+def encode_jpeg(pil_image):
+    image_bytes = io.BytesIO()
+    pil_image.save(image_bytes, format="JPEG", quality=jpeg_quality)
+    return base64.b64encode(image_bytes.getvalue()).decode('utf-8')
+
+def prepare_image(image, max_width=768, max_height=1024):
+    """
+    Prepare an uploaded image for the vision model in one pass: decode at reduced scale, 
+    resize keeping the aspect ratio, convert to RGB and encode as base64 JPEG.
+
+    Parameters:
+        image (required): file path or file-like object of the image.
+        max_width, max_height (optional): bounding box of the resized image.
+
+    Return:
+        str: the base64 encoded JPEG image.
+    """
+    return encode_jpeg(flatten_image(load_image(image, max_width, max_height)))
+
+def lost_detail(grayscale_image, side):
+    """
+    Mean difference of the pixels of a grayscale image with the same image seen at side x side pixels at most.
+    """
+    width, height = grayscale_image.size
+    scale = min(1.0, side / max(width, height))
+    blurred_image = grayscale_image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    return ImageStat.Stat(ImageChops.difference(grayscale_image, blurred_image.resize((width, height), Image.BILINEAR))).mean[0]
+
+def choose_image_detail(pil_image, detail=None):
+    """
+    This function chooses the detail an image is sent with: low when the model would see about the same in 
+    low detail (e.g. photos, figures, slides with large text), high when small details would be lost (e.g. text).
+
+    Parameters:
+        pil_image (required): the image which is sent.
+        detail (optional): "auto", "high" or "low". Defaults to image_detail.
+
+    Return:
+        str: "low" or "high".
+    """
+    detail = detail or image_detail
+    if detail in ("low", "high"):
+        return detail
+    if max(pil_image.size) <= vision_tile_size:
+        # Seen the same in low detail
+        return "low"
+    grayscale_image = pil_image.convert("L")
+    coarse_detail = lost_detail(grayscale_image, coarse_detail_size)
+    # Almost uniform image, e.g. a blank page
+    if coarse_detail < 0.5:
+        return "low"
+    return "high" if lost_detail(grayscale_image, vision_tile_size) >= high_detail_min_lost_share * coarse_detail else "low"
+
+def grayscale_pixels(pil_image, width, height):
+    return list(pil_image.convert("L").resize((width, height), Image.LANCZOS).getdata())
+
+def difference_hash(pil_image):
+    """
+    dHash of an image: one bit per pixel of an 8x8 grayscale image, set if the pixel is brighter
+    than the pixel on its right.
+
+    Return:
+        int: the 64 bits hash.
+    """
+    pixels = grayscale_pixels(pil_image, hash_size + 1, hash_size)
+    bits = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            position = row * (hash_size + 1) + column
+            bits = bits << 1 | (pixels[position] > pixels[position + 1])
+    return bits
+
+# Rows of the DCT matrix which give the 8 lowest frequencies of 32 pixels
+_dct_rows = [[math.cos(math.pi * (2 * pixel + 1) * frequency / (2 * phash_image_size)) for pixel in range(phash_image_size)]
+             for frequency in range(hash_size)]
+
+def perceptual_hash(pil_image):
+    """
+    pHash of an image: the 8x8 lowest frequencies of the DCT of a 32x32 grayscale image, one bit per
+    frequency set if it is above the median.
+
+    Return:
+        int: the 64 bits hash.
+    """
+    pixels = grayscale_pixels(pil_image, phash_image_size, phash_image_size)
+    # DCT of the rows, then of the columns of the result
+    rows = [[sum(coefficient * pixel for coefficient, pixel in zip(dct_row, pixels[row * phash_image_size:(row + 1) * phash_image_size]))
+             for dct_row in _dct_rows] for row in range(phash_image_size)]
+    frequencies = [sum(_dct_rows[vertical][row] * rows[row][horizontal] for row in range(phash_image_size))
+                   for vertical in range(hash_size) for horizontal in range(hash_size)]
+    # The first frequency is the mean brightness, it is left out of the median
+    median = sorted(frequencies[1:])[len(frequencies) // 2 - 1]
+    bits = 0
+    for frequency in frequencies:
+        bits = bits << 1 | (frequency > median)
+    return bits
+
+def hamming_distance(first_hash, second_hash):
+    return bin(first_hash ^ second_hash).count("1")
+
+def comparison_image(pil_image):
+    """
+    Grayscale image of comparison_image_size pixels at most, which pages are compared with, see changed_share.
+    """
+    grayscale_image = pil_image.convert("L")
+    grayscale_image.thumbnail((comparison_image_size, comparison_image_size), Image.BILINEAR)
+    return grayscale_image
+
+def changed_share(first_image, second_image):
+    """
+    This function gives how much two pages differ where they differ most.
+
+    Parameters:
+        first_image, second_image (required): images given by comparison_image.
+
+    Return:
+        float: the largest share of pixels which differ by more than duplicate_pixel_level in a cell of the grid.
+    """
+    if second_image.size != first_image.size:
+        second_image = second_image.resize(first_image.size, Image.BILINEAR)
+    changed_pixels = ImageChops.difference(first_image, second_image).point(
+        lambda level: 255 if level > duplicate_pixel_level else 0)
+    width, height = changed_pixels.size
+    largest_share = 0.0
+    for row in range(comparison_grid_size):
+        for column in range(comparison_grid_size):
+            histogram = changed_pixels.crop((column * width // comparison_grid_size, row * height // comparison_grid_size,
+                                             (column + 1) * width // comparison_grid_size,
+                                             (row + 1) * height // comparison_grid_size)).histogram()
+            largest_share = max(largest_share, histogram[255] / max(1, sum(histogram)))
+    return largest_share
+
+def mark_near_duplicates(prepared_images, threshold=None, max_changed_share=None):
+    """
+    This function marks the images which are copies of an image uploaded before them: both hashes are close
+    and no part of the images differs.
+
+    Parameters:
+        prepared_images (required): images given by prepare_images, with their "hashes" and "comparison_image".
+        threshold (optional): bits by which both hashes can differ. Defaults to duplicate_image_threshold.
+        max_changed_share (optional): see changed_share. Defaults to duplicate_cell_max_changed_share.
+
+    Return:
+        list: the same images, "duplicate_of" is the name of the image which is kept or None.
+    """
+    threshold = duplicate_image_threshold if threshold is None else threshold
+    max_changed_share = duplicate_cell_max_changed_share if max_changed_share is None else max_changed_share
+    kept_images = []
+    for prepared_image in prepared_images:
+        if prepared_image.get("hashes") is None or prepared_image.get("comparison_image") is None:
+            continue
+        for kept_image in kept_images:
+            if all(hamming_distance(first_hash, second_hash) <= threshold
+                   for first_hash, second_hash in zip(prepared_image["hashes"], kept_image["hashes"])) and \
+                    changed_share(kept_image["comparison_image"], prepared_image["comparison_image"]) <= max_changed_share:
+                prepared_image["duplicate_of"] = kept_image["name"]
+                break
+        else:
+            kept_images.append(prepared_image)
+    return prepared_images
+
+def prepare_images(images, max_workers=None, max_width=768, max_height=1024, deduplicate=None, detail=None):
+    """
+    Prepare a batch of uploaded images for the vision model on a thread pool. Copies of a page
+    are marked, only the first one uploaded needs to be sent. The detail of each image is chosen.
+
+    Parameters:
+        images (required): list of file paths or file-like objects (e.g. streamlit uploaded files).
+        max_workers (optional): number of images prepared at the same time. 
+                                Defaults to image_preparation_workers.
+        max_width, max_height (optional): bounding box of the resized images.
+        deduplicate (optional): mark copies, see mark_near_duplicates. Defaults to image_deduplication_enabled.
+        detail (optional): "auto", "high" or "low", see choose_image_detail. Defaults to image_detail.
+
+    Return:
+        list: one dictionary per image, in upload order
+              {"name": name of the image, "image": base64 JPEG or None, "error": None or Error_error,
+               "detail": "low" or "high", "tokens": tokens billed for the image at that detail, 
+               "hashes": (dHash, pHash) or None,
+               "duplicate_of": name of the image it is a copy of or None}
+    """
+    deduplicate = image_deduplication_enabled if deduplicate is None else deduplicate
+
+    def prepare(image):
+        name = image if isinstance(image, str) else getattr(image, "name", "image")
+        try:
+            pil_image = flatten_image(load_image(image, max_width, max_height))
+            hashes = (difference_hash(pil_image), perceptual_hash(pil_image)) if deduplicate else None
+            chosen_detail = choose_image_detail(pil_image, detail)
+            return {"name": name, "image": encode_jpeg(pil_image), "error": None, "detail": chosen_detail,
+                    "tokens": vision_image_tokens(*pil_image.size, chosen_detail), "hashes": hashes, "duplicate_of": None,
+                    "comparison_image": comparison_image(pil_image) if deduplicate else None}
+        except Exception as e:
+            return {"name": name, "image": None, "error": f"Error_{e}", "detail": None, "tokens": 0, 
+                    "hashes": None, "duplicate_of": None}
+
+    if not images:
+        return []
+    with trace_stage("image_preparation", images=len(images)) as span:
+        with ThreadPoolExecutor(max_workers=max(1, min(len(images), max_workers or image_preparation_workers))) as executor:
+            # Results are read in upload order
+            futures = [submit_in_context(executor, prepare, image) for image in images]
+            prepared_images = [future.result() for future in futures]
+        mark_near_duplicates(prepared_images)
+        # Only needed to mark the duplicates
+        for prepared_image in prepared_images:
+            prepared_image.pop("comparison_image", None)
+        duplicates = [prepared_image for prepared_image in prepared_images if prepared_image["duplicate_of"]]
+        span["payload_bytes"] = sum(len(prepared_image["image"] or "") for prepared_image in prepared_images 
+                                    if not prepared_image["duplicate_of"])
+        span["errors"] = sum(prepared_image["error"] is not None for prepared_image in prepared_images)
+        span["duplicates"] = len(duplicates)
+        span["tokens_saved"] = sum(prepared_image["tokens"] for prepared_image in duplicates)
+        span["low_detail_images"] = sum(prepared_image["detail"] == "low" for prepared_image in prepared_images)
+        return prepared_images
+
 def resize_image(image, max_width=768, max_height=1024):
     """ 
-    This function get image and resize it to 768x1024(default)
+    This function get image and resize it to fit in 768x1024(default), keeping its aspect ratio
     
     Parameters:
         image (required): The image to be resized. Can be a file path or a PIL Image object.
@@ -41,18 +366,13 @@ def resize_image(image, max_width=768, max_height=1024):
         Error_error -  if there is any problem in resizing
     """
     try:
-        pil_image = Image.open(image)
-        # Get size of orignal image
-        image_width, image_height = pil_image.size
-        
-        # Check and limit size of image
-        if image_width > max_width:
-            image_width = max_width
-        if image_height > max_height:
-            image_height = max_height
-
-        pil_image_resized = pil_image.resize((image_width, image_height))
-        print(pil_image_resized.size)
+        with trace_stage("resize_image") as span:
+            if isinstance(image, Image.Image):
+                pil_image_resized = image.copy()
+                pil_image_resized.thumbnail(fit_image_size(*image.size, max_width, max_height), Image.LANCZOS)
+            else:
+                pil_image_resized = load_image(image, max_width, max_height)
+            span["size"] = pil_image_resized.size
         return pil_image_resized
     except Exception as e:
-        return f"Error_{e}"
\ No newline at end of file
+        return f"Error_{e}"
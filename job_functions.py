@@ -0,0 +1,229 @@
+# Import modules
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Generation job settings, can be changed with environment variables
+job_queue_path = os.environ.get("GENERATION_JOBS_PATH", os.path.join(".cache", "jobs.sqlite3"))
+# Number of generations running at the same time in this process, the others wait in the queue
+job_workers = int(os.environ.get("GENERATION_JOB_WORKERS", 4))
+# Finished jobs and their documents are kept this long (default 1 day)
+job_ttl_seconds = float(os.environ.get("GENERATION_JOB_TTL_SECONDS", 24 * 60 * 60))
+
+# Jobs run on threads of this process, so they continue when the page which submitted them is rerun or closed
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def get_job_executor():
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=max(1, job_workers), thread_name_prefix="generation_job")
+        return _job_executor
+
+def connect_job_queue():
+    directory = os.path.dirname(job_queue_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(job_queue_path, timeout=10)
+    connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                              id TEXT PRIMARY KEY,
+                              name TEXT,
+                              status TEXT,
+                              progress TEXT,
+                              error TEXT,
+                              process_id INTEGER,
+                              created_at REAL,
+                              updated_at REAL,
+                              expires_at REAL)""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS job_artifacts (
+                              job_id TEXT,
+                              position INTEGER,
+                              name TEXT,
+                              data BLOB,
+                              PRIMARY KEY (job_id, name))""")
+    return connection
+
+def process_is_alive(process_id):
+    try:
+        os.kill(process_id, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+class JobProgress:
+    """
+    Given to the function of a job to report its progress and store its documents.
+
+    The progress is a dictionary saved as JSON with the job:
+        {"stages": {stage: "running", "done" or "failed"}, "days": {day: message}, "warnings": [...], ...}
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.progress = {"stages": {}, "days": {}, "warnings": []}
+        self.lock = threading.Lock()
+
+    def save(self):
+        with self.lock:
+            progress = json.dumps(self.progress)
+        connection = connect_job_queue()
+        try:
+            with connection:
+                connection.execute("UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                                   (progress, time.time(), self.job_id))
+        finally:
+            connection.close()
+
+    def update(self, **values):
+        """
+        Set values of the progress, e.g. update(timing=...).
+        """
+        with self.lock:
+            self.progress.update(values)
+        self.save()
+
+    def stage(self, stage, status="running"):
+        with self.lock:
+            self.progress["stages"][stage] = status
+        self.save()
+
+    def day(self, day, message):
+        with self.lock:
+            self.progress["days"][day] = message
+        self.save()
+
+    def warn(self, message):
+        with self.lock:
+            self.progress["warnings"].append(message)
+        self.save()
+
+    def add_artifact(self, name, data):
+        """
+        Store a document of the job, e.g. add_artifact("lesson_plan", bytes of the .docx file).
+        """
+        connection = connect_job_queue()
+        try:
+            with connection:
+                position = connection.execute("SELECT COUNT(*) FROM job_artifacts WHERE job_id = ?",
+                                              (self.job_id,)).fetchone()[0]
+                connection.execute("INSERT OR REPLACE INTO job_artifacts VALUES (?, ?, ?, ?)",
+                                   (self.job_id, position, name, sqlite3.Binary(data)))
+        finally:
+            connection.close()
+
+def set_job_status(job_id, status, error=None):
+    now = time.time()
+    # Finished jobs expire job_ttl_seconds after they end
+    expires_at = now + job_ttl_seconds if status in ("done", "failed") else None
+    connection = connect_job_queue()
+    try:
+        with connection:
+            connection.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ?, expires_at = ? WHERE id = ?",
+                               (status, error, now, expires_at, job_id))
+    finally:
+        connection.close()
+
+def run_job(job_id, function, arguments):
+    progress = JobProgress(job_id)
+    set_job_status(job_id, "running")
+    try:
+        function(progress, *arguments)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        set_job_status(job_id, "failed", f"Error_{e}")
+        return
+    set_job_status(job_id, "done")
+
+def submit_job(name, function, *arguments):
+    """
+    This function queues a generation, it runs on a thread of this process.
+
+    Parameters:
+        name (str): name of the job, e.g. generate_documents.
+        function (function): called with a JobProgress and the arguments. The job fails if it raises.
+        arguments: arguments of the function, they must not depend on the page (e.g. bytes of the
+                   uploaded files instead of the uploaded files).
+
+    Returns:
+        str: the id of the job, see get_job.
+    """
+    expire_jobs()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    connection = connect_job_queue()
+    try:
+        with connection:
+            connection.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (job_id, name, "queued", json.dumps({"stages": {}, "days": {}, "warnings": []}),
+                                None, os.getpid(), now, now, None))
+    finally:
+        connection.close()
+    get_job_executor().submit(run_job, job_id, function, arguments)
+    return job_id
+
+def get_job(job_id):
+    """
+    This function gives the status of a job: queued, running, done or failed.
+
+    Parameters:
+        job_id (str): id given by submit_job.
+
+    Returns:
+        dict: {"id", "name", "status", "progress", "error", "created_at", "updated_at", "expires_at"}
+              None if the job does not exist or is expired.
+    """
+    connection = connect_job_queue()
+    try:
+        row = connection.execute("""SELECT id, name, status, progress, error, process_id, created_at, updated_at, expires_at
+                                    FROM jobs WHERE id = ?""", (job_id,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    job = dict(zip(["id", "name", "status", "progress", "error", "process_id", "created_at", "updated_at", "expires_at"], row))
+    process_id = job.pop("process_id")
+    if job["expires_at"] is not None and job["expires_at"] < time.time():
+        return None
+    if job["status"] in ("queued", "running") and not process_is_alive(process_id):
+        # The app was restarted while the job was running
+        set_job_status(job_id, "failed", "Error_the generation was interrupted, please press Process again")
+        return get_job(job_id)
+    job["progress"] = json.loads(job["progress"])
+    return job
+
+def get_job_artifacts(job_id):
+    """
+    Returns:
+        dict: {name: data} of the documents of a job, in the order they were added.
+    """
+    connection = connect_job_queue()
+    try:
+        rows = connection.execute("SELECT name, data FROM job_artifacts WHERE job_id = ? ORDER BY position",
+                                  (job_id,)).fetchall()
+    finally:
+        connection.close()
+    return {name: bytes(data) for name, data in rows}
+
+def expire_jobs():
+    """
+    Remove the jobs which are expired and their documents.
+    """
+    try:
+        connection = connect_job_queue()
+        try:
+            with connection:
+                now = time.time()
+                connection.execute("""DELETE FROM job_artifacts WHERE job_id IN
+                                      (SELECT id FROM jobs WHERE expires_at < ?)""", (now,))
+                connection.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f"Expired jobs could not be removed: {e}")
@@ -0,0 +1,194 @@
+# Import modules
+import json
+import re
+
+# Keys of the lesson plan of each day given by the vision model
+lesson_plan_keys = ["terminology", "aims_and_objective", "introduction", "lesson_body", "Duration",
+                    "conclusion", "assessment", "answers"]
+
+def iter_json_array_segments(chunks, include_unfinished=False):
+    """
+    This function reads a JSON array of objects while it is being received and yields
+    the text of every object as soon as it is closed, e.g. each day of the lesson plan while the
+    response of the model is streamed.
+
+    Text before the array (e.g. a ```json fence) is skipped. If the response is a single
+    object instead of an array, that object is yielded.
+
+    Parameters:
+        chunks (iterable): parts of the response text in order.
+        include_unfinished (bool): also yield an object which is not closed when the text ends
+                                   (e.g. a response cut off by max_tokens).
+
+    Yields:
+        str: text of each object of the array.
+    """
+    buffer = ""
+    position = 0
+    started = False      # inside the array (or the top level object)
+    depth = 0            # depth of brackets inside the array
+    object_start = None  # position in buffer where the current object starts
+    in_string = escaped = False
+
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buffer += chunk
+        while position < len(buffer):
+            character = buffer[position]
+            if not started:
+                if character == "[":
+                    started = True
+                elif character == "{":
+                    started = True
+                    depth = 1
+                    object_start = position
+            elif in_string:
+                if escaped:
+                    escaped = False
+                elif character == "\\":
+                    escaped = True
+                elif character == '"':
+                    in_string = False
+            elif character == '"':
+                in_string = True
+            elif character in "{[":
+                if depth == 0:
+                    object_start = position
+                depth += 1
+            elif character in "}]":
+                if depth == 0:
+                    # End of the array. The rest of the response is read, so a streamed request ends
+                    # (and its usage is recorded) instead of being left open.
+                    for _ in chunks:
+                        pass
+                    return
+                depth -= 1
+                if depth == 0 and object_start is not None:
+                    yield buffer[object_start:position + 1]
+                    # Keep only what has not been read yet
+                    buffer = buffer[position + 1:]
+                    position = -1
+                    object_start = None
+            position += 1
+    if include_unfinished and object_start is not None and buffer[object_start:].strip():
+        yield buffer[object_start:]
+
+def strip_code_fence(text):
+    """
+    Remove a markdown code fence (```json ... ```) around a response. Text inside the fence is kept as is.
+    """
+    match = re.search(r"```[a-zA-Z]*\s*\n?(.*?)(```|$)", text, re.DOTALL)
+    return match.group(1) if match else text
+
+def remove_trailing_commas(text):
+    """
+    Remove commas followed by } or ], which json.loads does not accept. Text of strings is kept.
+    """
+    characters = []
+    in_string = escaped = False
+    for position, character in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif character == "\\":
+                escaped = True
+            elif character == '"':
+                in_string = False
+        elif character == '"':
+            in_string = True
+        elif character == ",":
+            following = text[position + 1:].lstrip()
+            if following[:1] in ("}", "]"):
+                continue
+        characters.append(character)
+    return "".join(characters)
+
+def loads_tolerant(text):
+    """
+    This function loads a JSON response of the model, accepting the usual mistakes:
+    a code fence or explanations around the JSON, trailing commas and new lines inside strings.
+
+    Parameters:
+        text (str): the response.
+
+    Returns:
+        the loaded value.
+
+    Raises:
+        ValueError: (json.JSONDecodeError) if the response can not be loaded.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    cleaned = strip_code_fence(text)
+    starts = [start for start in (cleaned.find("{"), cleaned.find("[")) if start != -1]
+    if starts:
+        cleaned = cleaned[min(starts):max(cleaned.rfind("}"), cleaned.rfind("]")) + 1]
+    # strict=False allows new lines and tabs inside strings
+    return json.loads(remove_trailing_commas(cleaned), strict=False)
+
+def as_text(value):
+    """
+    Value of the response as text, lists and objects are written one item per line.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return "\n".join(as_text(item) for item in value)
+    if isinstance(value, dict):
+        return "\n".join(f"{key}: {as_text(item)}" for key, item in value.items())
+    return str(value)
+
+def validate_lesson_plan(lesson_plan):
+    """
+    This function checks the lesson plan of one day and makes all its values text.
+    Keys which differ only by case (e.g. duration) are accepted.
+
+    Parameters:
+        lesson_plan (dict): lesson plan of one day, see lesson_plan_keys.
+
+    Returns:
+        dict: the lesson plan with every key of lesson_plan_keys.
+
+    Raises:
+        ValueError: if it is not an object or keys are missing.
+    """
+    if not isinstance(lesson_plan, dict):
+        raise ValueError("the lesson plan of a day must be a JSON object")
+    keys = {str(key).lower(): key for key in lesson_plan}
+    missing_keys = [key for key in lesson_plan_keys if key.lower() not in keys]
+    if missing_keys:
+        raise ValueError(f"keys {', '.join(missing_keys)} are missing")
+    return {key: as_text(lesson_plan[keys[key.lower()]]) for key in lesson_plan_keys}
+
+def validate_lesson_body(lesson_body):
+    """
+    This function checks an expanded lesson body and makes all its values text,
+    Lesson_Stages stays a list of {stage: details}.
+
+    Parameters:
+        lesson_body (dict): Lesson_Title, Duration, Focus, Materials, Activity and Lesson_Stages.
+
+    Returns:
+        dict: the lesson body in the same order.
+
+    Raises:
+        ValueError: if it is not an object or Lesson_Stages is missing.
+    """
+    if not isinstance(lesson_body, dict):
+        raise ValueError("the lesson body must be a JSON object")
+    if "Lesson_Stages" not in lesson_body:
+        raise ValueError("Lesson_Stages is missing")
+    validated_lesson_body = {}
+    for key, value in lesson_body.items():
+        if key != "Lesson_Stages":
+            validated_lesson_body[key] = as_text(value)
+            continue
+        if isinstance(value, dict):
+            value = [{stage: details} for stage, details in value.items()]
+        elif not isinstance(value, list):
+            value = [value]
+        validated_lesson_body[key] = [{stage: as_text(details) for stage, details in item.items()}
+                                      if isinstance(item, dict) else {"Stage": as_text(item)} for item in value]
+    return validated_lesson_body
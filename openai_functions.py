@@ -1,52 +1,665 @@
 # Import modules
-import streamlit as st
-from openai import OpenAI
-from image_operation_functions import encode_image, resize_image
+from cache_functions import completion_cache_key, get_cached_completion, set_cached_completion
+from tracing_functions import trace_stage, record_usage, submit_in_context, log_warning
+from json_functions import iter_json_array_segments, loads_tolerant, validate_lesson_plan, lesson_plan_keys
+from rate_limit_functions import (scheduled_request, estimate_request_tokens, request_deadline_seconds, tokens_per_minute,
+                                  default_completion_tokens)
+from token_functions import completion_budget, estimate_request, record_estimate, count_text_tokens, model_profile
 import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
-# Define api keys
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# Connections to the API are kept open and shared by all sessions of the app.
+# Retries are made by scheduled_request (rate_limit_functions), not by the client.
+openai_max_connections = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20))
 
-def chat_complition_images(content, total_plans):
+# Many pages are read with a map-reduce: batches of images are sent at the same time to extract their content,
+# then the lesson plans are written from the extracted content by the text model. VISION_MAP_REDUCE=auto uses
+# it from VISION_MAP_REDUCE_MIN_IMAGES images or when one request would not fit in the context window,
+# 1 always and 0 never (all images in one request).
+vision_map_reduce = os.environ.get("VISION_MAP_REDUCE", "auto")
+vision_map_reduce_min_images = int(os.environ.get("VISION_MAP_REDUCE_MIN_IMAGES", 6))
+# Extraction requests running at the same time, and image tokens of one request at most
+# (a smaller request is answered sooner)
+vision_map_concurrency = int(os.environ.get("VISION_MAP_CONCURRENCY", 4))
+vision_batch_max_image_tokens = int(os.environ.get("VISION_BATCH_MAX_IMAGE_TOKENS", 4 * 765))
+# Limits of the vision model (gpt-4-vision-preview)
+vision_model_context_window = 128000
+vision_model_max_output_tokens = 4096
+# Tokens expected in the response for the lesson plan of one day without its assessment, for each question
+# of the assessment with its answer, and for the content extracted from one page. max_tokens of a request is
+# given by token_functions.completion_budget, with the calibrated scale of the purpose of the response.
+lesson_plan_day_tokens = 250
+assessment_question_tokens = 60
+extraction_tokens_per_image = 250
+# max_tokens used before the estimator, kept as the lowest max_tokens until the purpose is calibrated:
+# for the lesson plan of one day and for the content of one page. Other responses had no max_tokens.
+uncalibrated_lesson_plan_day_max_tokens = 700
+uncalibrated_extraction_max_tokens_per_image = 350
+# Tokens of the text of a lesson plan prompt, without the extracted content
+lesson_plan_prompt_tokens = 700
+
+# The client (and the openai package) is only loaded by the first request, see get_client
+_client = None
+_client_lock = threading.Lock()
+_client_settings = {}
+
+def configure_client(api_key=None, base_url=None):
+    """
+    Set the API key and url used by the client instead of the environment, e.g. in scripts.
+    The client is built again on the next request.
+    """
+    global _client
+    with _client_lock:
+        _client_settings.update({"api_key": api_key, "base_url": base_url})
+        _client = None
+
+def openai_api_key():
+    """
+    The API key: configure_client, then OPENAI_API_KEY, then the streamlit secrets (.streamlit/secrets.toml).
+    """
+    api_key = _client_settings.get("api_key") or os.environ.get("OPENAI_API_KEY")
+    if api_key:
+        return api_key
+    try:
+        import streamlit as st
+        return st.secrets["OPENAI_API_KEY"]
+    except (ImportError, FileNotFoundError, KeyError):
+        raise RuntimeError("No OpenAI API key: set OPENAI_API_KEY or add it to .streamlit/secrets.toml")
+
+def get_client():
+    """
+    This function gives the OpenAI client, it is built on the first call.
+    OPENAI_BASE_URL is used by the client when no url is configured, e.g. to run the benchmarks
+    against a local stub server.
+
+    Returns:
+        OpenAI: the client shared by all requests of the process.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI
+            http_client = httpx.Client(limits=httpx.Limits(max_connections=openai_max_connections, 
+                                                           max_keepalive_connections=openai_max_connections),
+                                       timeout=httpx.Timeout(request_deadline_seconds, connect=10))
+            _client = OpenAI(api_key=openai_api_key(), base_url=_client_settings.get("base_url"), 
+                             http_client=http_client, max_retries=0)
+        return _client
+
+# Limit of API requests running at the same time, shared by all processes which use the same
+# semaphore (e.g. the units of batch_generate.py). None means no limit.
+api_semaphore = None
+
+def set_api_semaphore(semaphore):
+    """
+    Share a semaphore (threading or multiprocessing) which limits the API requests running at the same time.
+    """
+    global api_semaphore
+    api_semaphore = semaphore
+
+@contextmanager
+def api_request_slot():
+    """
+    Wait for a free API request slot, see set_api_semaphore.
+    """
+    with api_semaphore if api_semaphore is not None else nullcontext():
+        yield
+
+def payload_size(messages):
+    """
+    Size in bytes of the text and images (base64 data urls) sent in the messages.
+    """
+    size = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for item in content:
+            if item.get("type") == "text":
+                size += len(item["text"].encode("utf-8"))
+            elif item.get("type") == "image_url":
+                image_url = item["image_url"]
+                size += len(image_url["url"] if isinstance(image_url, dict) else image_url)
+    return size
+
+def lesson_plan_prompt(no_of_days, no_of_questions_for_assessment, dict_of_duration_and_activity, extracted_content=None):
+    """
+    Prompt which asks the vision model for the lesson plan of each day.
+
+    Parameters:
+        no_of_days (int): The number of days for which the lesson plan is required.
+        no_of_questions_for_assessment (int): The number of questions for each day of the assessment.
+        dict_of_duration_and_activity (dict): {day: {"Duration": minutes, "Activity": activity}}
+        extracted_content (str, optional): content of the pages given by extract_images_content, the lesson plans 
+                                           are written from it instead of from images sent with the prompt.
+
+    Returns:
+        str: the prompt.
+    """
+    # Extract durations
+    durations = [day["Duration"] for day in dict_of_duration_and_activity.values()]
+    durations = ", ".join(str(duration)+" minutes" for duration in durations[:-1]) + " and " + str(durations[-1]) + " minutes"
+
+    source = "provided images" if extracted_content is None else "provided content of the pages"
+    prompt = f"""I need {f"{no_of_days} lesson plans" if no_of_days>1 else f"{no_of_days} lesson plan"} according to {source} using Bloom's Taxonomy.
+    Design lesson plans for {durations} respectively.
+    Duration must be same as provided, adjust lesson plan according to time duration.
+    
+    Identify the following items from all {source}:
+    - KEY CONCEPTS & TERMINOLOGY
+    - Aims and Objectives
+    - Introduction (Opening routines, warmer, topic lead-in etc.)
+    - Lesson Body (Stages, activities, focus etc.)
+    - Duration
+    - Conclusion (Closing routines & wrap up, e.g. homework setting, review, summary etc.)
+    - Assessment ({no_of_questions_for_assessment} questions for students for assessment from the topic)
+    - Exact answers of assessment questions
+
+    Your response should start with JSON object.
+    I will use `json.loads()` to load your response in JSON. Give your response properly so that `json.loads()` don't create any issue.
+    Do not include any explanations, only provide {no_of_days} RFC8259 compliant JSON response following this format without deviation.
+    [{{"terminology": "key concepts and terminology separated by new line",
+    "aims_and_objective": "Aims and objectives separated by new line. Each line should start with SWBAT",
+    "introduction": "opening routines, warmer, topic lead-in etc separated by new line",
+    "lesson_body": "stages, activities, focus etc and should be a bit long e.g 4 to 5 lines",
+    "Duration": "lecture duration in minutes",
+    "conclusion": "closing routines & wrap up, e.g. homework setting, review, summary etc separated by new line",
+    "assessment": "{no_of_questions_for_assessment} questions for students for assessment from the topic separated by new line",
+    "answers": "Exact answers of assessment questions separated by new line"}}]
+
+    Make sure that values must be in string.
+    Don't repeat terminologies for each day.
+    Don't change any key.
+    Don't forget to use Bloom's Taxonomy while creating lesson plans.
+    Don't forget any instruction mentioned above.
+    """
+    # Don't use collections in values.
+    if extracted_content is not None:
+        prompt += f"""
+    Content of the pages, delimited by triple backticks: ```{extracted_content}```
+    """
+
+    return prompt
+
+def lesson_plan_tokens(no_of_days, no_of_questions_for_assessment=3):
+    """
+    Tokens expected in the response for the lesson plans of no_of_days days.
+    """
+    return no_of_days * (lesson_plan_day_tokens + assessment_question_tokens * no_of_questions_for_assessment)
+
+def image_content(image):
+    """
+    Content of a prepared image in a message, sent with the detail chosen for it (see prepare_images).
+    """
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image['image']}", 
+                                               "detail": image.get("detail") or "high"}}
+
+def completion_estimate(model, messages, purpose, expected_tokens, max_tokens=None, uncalibrated_max_tokens=None):
+    """
+    Prediction of a request before it is sent, see token_functions.estimate_request. Its max_tokens is the 
+    budget of expected_tokens (see token_functions.completion_budget) unless max_tokens is given.
+    """
+    predicted_tokens, budget = completion_budget(expected_tokens, purpose, model, uncalibrated_max_tokens)
+    max_tokens = max_tokens or budget
+    return estimate_request(model, messages, purpose, min(predicted_tokens, max_tokens), max_tokens)
+
+def chat_complition_images(content, total_plans, stream=False, model="gpt-4-vision-preview", max_tokens=None,
+                           expected_tokens=None, purpose="lesson_plans", uncalibrated_max_tokens=None):
     """
     This function uses the OpenAI API to generate text based on the input text.
 
     Parameters:
         content: The input text and images.
         total_plans (int): The number of plans to generate.
+        stream (bool, optional): give the text while it is generated, see stream_chat_complition_images.
+        model (str, optional): e.g. the text model when the content has no image.
+        max_tokens (int, optional): maximum tokens of the response. Defaults to the budget of expected_tokens.
+        expected_tokens (int, optional): tokens expected in the response. Defaults to lesson_plan_tokens of total_plans.
+        purpose (str, optional): what the response is, e.g. page_extraction, see token_functions.completion_budget.
+        uncalibrated_max_tokens (int, optional): lowest max_tokens until the purpose is calibrated. Defaults to
+                                                 uncalibrated_lesson_plan_day_max_tokens for each plan.
+
+    Returns:
+        str: The generated text. A response cut off by max_tokens is asked again once with the maximum of the model.
+        generator: parts of the generated text if stream is True.
+    """
+    if stream:
+        return stream_chat_complition_images(content, total_plans, model, max_tokens, expected_tokens, purpose,
+                                             uncalibrated_max_tokens)
+
+    messages = [
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
+    estimate = completion_estimate(model, messages, purpose, expected_tokens or lesson_plan_tokens(total_plans), max_tokens,
+                                   uncalibrated_max_tokens or uncalibrated_lesson_plan_day_max_tokens * total_plans)
+    max_tokens = estimate["max_tokens"]
+    images = sum(item.get("type") == "image_url" for item in content)
+
+    with trace_stage("vision_completion" if images else "text_completion", model=model, payload_bytes=payload_size(messages), 
+                     images=images, max_tokens=max_tokens, purpose=purpose) as span:
+        # Same prompt and same images give the cached response
+        cache_key = completion_cache_key(model, messages, max_tokens=max_tokens)
+        cached_response = get_cached_completion(cache_key)
+        span["cache_hit"] = cached_response is not None
+        if cached_response is not None:
+            return cached_response
+
+        # Time of the last attempt, from when it is sent
+        request_start = []
+        def create(timeout):
+            request_start.append(time.perf_counter())
+            return get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                timeout=timeout
+            )
+
+        with api_request_slot():
+            response = scheduled_request(model, create, estimate_request_tokens(messages, max_tokens), span=span)
+        record_usage(span, response)
+        record_estimate(span, estimate, response, seconds=time.perf_counter() - request_start[-1])
+        gpt_response = response.choices[0].message.content
+        # Only a complete response is kept in the cache, not one cut off by max_tokens or a content filter
+        if response.choices[0].finish_reason == "stop":
+            set_cached_completion(cache_key, model, gpt_response)
+        maximum = model_profile(model)["max_output_tokens"]
+        if response.choices[0].finish_reason == "length" and max_tokens < maximum:
+            span["retried_with_max_tokens"] = maximum
+            return chat_complition_images(content, total_plans, model=model, max_tokens=maximum, 
+                                          expected_tokens=expected_tokens, purpose=purpose)
+        return gpt_response
+
+def stream_chat_complition_images(content, total_plans, model="gpt-4-vision-preview", max_tokens=None, 
+                                  expected_tokens=None, purpose="lesson_plans", uncalibrated_max_tokens=None):
+    """
+    Same as chat_complition_images but the text is given part by part while the model generates it.
+
+    Parameters:
+        content: The input text and images.
+        total_plans (int): The number of plans to generate.
+        model, max_tokens, expected_tokens, purpose, uncalibrated_max_tokens (optional): see chat_complition_images.
+
+    Yields:
+        str: parts of the generated text. A cached response is given as one part. A response cut off by 
+             max_tokens is not asked again, its parts are already given.
+    """
+    messages = [
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
+    estimate = completion_estimate(model, messages, purpose, expected_tokens or lesson_plan_tokens(total_plans), max_tokens,
+                                   uncalibrated_max_tokens or uncalibrated_lesson_plan_day_max_tokens * total_plans)
+    max_tokens = estimate["max_tokens"]
+    images = sum(item.get("type") == "image_url" for item in content)
+
+    with trace_stage("vision_completion" if images else "text_completion", model=model, payload_bytes=payload_size(messages), 
+                     images=images, max_tokens=max_tokens, purpose=purpose, stream=True) as span:
+        # Streamed and complete responses share the cache
+        cache_key = completion_cache_key(model, messages, max_tokens=max_tokens)
+        cached_response = get_cached_completion(cache_key)
+        span["cache_hit"] = cached_response is not None
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        # Time of the last attempt, from when it is sent
+        request_start = []
+        def create(timeout):
+            request_start.append(time.perf_counter())
+            return get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                timeout=timeout
+            )
+
+        # The slot is kept until the whole response is received
+        with api_request_slot():
+            start = time.perf_counter()
+            response = scheduled_request(model, create, estimate_request_tokens(messages, max_tokens), span=span)
+            parts, finish_reason = [], None
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not parts:
+                        span["first_token_time"] = time.perf_counter() - start
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+        # Usage is not sent with streamed responses, the number of characters is kept instead
+        span["response_chars"] = sum(len(part) for part in parts)
+        record_estimate(span, estimate, response_text="".join(parts), seconds=time.perf_counter() - request_start[-1],
+                        finish_reason=finish_reason)
+        # Only a complete response is kept in the cache, not one cut off by max_tokens or a content filter
+        if finish_reason == "stop":
+            set_cached_completion(cache_key, model, "".join(parts))
+
+
+def use_map_reduce(image_tokens, no_of_days, no_of_questions_for_assessment=3):
+    """
+    This function chooses how the images are read, see vision_map_reduce.
+
+    Parameters:
+        image_tokens (list): tokens of each image, see token_functions.vision_image_tokens.
+        no_of_days (int): The number of days for which the lesson plan is required.
+        no_of_questions_for_assessment (int, optional): The number of questions for each day of the assessment.
+
+    Returns:
+        bool: True to use the map-reduce, False to send all images in one request.
+    """
+    if vision_map_reduce in ("0", "1"):
+        return vision_map_reduce == "1"
+    single_request_tokens = (sum(image_tokens) + lesson_plan_prompt_tokens 
+                             + lesson_plan_tokens(no_of_days, no_of_questions_for_assessment))
+    return len(image_tokens) >= max(2, vision_map_reduce_min_images) or single_request_tokens > vision_model_context_window
+
+def plan_image_batches(image_tokens, max_concurrency=None):
+    """
+    This function groups consecutive images for the extraction requests. The images are spread over the requests
+    running at the same time so that they end together. A batch has at most vision_batch_max_image_tokens image
+    tokens (there are then more batches than requests running at the same time) and its content fits in the
+    response of the model. Requests running at the same time must fit in the tokens per minute of the account,
+    more would only wait for each other.
+
+    Parameters:
+        image_tokens (list): tokens of each image, in upload order.
+        max_concurrency (int, optional): requests running at the same time at most. Defaults to vision_map_concurrency.
+
+    Returns:
+        tuple: (list of batches, each a list of image positions, number of requests running at the same time)
+    """
+    if not image_tokens:
+        return [], 1
+    # The max_tokens of each image must fit in the response
+    _, image_max_tokens = completion_budget(extraction_tokens_per_image, "page_extraction", "gpt-4-vision-preview",
+                                            uncalibrated_extraction_max_tokens_per_image)
+    max_images_per_batch = max(1, vision_model_max_output_tokens // image_max_tokens)
+    concurrency = max(1, min(max_concurrency or vision_map_concurrency, len(image_tokens)))
+    min_batches = math.ceil(len(image_tokens) / max_images_per_batch)
+    number_of_batches = max(concurrency, math.ceil(sum(image_tokens) / vision_batch_max_image_tokens), min_batches)
+    # Every round of requests running at the same time is full, but no batch has more than max_images_per_batch
+    number_of_batches = max(min(math.ceil(number_of_batches / concurrency) * concurrency, len(image_tokens)), min_batches)
+    # Consecutive images with about the same number of tokens in each batch
+    batches, batch, batch_tokens, remaining_tokens = [], [], 0, sum(image_tokens)
+    for position, tokens in enumerate(image_tokens):
+        remaining_batches = number_of_batches - len(batches)
+        remaining_images = len(image_tokens) - position
+        # A batch cut at max_images_per_batch may leave one more batch than planned
+        if batch and (batch_tokens + tokens / 2 > remaining_tokens / max(1, remaining_batches)
+                      or len(batch) == max_images_per_batch or remaining_images < remaining_batches):
+            batches.append(batch)
+            remaining_tokens -= batch_tokens
+            batch, batch_tokens = [], 0
+        batch.append(position)
+        batch_tokens += tokens
+    batches.append(batch)
+
+    request_tokens = max(sum(image_tokens[position] for position in batch) + image_max_tokens * len(batch)
+                         for batch in batches)
+    concurrency = max(1, min(concurrency, len(batches), int(tokens_per_minute // request_tokens)))
+    return batches, concurrency
+
+def extract_images_content(images, warn=None):
+    """
+    The map step of the map-reduce: the content of the pages is extracted by batches of images sent at the 
+    same time, see plan_image_batches. A batch which fails is left out, the others are kept.
+
+    Parameters:
+        images (list): prepared images {"name", "image": base64 JPEG, "detail", "tokens"}, see prepare_images.
+        warn (function, optional): called with the message of each batch which could not be read, defaults to log_warning.
+
+    Returns:
+        str: the content of all pages, in upload order.
+
+    Raises:
+        ValueError: if no batch could be read.
+    """
+    batches, concurrency = plan_image_batches([image["tokens"] for image in images])
+
+    def extract(batch):
+        prompt = f"""These are pages {batch[0] + 1} to {batch[-1] + 1} of the {len(images)} pages of a textbook unit.
+    Extract their content for a teacher who will plan lessons from it without the pages: key concepts and terminology,
+    definitions, rules, worked examples, exercises and figures described in words. Keep the order of the pages.
+    Be concise, do not write a lesson plan and do not include any explanations."""
+        content = [{"type": "text", "text": prompt}]
+        content += [image_content(images[position]) for position in batch]
+        return chat_complition_images(content, 1, expected_tokens=extraction_tokens_per_image * len(batch), 
+                                      purpose="page_extraction",
+                                      uncalibrated_max_tokens=uncalibrated_extraction_max_tokens_per_image * len(batch))
+
+    contents = []
+    with trace_stage("vision_map", images=len(images), batches=len(batches), concurrency=concurrency):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Read in upload order
+            futures = [submit_in_context(executor, extract, batch) for batch in batches]
+            for batch, future in zip(batches, futures):
+                try:
+                    contents.append(f"Pages {batch[0] + 1} to {batch[-1] + 1}:\n{future.result()}")
+                except Exception as e:
+                    message = f"{', '.join(images[position]['name'] for position in batch)} could not be read: Error_{e}"
+                    warn(message) if warn else log_warning(message)
+    if not contents:
+        raise ValueError("none of the pages could be read")
+    return "\n\n".join(contents)
+
+def lesson_plans_from_images(images, no_of_days, no_of_questions_for_assessment, dict_of_duration_and_activity, 
+                             stream=False, warn=None):
+    """
+    This function asks for the lesson plan of each day from the pages: all images in one vision request, or 
+    with the map-reduce for many pages (see use_map_reduce), then the lesson plans are written by the text model
+    from the extracted content.
+
+    Parameters:
+        images (list): prepared images {"name", "image": base64 JPEG, "detail", "tokens"}, see prepare_images.
+        no_of_days, no_of_questions_for_assessment, dict_of_duration_and_activity: see lesson_plan_prompt.
+        stream (bool, optional): give the response part by part while it is generated.
+        warn (function, optional): see extract_images_content.
 
     Returns:
-        str: The generated text.
+        str: the response, see parse_lesson_plans.
+        generator: parts of the response if stream is True.
+    """
+    expected_tokens = lesson_plan_tokens(no_of_days, no_of_questions_for_assessment)
+    if use_map_reduce([image["tokens"] for image in images], no_of_days, no_of_questions_for_assessment):
+        extracted_content = extract_images_content(images, warn)
+        prompt = lesson_plan_prompt(no_of_days, no_of_questions_for_assessment, dict_of_duration_and_activity, 
+                                    extracted_content)
+        return chat_complition_images([{"type": "text", "text": prompt}], no_of_days, stream, model="gpt-4-turbo-preview",
+                                      expected_tokens=expected_tokens)
+
+    prompt = lesson_plan_prompt(no_of_days, no_of_questions_for_assessment, dict_of_duration_and_activity)
+    content = [{"type": "text", "text": prompt}]
+    content += [image_content(image) for image in images]
+    return chat_complition_images(content, no_of_days, stream, expected_tokens=expected_tokens)
+
+def chat_completion(prompt, max_tokens=None, use_cache=True, expected_tokens=None, purpose="json_completion"):
     """
-    response = client.chat.completions.create(
-        model="gpt-4-vision-preview",
-        messages=[
-            {
-                "role": "user",
-                "content": content,
-            }
-        ],
-        max_tokens=700*total_plans
-    )
-    return response.choices[0].message.content
+    This function asks the text model for a JSON object.
+    JSON mode is used so the model can only answer with a valid JSON object.
 
+    Parameters:
+        prompt (str): the prompt, it must ask for a JSON object.
+        max_tokens (int, optional): maximum tokens of the response. Defaults to the budget of expected_tokens
+                                    (the maximum of the model until the purpose is calibrated), the default of
+                                    the model if neither is given.
+        use_cache (bool, optional): False to ask the model even if the prompt is cached (e.g. to regenerate
+                                    a part which came out badly), the new response replaces the cached one.
+        expected_tokens (int, optional): tokens expected in the response, see token_functions.completion_budget.
+        purpose (str, optional): what the response is, e.g. lesson_body.
 
-def chat_completion(prompt):
-    completion = client.chat.completions.create(
-    model="gpt-4-turbo-preview",
-    messages=[
-        # {"role": "system", "content": "You are a lesson planner designed to output JSON."},
+    Returns:
+        dict: the loaded response. A response cut off by max_tokens is asked again once with the maximum of the model.
+    """
+    model = "gpt-4-turbo-preview"
+    maximum = model_profile(model)["max_output_tokens"]
+    messages = [
+        {"role": "system", "content": "You are a lesson planner designed to output JSON."},
         {"role": "user", "content": prompt}
     ]
-    )
-    gpt_response = completion.choices[0].message.content
-    gpt_response = gpt_response.replace("`", "").replace("json", "") 
-    gpt_response = json.loads(gpt_response)
-    # print("=="*20)
-    # print(type(gpt_response))
-    # print("=="*20)
-    # print(gpt_response)
-    # print("=="*20)
-    # print(completion.choices[0].message.content)
-    # print("=="*20)
-    return gpt_response
\ No newline at end of file
+    response_format = {"type": "json_object"}
+    if expected_tokens or max_tokens:
+        # Responses of the text model had no max_tokens before the estimator
+        estimate = completion_estimate(model, messages, purpose, expected_tokens or max_tokens, max_tokens, maximum)
+        max_tokens = estimate["max_tokens"]
+    else:
+        # The model decides the length of the response
+        estimate = estimate_request(model, messages, purpose, default_completion_tokens)
+    # Only sent when given, so the cache keys of other requests do not change
+    parameters = {"max_tokens": max_tokens} if max_tokens else {}
+
+    with trace_stage("text_completion", model=model, payload_bytes=payload_size(messages), max_tokens=max_tokens, 
+                     purpose=purpose) as span:
+        cache_key = completion_cache_key(model, messages, response_format=response_format, **parameters)
+        raw_response = get_cached_completion(cache_key) if use_cache else None
+        from_cache = span["cache_hit"] = raw_response is not None
+        if not from_cache:
+            # Time of the last attempt, from when it is sent
+            request_start = []
+            def create(timeout):
+                request_start.append(time.perf_counter())
+                return get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                timeout=timeout,
+                **parameters
+                )
+
+            with api_request_slot():
+                completion = scheduled_request(model, create, estimate_request_tokens(messages, max_tokens), span=span)
+            record_usage(span, completion)
+            record_estimate(span, estimate, completion, seconds=time.perf_counter() - request_start[-1])
+            raw_response = completion.choices[0].message.content
+            cut_off = completion.choices[0].finish_reason == "length" and max_tokens and max_tokens < maximum
+            if cut_off:
+                span["retried_with_max_tokens"] = maximum
+    if not from_cache and cut_off:
+        return chat_completion(prompt, max_tokens=maximum, use_cache=use_cache, expected_tokens=expected_tokens,
+                               purpose=purpose)
+    gpt_response = loads_tolerant(raw_response)
+    # Only responses which can be loaded are kept in the cache
+    if not from_cache:
+        set_cached_completion(cache_key, model, raw_response)
+    return gpt_response
+
+def repair_lesson_plan(lesson_plan_text, error):
+    """
+    This function asks the text model to correct the lesson plan of one day which can not be loaded,
+    so that the other days do not have to be generated again.
+
+    Parameters:
+        lesson_plan_text (str): text of the day in the response of the vision model.
+        error (Exception): why it can not be loaded.
+
+    Returns:
+        dict: the lesson plan of the day, see validate_lesson_plan.
+    """
+    prompt = f"""The lesson plan of one day, delimited by triple backticks, should be a JSON object but it is not valid: {error}.
+    Give the same lesson plan as one RFC8259 compliant JSON object with exactly these keys: {", ".join(lesson_plan_keys)}.
+    All values must be strings, separate lines with new lines.
+    Keep the content, only fix the format. If a value is cut off or missing, complete it from the rest of the lesson plan.
+    lesson plan: ```{lesson_plan_text}```
+    """
+    # The repaired day is about as long as the text, or a whole day if it is cut off
+    expected_tokens = max(count_text_tokens(lesson_plan_text), lesson_plan_tokens(1))
+    return validate_lesson_plan(chat_completion(prompt, expected_tokens=expected_tokens, purpose="lesson_plan_repair"))
+
+# Sections of the lesson plan of a day which can be generated again, the duration is given by the user
+regenerated_lesson_plan_keys = [key for key in lesson_plan_keys if key != "Duration"]
+
+def regenerate_lesson_plan(lesson_plan, sections=None):
+    """
+    This function asks the text model to write sections of the lesson plan of one day again, from the
+    rest of the lesson plan. The other sections are kept.
+
+    Parameters:
+        lesson_plan (dict): lesson plan of the day, see validate_lesson_plan.
+        sections (list, optional): keys of the sections written again, every section if not given (the whole day).
+                                   The answers are written again with the assessment.
+
+    Returns:
+        dict: the lesson plan of the day with the new sections.
+
+    Raises:
+        ValueError: if a section is missing in the response.
+    """
+    sections = list(sections or regenerated_lesson_plan_keys)
+    if "assessment" in sections and "answers" not in sections:
+        # The answers must match the new questions
+        sections.append("answers")
+    number_of_questions = len([line for line in lesson_plan["assessment"].split("\n") if line.strip()])
+    prompt = f"""Here is the lesson plan of one day as a JSON object, delimited by triple backticks.
+    Write these sections again: {", ".join(sections)}. They must be different from the current ones and better, 
+    keep the same topic, level, format and length, and stay consistent with the other sections of the lesson plan.
+    The lesson lasts {lesson_plan["Duration"]} minutes. The assessment has {number_of_questions} questions separated 
+    by new line, the answers are the exact answers of the assessment questions separated by new line.
+    Give one RFC8259 compliant JSON object with exactly these keys: {", ".join(sections)}. All values must be strings.
+    lesson plan: ```{json.dumps(lesson_plan)}```
+    """
+    # Asked again when it is pressed again, a cached response would give the same sections
+    # The new sections are about as long as the current ones, short sections may come out longer
+    expected_tokens = max(100, count_text_tokens(json.dumps({section: lesson_plan.get(section, "") for section in sections})))
+    gpt_response = chat_completion(prompt, use_cache=False, expected_tokens=expected_tokens, 
+                                   purpose="lesson_plan_sections")
+    missing_sections = [section for section in sections if section not in gpt_response]
+    if missing_sections:
+        raise ValueError(f"sections {', '.join(missing_sections)} are missing in the response")
+    return validate_lesson_plan({**lesson_plan, **{section: gpt_response[section] for section in sections}})
+
+def parse_lesson_plans(gpt_response, repair=True, no_of_days=None):
+    """
+    This function reads the lesson plan of each day from the response of the vision model.
+    The vision model has no JSON mode, so each day is loaded on its own: a day which can not be 
+    loaded is corrected by repair_lesson_plan and the other days are kept.
+
+    Parameters:
+        gpt_response (str or iterable): the response, or its parts while it is streamed.
+        repair (bool): correct days which can not be loaded, else raise ValueError.
+        no_of_days (int, optional): number of days asked. Only these days are given, and fewer days 
+                                    (e.g. a response cut off by max_tokens) raise ValueError.
+
+    Yields:
+        dict: lesson plan of each day, see validate_lesson_plan.
+
+    Raises:
+        ValueError: if the response has no lesson plan or fewer lesson plans than no_of_days.
+    """
+    if isinstance(gpt_response, str):
+        gpt_response = [gpt_response]
+    day_number = 0
+    for segment in iter_json_array_segments(gpt_response, include_unfinished=True):
+        try:
+            lesson_plans = loads_tolerant(segment)
+            # {"lesson_plans": [...]} instead of the array
+            if isinstance(lesson_plans, dict) and len(lesson_plans) == 1 and \
+                    isinstance(next(iter(lesson_plans.values())), list):
+                lesson_plans = next(iter(lesson_plans.values()))
+            lesson_plans = [validate_lesson_plan(lesson_plan) 
+                            for lesson_plan in (lesson_plans if isinstance(lesson_plans, list) else [lesson_plans])]
+        except ValueError as e:
+            if not repair:
+                raise
+            with trace_stage("lesson_plan_repair", day=day_number + 1):
+                lesson_plans = [repair_lesson_plan(segment, e)]
+        for lesson_plan in lesson_plans:
+            if no_of_days is not None and day_number == no_of_days:
+                break
+            day_number += 1
+            yield lesson_plan
+    if day_number == 0:
+        raise ValueError("the response has no lesson plan")
+    if no_of_days is not None and day_number < no_of_days:
+        raise ValueError(f"the response has {day_number} of the {no_of_days} lesson plans, the other days are missing")
@@ -0,0 +1,295 @@
+# Import modules
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from tracing_functions import count_retry, current_trace_id
+from token_functions import estimate_prompt_tokens, default_model_profiles
+
+# Rate limits of the OpenAI account for each model, can be changed with environment variables
+requests_per_minute = float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", 500))
+tokens_per_minute = float(os.environ.get("OPENAI_TOKENS_PER_MINUTE", 150000))
+# Retries of a throttled or failed request, waiting base * 2**attempt seconds at most (with jitter)
+max_retries = int(os.environ.get("OPENAI_MAX_RETRIES", 5))
+backoff_base_seconds = float(os.environ.get("OPENAI_BACKOFF_BASE_SECONDS", 1))
+backoff_max_seconds = float(os.environ.get("OPENAI_BACKOFF_MAX_SECONDS", 60))
+# Time given to a call, waiting in the queue and retries included
+request_deadline_seconds = float(os.environ.get("OPENAI_REQUEST_DEADLINE_SECONDS", 180))
+
+# Tokens counted for a response without max_tokens
+default_completion_tokens = 1000
+
+# Requests are queued per session, a session is the current generation unless fair_queue_session is used
+_current_session = contextvars.ContextVar("current_session", default=None)
+
+class DeadlineExceeded(TimeoutError):
+    """
+    The call could not be made before its deadline.
+    """
+
+class TokenBucket:
+    """
+    Allows per_minute units per minute, refilled continuously. Starts full.
+    """
+    def __init__(self, per_minute, state=None):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        # [level, time of the last refill], a shared array when processes share the bucket (see shared_rate_limits)
+        self.state = state if state is not None else [self.capacity, time.monotonic()]
+
+    @property
+    def level(self):
+        return self.state[0]
+
+    @level.setter
+    def level(self, value):
+        self.state[0] = value
+
+    @property
+    def updated(self):
+        return self.state[1]
+
+    @updated.setter
+    def updated(self, value):
+        self.state[1] = value
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds before amount units are available, 0 if they are available now.
+        """
+        self.refill(now)
+        # A request bigger than the bucket is allowed once the bucket is full
+        amount = min(amount, self.capacity)
+        return 0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        # The level may go below 0, e.g. when the real usage is higher than the estimate
+        self.level -= amount
+
+class RequestScheduler:
+    """
+    Gives permission to send requests within the requests/min and tokens/min limits of a model.
+
+    Waiting requests are served one session after the other (round robin), so a generation with
+    many requests does not delay the generations of other sessions.
+
+    With shared (see shared_rate_limits) the buckets and the pause are shared by all processes,
+    the round robin is kept within each process.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute, shared=None):
+        self.request_bucket = TokenBucket(requests_per_minute, shared and shared["requests"])
+        self.token_bucket = TokenBucket(tokens_per_minute, shared and shared["tokens"])
+        # Time until which no request is sent, in a list so that it can be a shared array too
+        self.pause_state = shared["paused_until"] if shared else [0.0]
+        # Held while the buckets are read and changed, other processes change them too
+        self.buckets_lock = shared["lock"] if shared else nullcontext()
+        self.condition = threading.Condition()
+        self.queues = OrderedDict()  # session: waiting requests of the session, in order
+
+    def acquire(self, tokens, session, deadline):
+        """
+        Wait until the request can be sent.
+
+        Parameters:
+            tokens (int): estimated tokens of the request, see estimate_request_tokens.
+            session (str): queue of the request.
+            deadline (float): time.monotonic() after which the request is not sent anymore.
+
+        Raises:
+            DeadlineExceeded: if the deadline is reached first.
+        """
+        ticket = object()
+        with self.condition:
+            self.queues.setdefault(session, deque()).append(ticket)
+            granted = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        raise DeadlineExceeded("the request was still waiting for the rate limit at its deadline")
+                    wait = deadline - now
+                    # Only the first request of the first session can be sent
+                    if self.queues[next(iter(self.queues))][0] is ticket:
+                        with self.buckets_lock:
+                            wait = min(wait, max(self.pause_state[0] - now,
+                                                 self.request_bucket.wait_time(1, now),
+                                                 self.token_bucket.wait_time(tokens, now)))
+                            if wait <= 0:
+                                self.request_bucket.take(1)
+                                self.token_bucket.take(tokens)
+                                granted = True
+                                return
+                    # Requests of other processes do not wake this one, it waits for the time computed above
+                    self.condition.wait(wait)
+            finally:
+                queue = self.queues[session]
+                queue.remove(ticket)
+                if not queue:
+                    del self.queues[session]
+                elif granted:
+                    # Next request of this session waits for the other sessions
+                    self.queues.move_to_end(session)
+                self.condition.notify_all()
+
+    def settle(self, estimated_tokens, used_tokens):
+        """
+        Correct the tokens/min bucket with the real usage of a request.
+        """
+        with self.condition:
+            with self.buckets_lock:
+                self.token_bucket.take(used_tokens - estimated_tokens)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Send no request for some seconds, e.g. the retry-after of a 429 response.
+        """
+        with self.condition:
+            with self.buckets_lock:
+                self.pause_state[0] = max(self.pause_state[0], time.monotonic() + seconds)
+            self.condition.notify_all()
+
+# One scheduler for each model, OpenAI limits are per model
+_request_schedulers = {}
+_request_schedulers_lock = threading.Lock()
+# Rate limits shared with other processes, see use_shared_rate_limits
+_shared_rate_limits = {}
+
+def shared_rate_limits(context, models=None, requests_per_minute=requests_per_minute,
+                       tokens_per_minute=tokens_per_minute):
+    """
+    This function creates the rate limits of the account in shared memory, so that processes which
+    send requests at the same time (e.g. the units of batch_generate.py) stay within them together.
+    Give it to use_shared_rate_limits in each process, e.g. with the initializer of the process pool.
+
+    Parameters:
+        context: multiprocessing context of the processes.
+        models (list, optional): models which share their limits. Defaults to the models of
+                                 token_functions.default_model_profiles, other models are limited per process.
+        requests_per_minute, tokens_per_minute (float, optional): limits of each model.
+
+    Returns:
+        dict: {model: {"requests_per_minute", "tokens_per_minute", "lock", "requests", "tokens", "paused_until"}}
+    """
+    now = time.monotonic()
+    return {model: {"requests_per_minute": requests_per_minute, "tokens_per_minute": tokens_per_minute,
+                    "lock": context.Lock(),
+                    "requests": context.RawArray("d", [requests_per_minute, now]),
+                    "tokens": context.RawArray("d", [tokens_per_minute, now]),
+                    "paused_until": context.RawArray("d", [0.0])}
+            for model in (models or default_model_profiles)}
+
+def use_shared_rate_limits(rate_limits):
+    """
+    Send the requests of this process within the shared rate limits, see shared_rate_limits.
+    """
+    with _request_schedulers_lock:
+        _shared_rate_limits.clear()
+        _shared_rate_limits.update(rate_limits or {})
+        _request_schedulers.clear()
+
+def get_request_scheduler(model):
+    with _request_schedulers_lock:
+        if model not in _request_schedulers:
+            shared = _shared_rate_limits.get(model)
+            if shared:
+                _request_schedulers[model] = RequestScheduler(shared["requests_per_minute"], shared["tokens_per_minute"],
+                                                              shared)
+            else:
+                _request_schedulers[model] = RequestScheduler(requests_per_minute, tokens_per_minute)
+        return _request_schedulers[model]
+
+@contextmanager
+def fair_queue_session(session):
+    """
+    Queue the requests made in this context (and in thread pools started with submit_in_context) as session.
+    """
+    token = _current_session.set(session)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+def estimate_request_tokens(messages, max_tokens=None):
+    """
+    Number of tokens counted against the tokens/min limit for a request: the tokens of the messages
+    (see token_functions.estimate_prompt_tokens) and max_tokens (or default_completion_tokens).
+    """
+    return estimate_prompt_tokens(messages) + (max_tokens or default_completion_tokens)
+
+def retry_after_seconds(error):
+    """
+    Seconds asked by the retry-after-ms or retry-after header of an error response, None if there is none.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    for header, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        try:
+            return float(response.headers[header]) / scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Exponential backoff with full jitter, never shorter than the retry-after of the server.
+    """
+    delay = random.uniform(0, min(backoff_max_seconds, backoff_base_seconds * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+def scheduled_request(model, create, estimated_tokens, deadline_seconds=None, span=None):
+    """
+    This function sends a request within the rate limits of the model and retries it when it is
+    throttled (429), the connection fails or the server fails (5xx).
+
+    Parameters:
+        model (str): name of the model.
+        create (function): sends the request, called with the timeout (seconds) left before the deadline.
+        estimated_tokens (int): see estimate_request_tokens.
+        deadline_seconds (float, optional): time given to the call. Defaults to request_deadline_seconds.
+        span (dict, optional): stage of the trace, the time spent waiting is added as queue_time.
+
+    Returns:
+        the response of create.
+
+    Raises:
+        DeadlineExceeded: if the request could not be sent before the deadline.
+        the error of the last attempt if it can not be retried anymore.
+    """
+    # Loaded with the client, not when the module is imported
+    from openai import RateLimitError, APIConnectionError, InternalServerError
+    deadline = time.monotonic() + (deadline_seconds or request_deadline_seconds)
+    scheduler = get_request_scheduler(model)
+    session = _current_session.get() or current_trace_id() or threading.current_thread().name
+    attempt = 0
+    while True:
+        queue_start = time.monotonic()
+        scheduler.acquire(estimated_tokens, session, deadline)
+        if span is not None:
+            span["queue_time"] = span.get("queue_time", 0) + time.monotonic() - queue_start
+        try:
+            response = create(timeout=max(1, deadline - time.monotonic()))
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            retry_after = retry_after_seconds(e)
+            if isinstance(e, RateLimitError) and retry_after:
+                # Every session waits, not only this request
+                scheduler.pause(retry_after)
+            delay = backoff_delay(attempt, retry_after)
+            attempt += 1
+            if attempt > max_retries or time.monotonic() + delay >= deadline:
+                raise
+            count_retry()
+            time.sleep(delay)
+            continue
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            scheduler.settle(estimated_tokens, usage.total_tokens)
+        return response
@@ -0,0 +1,211 @@
+# Import modules
+import io
+import os
+import re
+import struct
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+from lxml import etree
+from docx.oxml.parser import parse_xml
+from docx.oxml.ns import qn
+from docx_writer_functions import table_cell_grid
+
+# Documents are rendered from compiled templates instead of python-docx, COMPILED_TEMPLATES=0 disables it
+compiled_templates = os.environ.get("COMPILED_TEMPLATES", "1") != "0"
+
+# Part of a .docx file which is rendered, every other part is copied as it is
+document_part_name = "word/document.xml"
+
+# Markers of an insertion point in the serialized document.xml
+_slot_marker = re.compile(rb"<\?slot-(start|end) ([^?]*)\?>")
+# Characters which can not be written in XML, lxml refuses them as well
+_invalid_xml_characters = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+def compile_template(template_bytes, insertion_points):
+    """
+    This function analyzes a template once so that documents can be rendered by splicing
+    WordprocessingML fragments into its document.xml.
+
+    Parameters:
+        template_bytes (bytes): content of the .docx template.
+        insertion_points (list): (name, table position, row position, cell position) of each cell
+                                 where content is written. A table position of None is the end of the body.
+
+    Returns:
+        dict: {"pieces": the serialized document.xml split in ("static", bytes) and ("slot", name, original bytes),
+               "members": the members of the zip file in order, with their compressed bytes (the document part has none)}
+    """
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as template_zip:
+        document_xml = template_zip.read(document_part_name)
+        members = []
+        for info in template_zip.infolist():
+            member = {"name": info.filename, "date_time": info.date_time, "flag_bits": info.flag_bits & 0x800,
+                      "compress_type": info.compress_type, "crc": info.CRC, "file_size": info.file_size, "data": None}
+            if info.filename != document_part_name:
+                # The compressed bytes are copied from the template, after the local header
+                name_length, extra_length = struct.unpack("<HH", template_bytes[info.header_offset + 26:info.header_offset + 30])
+                data_start = info.header_offset + 30 + name_length + extra_length
+                member["data"] = template_bytes[data_start:data_start + info.compress_size]
+            members.append(member)
+
+    root = parse_xml(document_xml)
+    body = root.body
+    tables = body.tbl_lst
+    grids = {}
+    for name, table_position, row_position, cell_position in insertion_points:
+        start, end = etree.ProcessingInstruction("slot-start", name), etree.ProcessingInstruction("slot-end", name)
+        if table_position is None:
+            # Before the section properties, which are the last element of the body
+            anchor = body[-1] if len(body) and body[-1].tag == qn("w:sectPr") else None
+            for marker in (start, end):
+                if anchor is not None:
+                    anchor.addprevious(marker)
+                else:
+                    body.append(marker)
+            continue
+        if table_position not in grids:
+            grids[table_position] = table_cell_grid(tables[table_position])
+        cell_element = grids[table_position](row_position, cell_position)
+        # Content of the cell is after its properties
+        has_properties = len(cell_element) and cell_element[0].tag == qn("w:tcPr")
+        cell_element.insert(1 if has_properties else 0, start)
+        cell_element.append(end)
+
+    # Serialized as python-docx does
+    pieces = []
+    parts = _slot_marker.split(etree.tostring(root, encoding="UTF-8", standalone=True))
+    pieces.append(("static", parts[0]))
+    # parts: static, kind, name, static, kind, name, ...
+    for position in range(1, len(parts), 3):
+        kind, name, following = parts[position], parts[position + 1].decode("utf-8"), parts[position + 2]
+        if kind == b"start":
+            pieces.append(("slot", name, following))
+        else:
+            pieces.append(("static", following))
+    return {"pieces": pieces, "members": members}
+
+def render_document_xml(compiled_template, fragments, keep_original=()):
+    """
+    This function gives the document.xml of a compiled template with the fragments in their insertion points.
+
+    Parameters:
+        compiled_template (dict): see compile_template.
+        fragments (dict): {insertion point name: WordprocessingML (str)}. The original content
+                          of an insertion point without fragment is kept.
+        keep_original (iterable): insertion points whose fragment is added after the original content
+                                  instead of replacing it.
+
+    Returns:
+        bytes: the document.xml.
+    """
+    keep_original = set(keep_original)
+    parts = []
+    for piece in compiled_template["pieces"]:
+        if piece[0] == "static":
+            parts.append(piece[1])
+            continue
+        _, name, original = piece
+        if name not in fragments:
+            parts.append(original)
+            continue
+        if name in keep_original:
+            parts.append(original)
+        parts.append(fragments[name].encode("utf-8"))
+    return b"".join(parts)
+
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+def iter_docx_bytes(compiled_template, document_xml):
+    """
+    This function writes the .docx file of a compiled template part by part: the members of the
+    template are copied without being decompressed, only document.xml is compressed.
+
+    Parameters:
+        compiled_template (dict): see compile_template.
+        document_xml (bytes): see render_document_xml.
+
+    Yields:
+        bytes: parts of the .docx file.
+    """
+    offset = 0
+    central_directory = []
+    for member in compiled_template["members"]:
+        name = member["name"].encode("utf-8")
+        compress_type, crc, file_size, data = member["compress_type"], member["crc"], member["file_size"], member["data"]
+        if data is None:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            data = compressor.compress(document_xml) + compressor.flush()
+            compress_type, crc, file_size = zipfile.ZIP_DEFLATED, zlib.crc32(document_xml), len(document_xml)
+        dos_time, dos_date = dos_date_time(member["date_time"])
+        header_fields = (20, member["flag_bits"], compress_type, dos_time, dos_date, crc, len(data), file_size, len(name))
+        local_header = struct.pack("<IHHHHHIIIHH", 0x04034b50, *header_fields, 0) + name
+        central_directory.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, *header_fields, 0, 0, 0, 0, 0, offset) + name)
+        yield local_header
+        yield data
+        offset += len(local_header) + len(data)
+    central_directory = b"".join(central_directory)
+    yield central_directory
+    entries = len(compiled_template["members"])
+    yield struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, entries, entries, len(central_directory), offset, 0)
+
+# =================================================
+# WordprocessingML fragments, the same XML as docx_writer_functions writes
+
+def run_xml(text, bold=False):
+    """
+    A run with text, new lines become w:br and tabs w:tab.
+    """
+    if _invalid_xml_characters.search(text):
+        raise ValueError("All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters")
+    parts = ["<w:r>", "<w:rPr><w:b/></w:rPr>" if bold else ""]
+    for position, piece in enumerate(re.split(r"([\t\r\n])", text)):
+        if position % 2:
+            parts.append("<w:tab/>" if piece == "\t" else "<w:br/>")
+        elif piece:
+            preserve = ' xml:space="preserve"' if len(piece.strip()) < len(piece) else ""
+            parts.append(f"<w:t{preserve}>{escape(piece)}</w:t>")
+    parts.append("</w:r>")
+    # A run without content is written as an empty element
+    return "<w:r/>" if len(parts) == 3 and not parts[1] else "".join(parts)
+
+def paragraph_xml(runs=()):
+    """
+    A paragraph with the runs (text, bold).
+    """
+    runs = "".join(run_xml(text, bold) for text, bold in runs)
+    return f"<w:p>{runs}</w:p>" if runs else "<w:p/>"
+
+def cell_text_xml(text):
+    """
+    Same as cell.text = text.
+    """
+    return paragraph_xml([(text, False)])
+
+def key_value_xml(key, value):
+    return paragraph_xml([(key, True), (": " + value, False)])
+
+def lesson_body_xml(lesson_body):
+    """
+    Same as write_lesson_body.
+    """
+    parts = []
+    for key, value in lesson_body.items():
+        if isinstance(value, list):
+            parts.append(key_value_xml(key, ""))
+            index = 1
+            for item in value:
+                for inner_key, inner_value in item.items():
+                    parts.append(paragraph_xml([(f"Stage {index} - {inner_key}", True), (": " + inner_value, False)]))
+                    index += 1
+        else:
+            parts.append(key_value_xml(key, value))
+    return "".join(parts)
+
+def paragraphs_xml(lines):
+    """
+    Same as document.add_paragraph(line) for each line.
+    """
+    return "".join(paragraph_xml([(line, False)] if line else []) for line in lines)
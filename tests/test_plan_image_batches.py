@@ -0,0 +1,34 @@
+import random
+import pytest
+from openai_functions import (plan_image_batches, completion_budget, extraction_tokens_per_image,
+                              uncalibrated_extraction_max_tokens_per_image, vision_model_max_output_tokens)
+
+# Tokens of one image with the tile formula: low detail, then 2 to 8 tiles of high detail
+image_token_choices = [85] + [85 + 170 * tiles for tiles in (2, 4, 6, 8)]
+
+def max_images_per_batch():
+    _, image_max_tokens = completion_budget(extraction_tokens_per_image, "page_extraction", "gpt-4-vision-preview",
+                                            uncalibrated_extraction_max_tokens_per_image)
+    return max(1, vision_model_max_output_tokens // image_max_tokens)
+
+def check_plan(image_tokens, max_concurrency):
+    batches, concurrency = plan_image_batches(image_tokens, max_concurrency)
+    assert [position for batch in batches for position in batch] == list(range(len(image_tokens)))
+    assert all(1 <= len(batch) <= max_images_per_batch() for batch in batches)
+    assert 1 <= concurrency <= len(batches)
+
+def test_no_image():
+    assert plan_image_batches([]) == ([], 1)
+
+@pytest.mark.parametrize("max_concurrency", [None, 1, 2, 3, 4, 8])
+def test_random_uploads(max_concurrency):
+    generator = random.Random(max_concurrency)
+    for _ in range(2000):
+        check_plan([generator.choice(image_token_choices) for _ in range(generator.randint(1, 60))], max_concurrency)
+
+def test_batch_cut_at_max_images():
+    # The first batches are closed by their tokens, the rest must still fit in max_images_per_batch
+    per_batch = max_images_per_batch()
+    image_tokens = [1445] * 4 + [85] * (2 * per_batch + 3)
+    for max_concurrency in (1, 2, 3):
+        check_plan(image_tokens, max_concurrency)
@@ -0,0 +1,40 @@
+import multiprocessing
+import time
+import pytest
+from rate_limit_functions import DeadlineExceeded, get_request_scheduler, shared_rate_limits, use_shared_rate_limits
+
+model = "gpt-4-turbo-preview"
+
+def acquire_for(rate_limits, tokens, seconds, results):
+    """
+    Runs in each process: acquire requests of tokens tokens until the deadline, put the number granted.
+    """
+    use_shared_rate_limits(rate_limits)
+    scheduler = get_request_scheduler(model)
+    deadline = time.monotonic() + seconds
+    granted = 0
+    while True:
+        try:
+            scheduler.acquire(tokens, "test", deadline)
+        except DeadlineExceeded:
+            break
+        granted += 1
+    results.put(granted)
+
+@pytest.mark.parametrize("requests_per_minute, tokens_per_minute, tokens", [(30, 1e9, 1), (1e6, 3000, 100)])
+def test_two_processes_share_the_rate_limits(requests_per_minute, tokens_per_minute, tokens):
+    context = multiprocessing.get_context("spawn")
+    rate_limits = shared_rate_limits(context, [model], requests_per_minute, tokens_per_minute)
+    results = context.Queue()
+    start = time.monotonic()
+    processes = [context.Process(target=acquire_for, args=(rate_limits, tokens, 2, results)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    granted = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - start
+
+    # One full bucket, then the refill of the time elapsed, for both processes together
+    allowed = min(requests_per_minute, tokens_per_minute / tokens)
+    assert allowed <= sum(granted) <= allowed + allowed / 60 * elapsed + 1
@@ -0,0 +1,309 @@
+# Import modules
+import base64
+import json
+import math
+import os
+import struct
+import threading
+import time
+
+# The vision model scales images to fit in 2048x2048, then scales the shortest side to 768
+# and bills every 512x512 tile. Sending more pixels than that only costs upload and CPU time.
+vision_max_long_side = 2048
+vision_max_short_side = 768
+vision_tile_size = 512
+# Tokens billed for an image: a base cost and a cost for each tile in high detail.
+# In low detail the image is seen at 512x512 and only the base cost is billed.
+vision_base_tokens = 85
+vision_tile_tokens = 170
+# Size of the image when its size can not be read from the request (768x1024, 4 tiles)
+default_image_size = (768, 1024)
+# Tokens of the chat format added to each message and to the reply
+message_overhead_tokens = 3
+reply_overhead_tokens = 3
+
+# Prices (dollars per token), limits and speed of each model, used to predict the cost and the time of a request.
+# The time is first_token_seconds, plus the prompt read at prompt_tokens_per_second, plus the response written at
+# output_tokens_per_second. prompt_scale corrects the counted prompt tokens, e.g. when tiktoken is not installed.
+# benchmarks/calibrate_estimator.py fits these values on the logged requests and writes them to the profile.
+default_model_profiles = {
+    "gpt-4-vision-preview": {"input_price": 10 / 1e6, "output_price": 30 / 1e6, "max_output_tokens": 4096,
+                             "context_window": 128000,
+                             "first_token_seconds": 2.0, "prompt_tokens_per_second": 5000,
+                             "output_tokens_per_second": 25, "prompt_scale": 1.0},
+    "gpt-4-turbo-preview": {"input_price": 10 / 1e6, "output_price": 30 / 1e6, "max_output_tokens": 4096,
+                            "context_window": 128000,
+                            "first_token_seconds": 0.8, "prompt_tokens_per_second": 5000,
+                            "output_tokens_per_second": 30, "prompt_scale": 1.0}}
+# Calibrated values of the models and the scale of the expected response of each purpose
+# (e.g. lesson_plans), they replace the defaults when the file exists
+estimator_profile_path = os.environ.get("TOKEN_ESTIMATOR_PROFILE", os.path.join(".cache", "token_estimator_profile.json"))
+# max_tokens of a request is the predicted response with this margin, so a response a bit longer than predicted
+# is not cut off. A cut off response (finish_reason "length") is logged, see calibrate_estimator.py.
+max_tokens_margin = float(os.environ.get("MAX_TOKENS_MARGIN", 0.3))
+# The prediction and the real usage of each request are appended to this file (JSON lines), an empty value
+# disables it. The file is renamed to .1 when it is bigger than token_estimate_log_max_bytes.
+token_estimate_log_path = os.environ.get("TOKEN_ESTIMATE_LOG", os.path.join(".cache", "token_estimates.jsonl"))
+token_estimate_log_max_bytes = int(os.environ.get("TOKEN_ESTIMATE_LOG_MAX_BYTES", 10 * 1024 * 1024))
+
+# tiktoken is optional (pip install tiktoken), it is loaded by the first count.
+# Without it, text is counted as about 4 characters per token.
+_encodings = {}
+_encodings_lock = threading.Lock()
+_estimator_profile = None
+_estimator_profile_lock = threading.Lock()
+_token_estimate_log_lock = threading.Lock()
+
+def get_encoding(model):
+    """
+    The tiktoken encoding of a model, None if tiktoken is not installed or its encoding can not be loaded.
+    """
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                import tiktoken
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding("cl100k_base")
+            except ImportError:
+                _encodings[model] = None
+            except Exception as e:
+                # The encoding is downloaded on its first use
+                print(f"tiktoken encoding of {model} could not be loaded, tokens are estimated: {e}")
+                _encodings[model] = None
+        return _encodings[model]
+
+def count_text_tokens(text, model="gpt-4-turbo-preview"):
+    """
+    Tokens of a text, counted by tiktoken or estimated at about 4 characters per token.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def vision_image_tokens(image_width, image_height, detail="high"):
+    """
+    This function gives the tokens billed by the vision model for an image.
+
+    Parameters:
+        image_width, image_height (required): size of the image which is sent.
+        detail (optional): "high" or "low".
+
+    Return:
+        int: 85 tokens in low detail, else 85 tokens and 170 tokens for each 512x512 tile of the image,
+             once scaled by the model.
+    """
+    if detail == "low":
+        return vision_base_tokens
+    long_side, short_side = max(image_width, image_height), min(image_width, image_height)
+    scale = min(1.0, vision_max_long_side / long_side, vision_max_short_side / short_side)
+    tiles = math.ceil(image_width * scale / vision_tile_size) * math.ceil(image_height * scale / vision_tile_size)
+    return vision_base_tokens + vision_tile_tokens * tiles
+
+def image_size(image_bytes):
+    """
+    Size of a JPEG or PNG image read from its first bytes, without decoding it.
+
+    Returns:
+        tuple: (width, height), None if it can not be read.
+    """
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" and len(image_bytes) >= 24:
+        return struct.unpack(">II", image_bytes[16:24])
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+    # Segments of the JPEG file until the frame header (SOF), which has the size
+    position = 2
+    while position + 9 <= len(image_bytes) and image_bytes[position] == 0xFF:
+        marker = image_bytes[position + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", image_bytes[position + 5:position + 9])
+            return width, height
+        position += 2 + struct.unpack(">H", image_bytes[position + 2:position + 4])[0]
+    return None
+
+def image_url_tokens(image_url):
+    """
+    Tokens of an image sent in a message.
+
+    Parameters:
+        image_url (str or dict): data url of the image, or {"url": data url, "detail": "low", "high" or "auto"}.
+    """
+    url, detail = (image_url.get("url", ""), image_url.get("detail", "auto")) if isinstance(image_url, dict) \
+        else (image_url, "auto")
+    if detail == "low":
+        return vision_base_tokens
+    size = None
+    if url.startswith("data:") and "," in url:
+        # The header of the image is in its first bytes
+        header = url.split(",", 1)[1][:8192]
+        try:
+            size = image_size(base64.b64decode(header[:len(header) // 4 * 4]))
+        except (ValueError, struct.error):
+            size = None
+    return vision_image_tokens(*(size or default_image_size))
+
+def estimate_prompt_tokens(messages, model="gpt-4-turbo-preview"):
+    """
+    Tokens of the messages of a request: the text counted with count_text_tokens, the images with
+    vision_image_tokens and the tokens of the chat format.
+    """
+    tokens = reply_overhead_tokens
+    for message in messages:
+        tokens += message_overhead_tokens
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        for item in content:
+            if item.get("type") == "text":
+                tokens += count_text_tokens(item["text"], model)
+            elif item.get("type") == "image_url":
+                tokens += image_url_tokens(item["image_url"])
+    return tokens
+
+def load_estimator_profile(path=None):
+    """
+    Load the calibrated profile written by benchmarks/calibrate_estimator.py, see estimator_profile_path.
+
+    Returns:
+        dict: {"models": {model: values which replace default_model_profiles}, "output_scale": {purpose: scale}}
+    """
+    global _estimator_profile
+    profile = {"models": {}, "output_scale": {}}
+    try:
+        with open(path or estimator_profile_path) as profile_file:
+            loaded_profile = json.load(profile_file)
+        profile["models"].update(loaded_profile.get("models", {}))
+        profile["output_scale"].update(loaded_profile.get("output_scale", {}))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Token estimator profile could not be loaded, the defaults are used: {e}")
+    with _estimator_profile_lock:
+        _estimator_profile = profile
+    return profile
+
+def estimator_profile():
+    with _estimator_profile_lock:
+        profile = _estimator_profile
+    return profile if profile is not None else load_estimator_profile()
+
+def model_profile(model):
+    """
+    Price, limits and speed of a model, see default_model_profiles. An unknown model uses the text model values.
+    """
+    profile = dict(default_model_profiles.get(model, default_model_profiles["gpt-4-turbo-preview"]))
+    profile.update(estimator_profile()["models"].get(model, {}))
+    return profile
+
+def completion_budget(expected_tokens, purpose, model="gpt-4-turbo-preview", uncalibrated_max_tokens=None):
+    """
+    This function predicts the tokens of a response and gives its max_tokens.
+
+    Parameters:
+        expected_tokens (int): tokens expected for the response, e.g. lesson_plan_tokens of the days.
+        purpose (str): what the response is, e.g. lesson_plans. The calibrated scale of the purpose is applied.
+        model (str, optional): name of the model.
+        uncalibrated_max_tokens (int, optional): max_tokens is not lower than this while the purpose has no
+                                                 calibrated scale, e.g. the limit used before the estimator.
+
+    Returns:
+        tuple: (predicted tokens of the response, max_tokens with max_tokens_margin, at most the maximum of the model)
+    """
+    maximum = model_profile(model)["max_output_tokens"]
+    output_scale = estimator_profile()["output_scale"].get(purpose)
+    predicted_tokens = max(1, round(expected_tokens * (output_scale or 1.0)))
+    max_tokens = math.ceil(predicted_tokens * (1 + max_tokens_margin))
+    if output_scale is None and uncalibrated_max_tokens:
+        # The expected tokens are only a guess until calibrate_estimator has seen real responses
+        max_tokens = max(max_tokens, uncalibrated_max_tokens)
+    return min(predicted_tokens, maximum), min(maximum, max_tokens)
+
+def request_cost(model, prompt_tokens, completion_tokens):
+    profile = model_profile(model)
+    return prompt_tokens * profile["input_price"] + completion_tokens * profile["output_price"]
+
+def request_seconds(model, prompt_tokens, completion_tokens):
+    profile = model_profile(model)
+    return (profile["first_token_seconds"] + prompt_tokens / profile["prompt_tokens_per_second"]
+            + completion_tokens / profile["output_tokens_per_second"])
+
+def estimate_request(model, messages, purpose, completion_tokens, max_tokens=None):
+    """
+    This function predicts the tokens, the time and the cost of a request before it is sent.
+
+    Parameters:
+        model (str): name of the model.
+        messages (list): messages of the request.
+        purpose (str): what the response is, e.g. lesson_plans, see completion_budget.
+        completion_tokens (int): predicted tokens of the response.
+        max_tokens (int, optional): max_tokens of the request.
+
+    Returns:
+        dict: {"model", "purpose", "images", "max_tokens", "prompt_tokens", "completion_tokens", "seconds", "cost"}
+    """
+    prompt_tokens = round(estimate_prompt_tokens(messages, model) * model_profile(model)["prompt_scale"])
+    images = sum(item.get("type") == "image_url" for message in messages if not isinstance(message["content"], str)
+                 for item in message["content"])
+    return {"model": model, "purpose": purpose, "images": images, "max_tokens": max_tokens,
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "seconds": request_seconds(model, prompt_tokens, completion_tokens),
+            "cost": request_cost(model, prompt_tokens, completion_tokens)}
+
+def log_token_estimate(entry):
+    if not token_estimate_log_path:
+        return
+    try:
+        with _token_estimate_log_lock:
+            directory = os.path.dirname(token_estimate_log_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if os.path.exists(token_estimate_log_path) and \
+                    os.path.getsize(token_estimate_log_path) > token_estimate_log_max_bytes:
+                os.replace(token_estimate_log_path, f"{token_estimate_log_path}.1")
+            with open(token_estimate_log_path, "a") as log_file:
+                log_file.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        # The log must never break a request
+        print(f"Token estimate log write failed: {e}")
+
+def record_estimate(span, estimate, response=None, response_text=None, seconds=None, finish_reason=None):
+    """
+    Compare the prediction of a request with what it really used: the prediction and the real cost are added to
+    the span and both are logged, see token_estimate_log_path.
+
+    Parameters:
+        span (dict): stage of the trace of the request.
+        estimate (dict): given by estimate_request.
+        response (optional): the response, its usage is used when it has one.
+        response_text (str, optional): text of a response without usage (streamed), its tokens are counted.
+        seconds (float, optional): time of the request, from when it was sent to its last token.
+        finish_reason (str, optional): finish reason of a streamed response.
+    """
+    span["predicted_prompt_tokens"] = estimate["prompt_tokens"]
+    span["predicted_completion_tokens"] = estimate["completion_tokens"]
+    span["predicted_seconds"] = round(estimate["seconds"], 3)
+    span["predicted_cost"] = round(estimate["cost"], 6)
+
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        prompt_tokens, completion_tokens, counted = usage.prompt_tokens, usage.completion_tokens, False
+    elif response_text is not None:
+        # Streamed responses have no usage: the prompt is not known and the response is counted
+        prompt_tokens, completion_tokens, counted = None, count_text_tokens(response_text, estimate["model"]), True
+    else:
+        prompt_tokens, completion_tokens, counted = None, None, True
+    if response is not None and getattr(response, "choices", None):
+        finish_reason = response.choices[0].finish_reason
+    cost = None
+    if prompt_tokens is not None and completion_tokens is not None:
+        cost = span["cost"] = round(request_cost(estimate["model"], prompt_tokens, completion_tokens), 6)
+
+    log_token_estimate({"time": time.time(), "model": estimate["model"], "purpose": estimate["purpose"],
+                        "images": estimate["images"], "max_tokens": estimate["max_tokens"],
+                        "predicted_prompt_tokens": estimate["prompt_tokens"],
+                        "predicted_completion_tokens": estimate["completion_tokens"],
+                        "predicted_seconds": estimate["seconds"], "predicted_cost": estimate["cost"],
+                        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "counted": counted,
+                        "seconds": seconds, "cost": cost, "finish_reason": finish_reason})
@@ -0,0 +1,155 @@
+# Import modules
+import contextvars
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+# Timing of each stage of a generation is written as one JSON object per line.
+# The log goes to TIMING_LOG_FILE if it is set, else to stderr. PIPELINE_TRACING=0 disables it.
+tracing_enabled = os.environ.get("PIPELINE_TRACING", "1") != "0"
+timing_log_file = os.environ.get("TIMING_LOG_FILE")
+
+logger = logging.getLogger("lesson_plan.timing")
+if not logger.handlers:
+    handler = logging.FileHandler(timing_log_file) if timing_log_file else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Trace of the generation running in the current thread (or copied context) and its current stage
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+def log_event(event):
+    if tracing_enabled:
+        logger.info(json.dumps(event, default=str))
+
+@contextmanager
+def trace_request(name, **attributes):
+    """
+    Collect the stages of one generation. Stages started in this context (and in thread pools
+    started with submit_in_context) are added to the trace.
+
+    Parameters:
+        name (str): name of the generation.
+        attributes: values logged with the trace (e.g. number of days).
+
+    Yields:
+        dict: the trace {"trace_id", "name", "attributes", "spans", "wall_time", "retries"}
+    """
+    trace = {"trace_id": uuid.uuid4().hex, "name": name, "attributes": attributes,
+             "spans": [], "wall_time": None, "retries": 0}
+    token = _current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace["wall_time"] = time.perf_counter() - start
+        _current_trace.reset(token)
+        log_event({"event": "trace", "trace_id": trace["trace_id"], "name": name, **attributes,
+                   "wall_time": trace["wall_time"], "retries": trace["retries"],
+                   "stages": summarize_trace(trace)})
+
+@contextmanager
+def trace_stage(stage, **attributes):
+    """
+    Measure one stage of the generation.
+
+    Parameters:
+        stage (str): name of the stage (e.g. vision_completion).
+        attributes: values logged with the stage (e.g. day, payload_bytes).
+
+    Yields:
+        dict: the span, more values can be added to it while the stage runs, see record_usage.
+    """
+    trace = _current_trace.get()
+    span = {"stage": stage, **attributes, "retries": 0}
+    token = _current_span.set(span)
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield span
+    except Exception as e:
+        span["error"] = str(e)
+        raise
+    finally:
+        span["wall_time"] = time.perf_counter() - start
+        span["cpu_time"] = time.thread_time() - cpu_start
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # A generator closed from another context
+            pass
+        if trace is not None:
+            trace["spans"].append(span)
+        log_event({"event": "stage", "trace_id": trace["trace_id"] if trace else None, **span})
+
+def record_usage(span, response):
+    """
+    Add token usage of an OpenAI response to a span.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        span["prompt_tokens"] = usage.prompt_tokens
+        span["completion_tokens"] = usage.completion_tokens
+        span["total_tokens"] = usage.total_tokens
+
+def count_retry():
+    """
+    Count a retried API request in the current stage and trace.
+    """
+    span, trace = _current_span.get(), _current_trace.get()
+    if span is not None:
+        span["retries"] += 1
+    if trace is not None:
+        trace["retries"] += 1
+
+def current_trace_id():
+    """
+    Returns:
+        str: id of the trace of the current generation, None outside of trace_request.
+    """
+    trace = _current_trace.get()
+    return trace["trace_id"] if trace is not None else None
+
+def log_warning(message, **attributes):
+    """
+    Log a problem which does not stop the generation (e.g. a lesson body which is not generated) with the
+    trace of the current generation.
+    """
+    log_event({"event": "warning", "trace_id": current_trace_id(), "message": message, **attributes})
+
+def submit_in_context(executor, function, *args, **kwargs):
+    """
+    executor.submit which keeps the current trace, so stages run on the pool are part of it.
+    """
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+def summarize_trace(trace):
+    """
+    Group the spans of a trace by stage.
+
+    Returns:
+        list: one dictionary per stage in order of first appearance with count, total and
+              maximum wall time, cpu time, tokens, payload bytes, time waiting for the
+              rate limits, retries and errors.
+    """
+    stages = {}
+    for span in trace["spans"]:
+        summary = stages.setdefault(span["stage"], {"stage": span["stage"], "count": 0, "wall_time": 0.0,
+                                                    "max_wall_time": 0.0, "cpu_time": 0.0, "total_tokens": 0,
+                                                    "payload_bytes": 0, "queue_time": 0.0, "retries": 0,
+                                                    "errors": 0})
+        summary["count"] += 1
+        summary["wall_time"] += span["wall_time"]
+        summary["max_wall_time"] = max(summary["max_wall_time"], span["wall_time"])
+        summary["cpu_time"] += span["cpu_time"]
+        summary["total_tokens"] += span.get("total_tokens", 0)
+        summary["payload_bytes"] += span.get("payload_bytes", 0)
+        summary["queue_time"] += span.get("queue_time", 0)
+        summary["retries"] += span["retries"]
+        summary["errors"] += "error" in span
+    return list(stages.values())